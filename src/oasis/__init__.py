@@ -9,10 +9,12 @@
 # We include the views covering logging in/out and account signup and related.
 
 from flask import Flask, session, redirect, url_for, request, \
-    render_template, render_template_string, flash, abort
+    render_template, render_template_string, flash, abort, g
 import tempfile
 import datetime
 import os
+import time
+import cProfile
 
 import _strptime  # import should prevent thread import blocking issues
 # ask Google about:     AttributeError: _strptime
@@ -65,14 +67,39 @@ L.addHandler(FH)
 L.setLevel(OaConfig.loglevel)
 L.info("File logger starting up")
 
+if OaConfig.slow_query_log:
+    if os.access(OaConfig.slow_query_log, os.W_OK) or \
+            os.access(os.path.dirname(OaConfig.slow_query_log), os.W_OK):
+        SLOWH = RotatingFileHandler(filename=OaConfig.slow_query_log)
+        SLOWH.setFormatter(logging.Formatter("%(asctime)s %(process)d: %(message)s"))
+        SLOW_L = logging.getLogger("oasisqe.slowsql")
+        SLOW_L.addHandler(SLOWH)
+        SLOW_L.setLevel(logging.WARN)
+        SLOW_L.propagate = False
+    else:
+        L.warn("Unable to write to slow query log %s" % OaConfig.slow_query_log)
+
+# Profiled requests are logged here, or to the main log at INFO level.
+PROFILE_L = logging.getLogger("oasisqe.profile")
+if OaConfig.profile_log:
+    if os.access(OaConfig.profile_log, os.W_OK) or \
+            os.access(os.path.dirname(OaConfig.profile_log), os.W_OK):
+        PROFH = RotatingFileHandler(filename=OaConfig.profile_log)
+        PROFH.setFormatter(logging.Formatter("%(asctime)s %(process)d: %(message)s"))
+        PROFILE_L.addHandler(PROFH)
+        PROFILE_L.setLevel(logging.INFO)
+        PROFILE_L.propagate = False
+    else:
+        L.warn("Unable to write to profile log %s" % OaConfig.profile_log)
+
 from functools import wraps
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from oasis.lib import Users2, Users, DB
+from oasis.lib import Users2, Users, DB, Profiling
 from oasis.lib.Audit import audit
-from oasis.lib.Permissions import satisfy_perms
+from oasis.lib.Permissions import satisfy_perms, check_perm
 from oasis.lib.General import sanitize_username
 
 csrf=CSRFProtect(app)
@@ -116,6 +143,64 @@ def template_context():
     }}
 
 
+def _want_profile():
+    """ Should we profile this request? Sysadmins can ask for it with a
+        header or cookie, or profile_requests turns it on for everything.
+    """
+    if OaConfig.profile_requests:
+        return True
+    if request.headers.get("X-Oasis-Profile") != "1" and \
+            request.cookies.get("oasis_profile") != "1":
+        return False
+    return 'user_id' in session and check_perm(session['user_id'], 0, 'sysadmin')
+
+
+@app.before_request
+def profile_start():
+    """ Start profiling the request if it's wanted. """
+    if not _want_profile():
+        return
+    Profiling.start("%s %s" % (request.method, request.path))
+    if OaConfig.profile_dir:
+        g.cprofile = cProfile.Profile()
+        g.cprofile.enable()
+
+
+@app.after_request
+def profile_finish(response):
+    """ Log where a profiled request spent its time. A summary is also sent
+        back in the X-Oasis-Profile header.
+    """
+    profile = Profiling.stop()
+    if not profile:
+        return response
+    cprof = getattr(g, "cprofile", None)
+    if cprof:
+        cprof.disable()
+        g.cprofile = None
+        fname = "%s-%s-%s.prof" % (time.strftime("%Y%m%d-%H%M%S"),
+                                   request.endpoint or "none", os.getpid())
+        try:
+            cprof.dump_stats(os.path.join(OaConfig.profile_dir, fname))
+        except (IOError, OSError) as err:
+            L.warn("Unable to save profile %s: %s" % (fname, err))
+    PROFILE_L.info(profile.report())
+    response.headers["X-Oasis-Profile"] = profile.summary()
+    return response
+
+
+@app.teardown_request
+def profile_cleanup(exception):
+    """ Make sure profiling stops if the request failed. """
+    cprof = getattr(g, "cprofile", None)
+    if cprof:
+        cprof.disable()
+        g.cprofile = None
+    profile = Profiling.stop()
+    if profile:
+        PROFILE_L.info("%s (failed: %s)" % (profile.report(), exception))
+
+
 @app.errorhandler(500)
 def internal_error(exception):
     L.error(exception)
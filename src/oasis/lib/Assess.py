@@ -9,7 +9,7 @@
 import re
 
 from oasis.lib.OaExceptions import OaMarkerError
-from oasis.lib import DB, General, Exams, Courses
+from oasis.lib import OaConfig, DB, General, Exams, Courses, Questions, Marking
 from logging import getLogger
 
 L = getLogger("oasisqe")
@@ -18,7 +18,17 @@ DATEFORMAT = "%d %b %H:%M"
 
 
 def mark_exam(user_id, exam_id):
-    """ Submit the assessment and mark it.
+    """ Submit the assessment for marking. If the marking queue is enabled
+        it's queued for the marking workers, otherwise it's marked now.
+        Returns True if it went well, or False if a problem.
+    """
+    if OaConfig.marking_queue:
+        return Marking.enqueue(user_id, exam_id)
+    return mark_exam_now(user_id, exam_id)
+
+
+def mark_exam_now(user_id, exam_id, submittime=None):
+    """ Mark the assessment. submittime is when it was submitted, if not now.
         Returns True if it went well, or False if a problem.
     """
     numquestions = Exams.get_num_questions(exam_id)
@@ -65,7 +75,7 @@ def mark_exam(user_id, exam_id):
         examtotal += total
     if not errors:
         Exams.set_user_status(user_id, exam_id, 5)
-        Exams.set_submit_time(user_id, exam_id)
+        Exams.set_submit_time(user_id, exam_id, submittime)
         Exams.save_score(exam_id, user_id, examtotal)
         Exams.touchuserexam(exam_id, user_id)
 
@@ -130,11 +140,11 @@ def render_own_marked_exam(student, exam):
                  }, ], False
     examtotal = 0.0
     for question in questions:
-        qtemplate = DB.get_q_parent(question)
+        qctx = Questions.get_context(question)
 
         answers = DB.get_q_guesses_before_time(question, examsubmit)
-        pos = DB.get_qt_exam_pos(exam, qtemplate)
-        marks = General.mark_q(question, answers)
+        pos = DB.get_qt_exam_pos(exam, qctx.qt_id)
+        marks = General.mark_q(qctx, answers)
         parts = [int(var[1:])
                  for var in marks.keys()
                  if re.search("^A([0-9]+$)", var) > 0]
@@ -159,7 +169,7 @@ def render_own_marked_exam(student, exam):
                 'comment': comment
             })
 
-        html = General.render_q_html(question)
+        html = General.render_q_html(qctx)
         results.append({
             'pos': pos,
             'html': html,
@@ -171,13 +181,9 @@ def render_own_marked_exam(student, exam):
 def get_exam_list_sorted(user_id, prev_years=False):
     """ Return a list of exams for the given user. """
     courses = Courses.get_all()
-    exams = []
+    exam_ids = []
     for cid in courses:
-        try:
-            exams += [Exams.get_exam_struct(e, user_id)
-                      for e in Courses.get_exams(cid, prev_years=prev_years)]
-        except KeyError, err:
-            L.error("Failed fetching exam list for user %s: %s" %
-                    (user_id, err))
+        exam_ids += Courses.get_exams(cid, prev_years=prev_years)
+    exams = Exams.get_exam_structs(exam_ids, user_id)
     exams.sort(key=lambda y: y['start_epoch'], reverse=True)
     return exams
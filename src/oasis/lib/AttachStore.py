@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" AttachStore.py
+    Where question and question template attachment data is kept.
+
+    By default it's in the database, in qattach.data and qtattach.data. If
+    attachment_dir is set, new attachments go in a tree of files under it
+    named by their content hash instead, and the row keeps the hash with
+    data NULL. Identical attachments, like the copies copy_qt_all() makes
+    and the same image generated for many variations, share one file.
+
+    "oasisdb moveblobs" moves attachments already in the database out.
+"""
+
+import errno
+import os
+import string
+import tempfile
+
+import OaConfig
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+
+class FileStore(object):
+    """ Blobs in a directory tree, named by their hex hash, eg.
+            root/ab/cd/abcdef0123...
+
+        accel is the URL prefix nginx serves root from as an internal
+        location, for X-Accel-Redirect, or None to send files ourselves.
+    """
+
+    def __init__(self, root, accel=None):
+        self.root = root
+        self.accel = accel
+
+    def _relpath(self, digest):
+        if not isinstance(digest, basestring) or len(digest) < 8 or \
+                not all([ch in string.hexdigits for ch in digest]):
+            raise ValueError("Invalid attachment hash %r" % digest)
+        digest = digest.lower()
+        return os.path.join(digest[0:2], digest[2:4], digest)
+
+    def path(self, digest):
+        """ Filename of the blob with the given hash. """
+        return os.path.join(self.root, self._relpath(digest))
+
+    def accel_url(self, digest):
+        """ X-Accel-Redirect location of the blob with the given hash. """
+        return "%s/%s" % (self.accel.rstrip("/"), self._relpath(digest).replace(os.sep, "/"))
+
+    def get(self, digest):
+        """ The data with the given hash, or None if we don't have it. """
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except IOError as err:
+            L.error("Unable to read attachment %s from store: %s" % (digest, err))
+            return None
+
+    def put(self, digest, data):
+        """ Store the data under its hash. Returns True if it's stored, or
+            already was. Returns False if a different blob already has the
+            hash, the caller should keep the data elsewhere.
+        """
+        path = self.path(digest)
+        if os.path.exists(path):
+            if os.path.getsize(path) == len(data):
+                with open(path, "rb") as f:
+                    if f.read() == data:
+                        return True
+            L.error("Attachment hash collision on %s, not storing." % digest)
+            return False
+
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        # Write it beside where it goes and rename, so nobody sees half a file.
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmpname, 0644)  # the web server may be sending it
+            os.rename(tmpname, path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        return True
+
+
+if OaConfig.attachment_dir:
+    STORE = FileStore(OaConfig.attachment_dir, OaConfig.attachment_accel or None)
+else:
+    STORE = None
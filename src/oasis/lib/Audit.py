@@ -5,18 +5,211 @@
 
 """ Audit.py
     Handle storing and searching audit messages
+
+    audit() doesn't write to the database itself, it queues the record for
+    a background thread that writes them in batches, so a burst of logins
+    doesn't wait on an INSERT each. If the queue is full, or the database
+    can't be written, records go to the spill file (audit_spill_file) and
+    are written the next time a process starts. Whatever is queued is
+    written before the process exits.
 """
 
-from oasis.lib.DB import run_sql
+import Queue
+import atexit
+import errno
+import json
+import os
+import tempfile
+import threading
+import time
+
+from oasis.lib.DB import run_sql, BATCH_SIZE
+from oasis.lib import OaConfig
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+# Records waiting to be written, per process.
+MAX_QUEUE = 10000
+
+# Seconds to wait for the writer to finish at exit.
+EXIT_TIMEOUT = 10
+
+_STOP = object()
+
+_lock = threading.Lock()
+_queue = None
+_writer = None
+_writer_pid = None
+
+
+def _spill_file():
+    if OaConfig.audit_spill_file:
+        return OaConfig.audit_spill_file
+    return os.path.join(tempfile.gettempdir(), "oasisqe-audit-%s.spill" % os.getuid())
+
+
+def _open_spill(path, flags):
+    """ Open the spill file, only readable by us. The default one is in the
+        shared temporary directory, so don't follow links and don't use a
+        file someone else made.
+    """
+    fd = os.open(path, flags | getattr(os, "O_NOFOLLOW", 0), 0600)
+    if os.fstat(fd).st_uid != os.getuid():
+        os.close(fd)
+        raise OSError(errno.EPERM, "Audit spill file %s isn't ours" % path)
+    return fd
+
+
+def _insert(batch):
+    """ Write (time, class, instigator, object, module, message) records
+        to the database in one INSERT. time is in epoch seconds.
+    """
+    values = ", ".join(["(to_timestamp(%s), %s, %s, %s, %s, %s)"] * len(batch))
+    params = []
+    for record in batch:
+        params.extend(record)
+    run_sql("""INSERT INTO audit ("time", "class", "instigator",
+                                  "object", "module", "longmesg")
+               VALUES %s;""" % values, params, fetch=False)
+
+
+def _spill(records):
+    """ Keep records we couldn't write in the spill file, one per line. """
+    try:
+        with _lock:
+            fd = _open_spill(_spill_file(), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            with os.fdopen(fd, "a") as spillf:
+                for record in records:
+                    spillf.write(json.dumps(record) + "\n")
+    except (IOError, OSError, TypeError, ValueError) as err:
+        L.error("Unable to save %d audit records: %s %s" % (len(records), err, records))
+
+
+def _write(records):
+    """ Write the records BATCH_SIZE at a time, keeping any batch we can't
+        write in the spill file.
+    """
+    for start in range(0, len(records), BATCH_SIZE):
+        batch = records[start:start + BATCH_SIZE]
+        try:
+            _insert(batch)
+        except Exception as err:
+            L.error("Unable to write %d audit records, spilling them: %s" % (len(batch), err))
+            _spill(batch)
+
+
+def replay_spilled():
+    """ Write any records left in the spill file. The file is renamed first,
+        so only one process picks up each record.
+        Returns the number written.
+    """
+    spill = _spill_file()
+    if not os.path.exists(spill):
+        return 0
+    replay = "%s.%s" % (spill, os.getpid())
+    try:
+        os.rename(spill, replay)
+    except OSError:
+        return 0  # someone else got it
+    records = []
+    try:
+        fd = _open_spill(replay, os.O_RDONLY)
+    except OSError as err:
+        L.error("Not replaying audit spill file: %s" % err)
+        return 0
+    with os.fdopen(fd) as replayf:
+        for line in replayf:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                L.warn("Ignoring bad line in audit spill file: %r" % line)
+    _write(records)
+    os.remove(replay)
+    L.info("Replayed %d spilled audit records" % len(records))
+    return len(records)
+
+
+def _drain(queue):
+    """ Writer thread. Waits for a record, then writes it and everything
+        else queued with it.
+    """
+    try:
+        replay_spilled()
+    except Exception as err:
+        L.error("Unable to replay spilled audit records: %s" % err)
+    stopping = False
+    while not stopping:
+        records = [queue.get()]
+        while len(records) < BATCH_SIZE:
+            try:
+                records.append(queue.get_nowait())
+            except Queue.Empty:
+                break
+        if _STOP in records:
+            stopping = True
+            records = [record for record in records if record is not _STOP]
+        if records:
+            _write(records)
+
+
+def _get_queue():
+    """ The queue for this process, starting the writer if needed. A forked
+        child doesn't have its parent's thread so it gets its own.
+    """
+    global _queue, _writer, _writer_pid
+    if _writer_pid == os.getpid() and _writer.is_alive():
+        return _queue
+    with _lock:
+        if _writer_pid != os.getpid() or not _writer.is_alive():
+            _queue = Queue.Queue(MAX_QUEUE)
+            _writer = threading.Thread(target=_drain, args=(_queue,), name="audit-writer")
+            _writer.daemon = True
+            _writer.start()
+            _writer_pid = os.getpid()
+    return _queue
+
+
+def flush(timeout=EXIT_TIMEOUT):
+    """ Write everything queued and stop the writer. Anything it doesn't
+        get to in time is spilled. The next audit() starts a new writer.
+    """
+    global _writer_pid
+    if _writer_pid != os.getpid() or not _writer.is_alive():
+        return
+    queue = _queue
+    writer = _writer
+    _writer_pid = None
+    try:
+        queue.put(_STOP, True, timeout)
+    except Queue.Full:
+        pass
+    writer.join(timeout)
+    if writer.is_alive():
+        L.error("Audit writer didn't finish in %ss" % timeout)
+    leftover = []
+    while True:
+        try:
+            record = queue.get_nowait()
+        except Queue.Empty:
+            break
+        if record is not _STOP:
+            leftover.append(record)
+    if leftover:
+        _spill(leftover)
+
+
+atexit.register(flush)
 
 
 def audit(aclass, instigator, obj, module, message):
     """Record the message in the audit system."""
-    sql = """INSERT INTO audit ("time", "class", "instigator",
-                                "object", "module", "longmesg")
-            VALUES (NOW(), %s, %s, %s, %s, %s);"""
-    params = [aclass, instigator, obj, module, message]
-    run_sql(sql, params)
+    record = [time.time(), aclass, instigator, obj, module, message]
+    try:
+        _get_queue().put_nowait(record)
+    except Queue.Full:
+        L.warn("Audit queue full, spilling record.")
+        _spill([record])
 
 
 def get_records_by_user(uid, start=None, end=None, limit=100, offset=0):
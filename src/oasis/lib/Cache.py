@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" Cache.py
+    A small per-process cache that sits in front of memcached for data that
+    never changes once written, such as question template attachments and
+    variations for a given (qtemplate, version).
+
+    Lookups go to the in-process LRU first, then memcached, and the caller
+    fetches from the database on a miss and calls set().
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+
+class LRUCache(object):
+    """ A thread safe least-recently-used cache bounded by the (approximate)
+        total size in bytes of the items it holds.
+
+        Items older than ttl seconds are treated as missing, which bounds how
+        long an entry can be out of date if the data underneath it is ever
+        rewritten in place.
+    """
+
+    def __init__(self, maxbytes, ttl=None):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()   # key: (value, size, stored)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return (True, value) if the key is cached, else (False, None).
+        """
+        with self.lock:
+            try:
+                value, size, stored = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return False, None
+            if self.ttl and time.time() - stored > self.ttl:
+                self.bytes -= size
+                self.misses += 1
+                return False, None
+            self.items[key] = (value, size, stored)   # most recently used
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value, size):
+        """ Store the value, evicting the least recently used items to
+            make room. Items larger than the whole cache aren't stored.
+        """
+        if size > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, size, time.time())
+            self.bytes += size
+            while self.bytes > self.maxbytes:
+                _, (_, oldsize, _) = self.items.popitem(last=False)
+                self.bytes -= oldsize
+                self.evictions += 1
+
+    def delete(self, key):
+        """ Remove the item if it's there. """
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+
+    def clear(self):
+        """ Remove everything. """
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TwoTierCache(object):
+    """ An in-process LRUCache backed by memcached (an MCPool).
+
+        Keys are tuples, eg. (qt_id, name, version, variation). Values stored
+        in memcached must be picklable. The local tier keeps whatever is
+        passed to set(), so callers storing mutable objects should copy
+        what they get back.
+    """
+
+    def __init__(self, name, mc, maxbytes, ttl=None, mc_expiry=None):
+        self.name = name
+        self.mc = mc
+        self.mc_expiry = mc_expiry
+        self.local = LRUCache(maxbytes, ttl)
+        self.lock = threading.Lock()
+        self.mc_hits = 0
+        self.misses = 0
+
+    def _mc_key(self, key):
+        """ memcached keys can't contain spaces and are limited in length. """
+        return "%s-%s" % (self.name, hashlib.md5(repr(key)).hexdigest())
+
+    def get(self, key):
+        """ Return (True, value) if the key is cached in either tier,
+            else (False, None).
+        """
+        found, value = self.local.get(key)
+        if found:
+            return True, value
+        obj = self.mc.get(self._mc_key(key))
+        if obj:
+            value, size = obj
+            self.local.set(key, value, size)
+            with self.lock:
+                self.mc_hits += 1
+            return True, value
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key, value, size):
+        """ Put the value in both tiers. size is its approximate size in
+            bytes, for the local LRU.
+        """
+        self.local.set(key, value, size)
+        self.mc.set(self._mc_key(key), (value, size), self.mc_expiry)
+
+    def delete(self, key):
+        """ Remove the key from both tiers. Other processes may still have
+            it in their local tier until it expires.
+        """
+        self.local.delete(key)
+        self.mc.delete(self._mc_key(key))
+
+    def stats(self):
+        """ Hit/miss statistics, for monitoring.
+        """
+        lookups = self.local.hits + self.mc_hits + self.misses
+        return {
+            'name': self.name,
+            'local_hits': self.local.hits,
+            'mc_hits': self.mc_hits,
+            'misses': self.misses,
+            'hit_ratio': (float(self.local.hits + self.mc_hits) / lookups) if lookups else 0.0,
+            'entries': len(self.local),
+            'bytes': self.local.bytes,
+            'maxbytes': self.local.maxbytes,
+            'evictions': self.local.evictions
+        }
@@ -87,8 +87,9 @@ def save_perms(request, cid, user_id):
     permlist = get_course_perms(cid)
     perms = {}
     users = {}
+    found = Users2.get_users([perm[0] for perm in permlist])
     for perm in permlist:
-        u = Users2.get_user(perm[0])
+        u = found[perm[0]]
         uname = u['uname']
         if uname not in users:
             users[uname] = {}
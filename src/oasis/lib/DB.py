@@ -10,40 +10,126 @@
 """
 
 import psycopg2
+import copy
 import cPickle
 import datetime
+import hashlib
 import json
 import os
 import OaConfig
 import Pool
+import Cache
+import AttachStore
 from logging import getLogger
 
 L = getLogger("oasisqe.db")
 
 IntegrityError = psycopg2.IntegrityError
 
-# 3 connections. Lets us keep going if one is slow but
-# doesn't overload the server if there're a lot of us
-dbpool = Pool.DbPool(OaConfig.oasisdbconnectstring, 3)
+# Start with a few connections so we can keep going if one is slow, and
+# grow on demand up to the configured maximum under load.
+dbpool = Pool.DbPool(OaConfig.oasisdbconnectstring,
+                     OaConfig.dbpool_min,
+                     OaConfig.dbpool_max,
+                     timeout=OaConfig.dbpool_timeout)
 
 
 from Pool import MCPool
 
-# Get a pool of memcache connections to use
-MC = MCPool('127.0.0.1:11211', 3)
+# Maximum number of rows to send in a single multi-row INSERT
+BATCH_SIZE = 500
 
+# Our memcached servers
+MC = MCPool(OaConfig.memcache_servers,
+            timeout=OaConfig.memcache_timeout,
+            fail_threshold=OaConfig.memcache_fail_threshold,
+            retry=OaConfig.memcache_retry)
 
-def run_sql(sql, params=None, quiet=False):
-    # type: (str, list, bool) -> list
-    """ Execute SQL commands using the dbpool"""
+# Question template attachments and variations never change once a
+# (qtemplate, version) exists, editing creates a new version, so we can keep
+# them close. Keyed by (qt_id, name, version, variation)
+TEMPLATE_CACHE = Cache.TwoTierCache("qtdata", MC,
+                                    OaConfig.local_cache_mb * 1024 * 1024,
+                                    ttl=OaConfig.local_cache_ttl,
+                                    mc_expiry=OaConfig.local_cache_ttl)
+
+# Parsed question HTML and compiled question scripts, derived from the above
+# so also per (qt_id, version). In-process only. See QHtml and QScripts.
+COMPILED_CACHE = Cache.LRUCache(OaConfig.compiled_cache_mb * 1024 * 1024,
+                                ttl=OaConfig.local_cache_ttl)
+
+
+# The hot statements, run as prepared statements. See query().
+QUERIES = {}
+
+
+def run_sql(sql, params=None, quiet=False, fetch=None):
+    # type: (str, list, bool, bool) -> list
+    """ Execute SQL commands using the dbpool.
+        If fetch isn't given, whether to return rows is guessed from the SQL.
+    """
     if not quiet:
         L.debug("SQL: %s ;(%s)", sql, params)
     conn = dbpool.start()
-    res = conn.run_sql(sql, params)
-    dbpool.finish(conn)
+    try:
+        res = conn.run_sql(sql, params, fetch=fetch)
+    finally:
+        dbpool.finish(conn)
+    return res
+
+
+def query(name, sql, fetch=False):
+    # type: (str, str, bool) -> Pool.Query
+    """ Declare a frequently run statement. Run it with run_query(), which
+        prepares it on each database connection the first time it's used
+        there. fetch says whether it returns rows.
+    """
+    assert name not in QUERIES, "Query %s declared twice" % name
+    QUERIES[name] = Pool.Query(name, sql, fetch)
+    return QUERIES[name]
+
+
+def run_query(query_, params=None):
+    # type: (Pool.Query, list) -> list
+    """ Execute a query declared with query(), using the dbpool. """
+    L.debug("SQL: %s ;(%s)", query_.name, params)
+    conn = dbpool.start()
+    try:
+        res = conn.run_query(query_, params)
+    finally:
+        dbpool.finish(conn)
     return res
 
 
+def query_stats():
+    """ How often each of the declared queries has been run in this process
+        and how long they took, most total time first.
+    """
+    return sorted([q.stats() for q in QUERIES.values()],
+                  key=lambda q: q['total'], reverse=True)
+
+
+def runtime_stats(top=20):
+    """ Database and cache statistics for this process, for monitoring.
+        Includes the declared queries and the top ad-hoc statements by total
+        time. Times are in seconds.
+    """
+    return {
+        'pid': os.getpid(),
+        'pool': dbpool.stats(),
+        'queries': query_stats(),
+        'statements': Pool.all_statement_stats()[:top],
+        'memcache': MC.stats(),
+        'template_cache': TEMPLATE_CACHE.stats()
+    }
+
+
+Q_SET_VIEWTIME = query("set_q_viewtime",
+                       """UPDATE "questions"
+                          SET "firstview" = NOW()
+                          WHERE "question" = %s;""")
+
+
 def set_q_viewtime(question):
     # type: (int) -> None
     """ Record that the question has been viewed.
@@ -52,9 +138,13 @@ def set_q_viewtime(question):
     """
     assert isinstance(question, int)
     assert question != 0
-    run_sql("""UPDATE "questions"
-               SET "firstview" = NOW()
-               WHERE "question" = %s;""", [question, ])
+    run_query(Q_SET_VIEWTIME, [question, ])
+
+
+Q_SET_MARKTIME = query("set_q_marktime",
+                       """UPDATE questions
+                          SET "marktime"=NOW()
+                          WHERE "question"=%s;""")
 
 
 def set_q_marktime(question):
@@ -64,9 +154,7 @@ def set_q_marktime(question):
         we usually want the first time.
     """
     assert isinstance(question, int)
-    run_sql("""UPDATE questions
-               SET "marktime"=NOW()
-               WHERE "question"=%s;""", [question, ])
+    run_query(Q_SET_MARKTIME, [question, ])
 
 
 def get_q_viewtime(question):
@@ -84,15 +172,19 @@ def get_q_viewtime(question):
     return None
 
 
+Q_GET_MARKTIME = query("get_q_marktime",
+                       """SELECT "marktime"
+                          FROM "questions"
+                          WHERE "question"=%s;""", fetch=True)
+
+
 def get_q_marktime(question):
     # type: (int) -> str or None
     """ Return the time that the question was marked
         as a human readable string, or None if it hasn't been.
     """
     assert isinstance(question, int)
-    ret = run_sql("""SELECT "marktime"
-                     FROM "questions"
-                     WHERE "question"=%s;""", [question, ])
+    ret = run_query(Q_GET_MARKTIME, [question, ])
     if ret:
         marktime = ret[0][0]
         if marktime:
@@ -100,6 +192,13 @@ def get_q_marktime(question):
     return None
 
 
+Q_GET_EXAM_Q_BY_POS = query("get_exam_q_by_pos_student",
+                            """SELECT question FROM examquestions
+                               WHERE student = %s
+                                 AND position = %s
+                                 AND exam = %s;""", fetch=True)
+
+
 def get_exam_q_by_pos_student(exam, position, student):
     # type: (int, int, int) -> int or None
     """ Return the question at the given position in the exam for the student.
@@ -108,11 +207,7 @@ def get_exam_q_by_pos_student(exam, position, student):
     assert isinstance(exam, int)
     assert isinstance(position, int)
     assert isinstance(student, int)
-    ret = run_sql("""SELECT question FROM examquestions
-                        WHERE student = %s
-                        AND position = %s
-                        AND exam = %s;""",
-                  [student, position, exam])
+    ret = run_query(Q_GET_EXAM_Q_BY_POS, [student, position, exam])
     if ret:
         return int(ret[0][0])
     return False
@@ -146,6 +241,15 @@ def get_q_by_qt_student(qt_id, student):
     return False
 
 
+def get_q_score(q_id):
+    """ Return the score of a question, or None if it hasn't one."""
+    assert isinstance(q_id, int)
+    ret = run_sql("""SELECT score FROM "questions" WHERE question = %s;""", [q_id, ])
+    if ret and ret[0][0] is not None:
+        return float(ret[0][0])
+    return None
+
+
 def update_q_score(q_id, score):
     """ Set the score of a question."""
     assert isinstance(q_id, int)
@@ -166,28 +270,43 @@ def set_q_status(q_id, status):
     run_sql("""UPDATE "questions" SET "status" = %s WHERE "question" = %s;""", [status, q_id])
 
 
+Q_GET_Q_VERSION = query("get_q_version",
+                        """SELECT "version" FROM "questions" WHERE "question" = %s;""",
+                        fetch=True)
+
+
 def get_q_version(q_id):
     """ Return the template version this question was generated from """
     assert isinstance(q_id, int)
-    ret = run_sql("""SELECT "version" FROM "questions" WHERE "question" = %s;""", [q_id, ])
+    ret = run_query(Q_GET_Q_VERSION, [q_id, ])
     if ret:
         return int(ret[0][0])
     return None
 
 
+Q_GET_Q_VARIATION = query("get_q_variation",
+                          "SELECT variation FROM questions WHERE question = %s;",
+                          fetch=True)
+
+
 def get_q_variation(q_id):
     """ Return the template variation this question was generated from"""
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT variation FROM questions WHERE question = %s;", [q_id, ])
+    ret = run_query(Q_GET_Q_VARIATION, [q_id, ])
     if ret:
         return int(ret[0][0])
     return None
 
 
+Q_GET_Q_PARENT = query("get_q_parent",
+                       "SELECT qtemplate FROM questions WHERE question = %s;",
+                       fetch=True)
+
+
 def get_q_parent(q_id):
     """ Return the template this question was generated from"""
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT qtemplate FROM questions WHERE question = %s;", [q_id, ])
+    ret = run_query(Q_GET_Q_PARENT, [q_id, ])
     if ret:
         return int(ret[0][0])
     L.error("No parent found for question %s!" % q_id)
@@ -196,30 +315,69 @@ def get_q_parent(q_id):
 
 def save_guess(q_id, part, value):
     """ Store the guess in the database."""
-    assert isinstance(q_id, int)
-    assert isinstance(part, int)
-    assert isinstance(value, unicode)
-    L.info("Saving guess for qid %s:  %s = %s " % (q_id, part, value))
-    # noinspection PyComparisonWithNone
-    if value is not None:  # "" is legit
-        run_sql("""INSERT INTO guesses (question, created, part, guess)
-                   VALUES (%s, NOW(), %s, %s);""",
-                [q_id, part, value])
+    save_guesses([(q_id, part, value)])
+
+
+def save_guesses(guesses):
+    """ Store several guesses in the database at once.
+        guesses is a list of (q_id, part, value). They are added to the
+        guess history and latest_guesses in one go, so either all or none
+        are saved.
+    """
+    latest = {}
+    for q_id, part, value in guesses:
+        assert isinstance(q_id, int)
+        assert isinstance(part, int)
+        assert isinstance(value, unicode)
+        # noinspection PyComparisonWithNone
+        if value is not None:  # "" is legit
+            latest[(q_id, part)] = value
+    if not latest:
+        return
+    L.info("Saving guesses: %s" % (guesses,))
+    params = []
+    for (q_id, part), value in latest.iteritems():
+        params.extend([q_id, part, value])
+    values = ", ".join(["(%s, %s, %s)"] * len(latest))
+    # Several statements sent at once run as one transaction.
+    # No INSERT .. ON CONFLICT before PostgreSQL 9.5, so update the parts we
+    # have and add the ones we don't.
+    sql = """INSERT INTO guesses (question, created, part, guess)
+                 SELECT v.question, NOW(), v.part, v.guess
+                 FROM (VALUES %s) AS v(question, part, guess);
+             UPDATE latest_guesses AS l
+                 SET created = NOW(), guess = v.guess
+                 FROM (VALUES %s) AS v(question, part, guess)
+                 WHERE l.question = v.question AND l.part = v.part;
+             INSERT INTO latest_guesses (question, part, created, guess)
+                 SELECT v.question, v.part, NOW(), v.guess
+                 FROM (VALUES %s) AS v(question, part, guess)
+                 WHERE NOT EXISTS (SELECT 1 FROM latest_guesses AS l
+                                   WHERE l.question = v.question
+                                     AND l.part = v.part);""" % (values, values, values)
+    try:
+        run_sql(sql, params * 3, fetch=False)
+    except IntegrityError:
+        # Another request added one of the parts at the same time, try again
+        # now it's there to update.
+        run_sql(sql, params * 3, fetch=False)
+
+
+Q_GET_LATEST_GUESSES = query("get_q_latest_guesses",
+                             """SELECT part, guess, created
+                                FROM latest_guesses
+                                WHERE question = %s;""", fetch=True)
 
 
 def get_q_guesses(q_id):
     """ Return a dictionary of the recent guesses in a question."""
     assert isinstance(q_id, int)
-    ret = run_sql("""SELECT part, guess
-                     FROM guesses
-                     WHERE question = %s
-                     ORDER BY created DESC;""", [q_id, ])
+    ret = run_query(Q_GET_LATEST_GUESSES, [q_id, ])
     if not ret:
         return {}
     guesses = {}
     for row in ret:
-        if not "G%d" % (int(row[0])) in guesses:
-            guesses["G%d" % (int(row[0]))] = row[1]
+        guesses["G%d" % (int(row[0]))] = row[1]
     return guesses
 
 
@@ -229,18 +387,28 @@ def get_q_guesses_before_time(q_id, lasttime):
     """
     assert isinstance(q_id, int)
     assert isinstance(lasttime, datetime.datetime)
-    ret = run_sql("""SELECT part, guess
+    ret = run_query(Q_GET_LATEST_GUESSES, [q_id, ])
+    if not ret:
+        return {}
+    guesses = {}
+    for row in ret:
+        if row[2] is None or row[2] >= lasttime:
+            break
+        guesses["G%d" % (int(row[0]))] = row[1]
+    else:
+        return guesses
+    # Some were changed after, look back through the history for those.
+    ret = run_sql("""SELECT DISTINCT ON (part) part, guess
                      FROM guesses
                      WHERE question = %s
                        AND created < %s
-                     ORDER BY created DESC;""",
+                     ORDER BY part, created DESC, id DESC;""",
                   [q_id, lasttime])
     if not ret:
         return {}
     guesses = {}
     for row in ret:
-        if not "G%d" % (int(row[0])) in guesses:
-            guesses["G%d" % (int(row[0]))] = row[1]
+        guesses["G%d" % (int(row[0]))] = row[1]
     return guesses
 
 
@@ -329,12 +497,16 @@ def incr_qt_version(qt_id):
     return version
 
 
+Q_GET_QT_VERSION = query("get_qt_version",
+                         """SELECT version
+                            FROM qtemplates
+                            WHERE qtemplate = %s;""", fetch=True)
+
+
 def get_qt_version(qt_id):
     """ Fetch the version of a question template."""
     assert isinstance(qt_id, int)
-    ret = run_sql("""SELECT version
-                     FROM qtemplates
-                     WHERE qtemplate = %s;""", [qt_id, ])
+    ret = run_query(Q_GET_QT_VERSION, [qt_id, ])
     if ret:
         return int(ret[0][0])
     raise KeyError("Question Template version %s not found" % qt_id)
@@ -478,6 +650,112 @@ def get_qt_att_mimetype(qt_id, name, version=1000000000):
     return False
 
 
+def _att_info(row):
+    """ {'mimetype', 'hash', 'size', 'in_store'} from the columns of an
+        attachment row. in_store is True if the data is in the
+        AttachStore rather than the database.
+    """
+    return {
+        'mimetype': row[0],
+        'hash': row[1],
+        'size': row[2],
+        'in_store': row[3]
+    }
+
+
+def _att_data(data, digest):
+    """ The data of an attachment row, from the AttachStore if it's not in
+        the database.
+    """
+    if data is not None:
+        return str(data)
+    if not digest:
+        return ""  # an empty row from before hashes were kept
+    if not AttachStore.STORE:
+        L.error("Attachment %s is in the attachment store, but attachment_dir isn't set." % digest)
+        return None
+    return AttachStore.STORE.get(digest)
+
+
+def _att_column(data, digest):
+    """ What to put in the data column of a new attachment row. None if
+        it's gone in the AttachStore.
+    """
+    if AttachStore.STORE and AttachStore.STORE.put(digest, data):
+        return None
+    return psycopg2.Binary(data)
+
+
+def get_q_att_info(qt_id, name, variation, version=1000000000):
+    """ Return {'mimetype', 'hash', 'size', 'in_store'} for the question
+        attachment, without fetching the data, or None if there isn't one.
+        hash is the hex MD5 of the data, worked out when it was stored.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    assert isinstance(variation, int)
+    assert isinstance(name, str) or isinstance(name, unicode)
+    if version == 1000000000:
+        version = get_qt_version(qt_id)
+
+    key = (qt_id, name, version, variation, "info")
+    found, info = TEMPLATE_CACHE.get(key)
+    if found:
+        return info
+    ret = run_sql("""SELECT mimetype, hash, size, data IS NULL AND hash IS NOT NULL
+                     FROM qattach
+                     WHERE "name" = %s
+                       AND "qtemplate" = %s
+                       AND "variation" = %s
+                       AND "version" = %s;""", [name, qt_id, variation, version])
+    if not ret:
+        return None
+    info = _att_info(ret[0])
+    TEMPLATE_CACHE.set(key, info, 200)
+    return info
+
+
+def get_qt_att_info(qt_id, name, version=1000000000):
+    """ Return {'mimetype', 'hash', 'size', 'in_store'} for the newest
+        version (up to version) of the question template attachment, without
+        fetching the data, or None if there isn't one.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    assert isinstance(name, str) or isinstance(name, unicode)
+    if version == 1000000000:
+        version = get_qt_version(qt_id)
+
+    key = (qt_id, name, version, None, "info")
+    found, info = TEMPLATE_CACHE.get(key)
+    if found:
+        return info
+    ret = run_sql("""SELECT mimetype, hash, size, data IS NULL AND hash IS NOT NULL
+                     FROM qtattach
+                     WHERE qtemplate = %s
+                       AND name = %s
+                       AND version =
+                         (SELECT MAX(version)
+                          FROM qtattach
+                          WHERE qtemplate = %s
+                            AND version <= %s
+                            AND name = %s);""", [qt_id, name, qt_id, version, name])
+    if not ret:
+        return None
+    info = _att_info(ret[0])
+    TEMPLATE_CACHE.set(key, info, 200)
+    return info
+
+
+Q_GET_Q_ATT = query("get_q_att",
+                    """SELECT "qtemplate", "data", "hash"
+                       FROM "qattach"
+                       WHERE "qtemplate" = %s
+                         AND "name" = %s
+                         AND "variation" = %s
+                         AND "version" = %s;""", fetch=True)
+
+
 def get_q_att(qt_id, name, variation, version=1000000000):
     """ Fetch an attachment for the question"""
 
@@ -491,19 +769,32 @@ def get_q_att(qt_id, name, variation, version=1000000000):
         L.warn("Request for unknown qt version. get_qt_att(%s, %s, %s, %s)" % (qt_id, name, variation, version))
         return None
 
-    ret = run_sql("""SELECT "qtemplate", "data"
-                        FROM "qattach"
-                        WHERE "qtemplate" = %s
-                        AND "name" = %s
-                        AND "variation" = %s
-                        AND "version" = %s;""",
-                  [qt_id, name, variation, version])
+    key = (qt_id, name, version, variation)
+    found, data = TEMPLATE_CACHE.get(key)
+    if found:
+        return data
+    ret = run_query(Q_GET_Q_ATT, [qt_id, name, variation, version])
     if ret:
-        data = str(ret[0][1])
+        data = _att_data(ret[0][1], ret[0][2])
+        if data is not None:
+            TEMPLATE_CACHE.set(key, data, len(data))
         return data
     return get_qt_att(qt_id, name, version)
 
 
+Q_GET_QT_ATT = query("get_qt_att",
+                     """SELECT data, hash
+                        FROM qtattach
+                        WHERE qtemplate = %s
+                          AND name = %s
+                          AND version =
+                            (SELECT MAX(version)
+                             FROM qtattach
+                             WHERE qtemplate = %s
+                               AND version <= %s
+                               AND name = %s);""", fetch=True)
+
+
 def get_qt_att(qt_id, name, version=1000000000):
     """ Fetch an attachment for the question template.
         If version is set to 0, will fetch the newest.
@@ -514,20 +805,15 @@ def get_qt_att(qt_id, name, version=1000000000):
     if version == 1000000000:
         version = get_qt_version(qt_id)
 
-    ret = run_sql("""SELECT data
-                     FROM qtattach
-                     WHERE qtemplate = %s
-                       AND name = %s
-                       AND version =
-                         (SELECT MAX(version)
-                          FROM qtattach
-                          WHERE qtemplate = %s
-                            AND version <= %s
-                            AND name = %s);""",
-                  [qt_id, name, qt_id, version, name])
+    key = (qt_id, name, version, None)
+    found, data = TEMPLATE_CACHE.get(key)
+    if found:
+        return data
+    ret = run_query(Q_GET_QT_ATT, [qt_id, name, qt_id, version, name])
     if ret:
-        data = str(ret[0][0])
-
+        data = _att_data(ret[0][0], ret[0][1])
+        if data is not None:
+            TEMPLATE_CACHE.set(key, data, len(data))
         return data
 
     return False
@@ -648,6 +934,18 @@ def get_qt_variations(qt_id, version=1000000000):
     return ret
 
 
+Q_GET_QT_VARIATION = query("get_qt_variation",
+                           """SELECT "data"
+                              FROM qtvariations
+                              WHERE "qtemplate" = %s
+                                AND "variation" = %s
+                                AND "version" =
+                                  (SELECT MAX("version")
+                                   FROM qtvariations
+                                   WHERE "qtemplate" = %s
+                                     AND "version" <= %s);""", fetch=True)
+
+
 def get_qt_variation(qt_id, variation, version=1000000000):
     """ Return a specific variation of a question template."""
     assert isinstance(qt_id, int)
@@ -655,16 +953,11 @@ def get_qt_variation(qt_id, variation, version=1000000000):
     assert isinstance(variation, int)
     if version == 1000000000:
         version = get_qt_version(qt_id)
-    res = run_sql("""SELECT "data"
-                     FROM qtvariations
-                     WHERE "qtemplate" = %s
-                       AND "variation" = %s
-                       AND "version" =
-                         (SELECT MAX("version")
-                          FROM qtvariations
-                          WHERE "qtemplate" = %s
-                            AND "version" <= %s);""",
-                  [qt_id, variation, qt_id, version])
+    key = (qt_id, "qtvariation", version, variation)
+    found, data = TEMPLATE_CACHE.get(key)
+    if found:
+        return copy.deepcopy(data)   # callers add to it
+    res = run_query(Q_GET_QT_VARIATION, [qt_id, variation, qt_id, version])
     if not res:
         L.warn("Request for unknown qt variation. (%s, %s, %s)" %
                (qt_id, variation, version))
@@ -677,7 +970,9 @@ def get_qt_variation(qt_id, variation, version=1000000000):
     except TypeError:
         L.warn("Type error trying to cpickle.loads(%s) for (%s, %s, %s)" %
                (type(result), qt_id, variation, version))
-    return data
+        return data
+    TEMPLATE_CACHE.set(key, data, len(result))
+    return copy.deepcopy(data)
 
 
 def get_qt_num_variations(qt_id, version=1000000000):
@@ -711,11 +1006,16 @@ def create_q_att(qt_id, variation, name, mimetype, data, version):
     if not name and not data:
         L.warn("Refusing to create empty attachment for question %s" % qt_id)
         return
-    safe_data = psycopg2.Binary(data)
+    TEMPLATE_CACHE.delete((qt_id, name, version, variation))
+    TEMPLATE_CACHE.delete((qt_id, name, version, variation, "info"))
+    if isinstance(data, unicode):
+        data = data.encode("utf8")
+    digest = hashlib.md5(data).hexdigest()
     run_sql("""INSERT INTO "qattach"
-                   (qtemplate, variation, mimetype, name, data, version)
-               VALUES (%s, %s, %s, %s, %s, %s);""",
-            [qt_id, variation, mimetype, name, safe_data, version])
+                   (qtemplate, variation, mimetype, name, data, version, hash, size)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""",
+            [qt_id, variation, mimetype, name, _att_column(data, digest), version,
+             digest, len(data)])
     return None
 
 
@@ -726,20 +1026,56 @@ def create_qt_att(qt_id, name, mime_type, data, version):
     assert isinstance(mime_type, str) or isinstance(mime_type, unicode)
     assert isinstance(data, str) or isinstance(data, unicode)
     assert isinstance(version, int)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
-    MC.delete(key)
+    TEMPLATE_CACHE.delete((qt_id, name, version, None))
+    TEMPLATE_CACHE.delete((qt_id, name, version, None, "info"))
     if not data:
         data = ""
     L.info("QT Attachment upload '%s' '%s' %s bytes" % (name, mime_type, len(data)))
     if isinstance(data, unicode):
         data = data.encode("utf8")
-    safe_data = psycopg2.Binary(data)
-    run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, data, version)
-               VALUES (%s, %s, %s, %s, %s);""",
-            [qt_id, mime_type, name, safe_data, version])
+    digest = hashlib.md5(data).hexdigest()
+    run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, data, version, hash, size)
+               VALUES (%s, %s, %s, %s, %s, %s, %s);""",
+            [qt_id, mime_type, name, _att_column(data, digest), version,
+             digest, len(data)])
     return None
 
 
+def move_atts_to_store(batch=20, verbose=False):
+    """ Move attachment data out of the database into the AttachStore,
+        a few rows at a time. Returns the number of rows moved. Safe to run
+        while OASIS is in use, and to run again if it's interrupted.
+    """
+    if not AttachStore.STORE:
+        raise IOError("attachment_dir isn't set, nowhere to move attachments to.")
+    moved = 0
+    for table in ("qattach", "qtattach"):
+        last = 0
+        while True:
+            ret = run_sql("""SELECT "%s", data
+                             FROM %s
+                             WHERE "%s" > %%s
+                               AND data IS NOT NULL
+                             ORDER BY "%s"
+                             LIMIT %%s;""" % (table, table, table, table),
+                          [last, batch])
+            if not ret:
+                break
+            for row_id, data in ret:
+                last = row_id
+                data = str(data)
+                digest = hashlib.md5(data).hexdigest()
+                if not AttachStore.STORE.put(digest, data):
+                    continue
+                run_sql("""UPDATE %s SET data = NULL, hash = %%s, size = %%s
+                           WHERE "%s" = %%s;""" % (table, table),
+                        [digest, len(data), row_id])
+                moved += 1
+            if verbose:
+                print "%s: moved %s attachments" % (table, moved)
+    return moved
+
+
 def create_q(qt_id, name, student, status, variation, version, exam):
     """ Add a question (instance) to the database."""
     assert isinstance(qt_id, int)
@@ -759,6 +1095,37 @@ def create_q(qt_id, name, student, status, variation, version, exam):
     return res[0][0]
 
 
+def create_qs(questions):
+    """ Add a batch of questions (instances) to the database using multi-row
+        INSERTs. Takes a list of
+          (qt_id, name, student, status, variation, version, exam)
+        tuples and returns a list of the new question IDs in the same order.
+    """
+    assert isinstance(questions, list)
+    q_ids = []
+    for start in range(0, len(questions), BATCH_SIZE):
+        chunk = questions[start:start + BATCH_SIZE]
+        params = []
+        for row in chunk:
+            assert len(row) == 7
+            params.extend(row)
+        values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(chunk))
+        res = run_sql("""INSERT INTO questions (qtemplate, name, student, status, variation, version, exam)
+                         VALUES %s
+                         RETURNING question, qtemplate, student, variation;""" % values,
+                      params)
+        if not res or len(res) != len(chunk):
+            L.error("create_qs(%d questions) may have failed." % len(chunk))
+            return None
+        # Don't rely on RETURNING order, match them up by template/student/variation
+        created = {}
+        for row in res:
+            created.setdefault((int(row[1]), int(row[2]), int(row[3])), []).append(int(row[0]))
+        for row in chunk:
+            q_ids.append(created[(row[0], row[2], row[4])].pop(0))
+    return q_ids
+
+
 def update_qt_title(qt_id, title):
     """ Update the title of a question template. """
     assert isinstance(qt_id, int)
@@ -812,6 +1179,7 @@ def update_exam_qt_in_pos(exam_id, position, qts):
     assert isinstance(exam_id, int)
     assert isinstance(position, int)
     assert isinstance(qts, list)
+    MC.delete("exam-%s-gradebook" % exam_id)
     # First remove the current set
     run_sql("DELETE FROM examqtemplates "
             "WHERE exam = %s "
@@ -882,14 +1250,16 @@ def copy_qt_all(qt_id):
     newid = _copy_qt(qt_id)
     if newid <= 0:
         return 0
-    attachments = get_qt_atts(qt_id)
     newversion = get_qt_version(newid)
-    for name in attachments:
-        create_qt_att(newid,
-                      name,
-                      get_qt_att_mimetype(qt_id, name),
-                      get_qt_att(qt_id, name),
-                      newversion)
+    # Straight across, so attachments in the AttachStore are shared rather
+    # than copied.
+    run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, data, version, hash, size)
+               SELECT DISTINCT ON (name) %s, mimetype, name, data, %s, hash, size
+               FROM qtattach
+               WHERE qtemplate = %s
+                 AND version <= %s
+               ORDER BY name, version DESC, qtattach DESC;""",
+            [newid, newversion, qt_id, get_qt_version(qt_id)])
     try:
         variations = get_qt_variations(qt_id)
         for variation in variations.keys():
@@ -932,6 +1302,7 @@ def add_qt_variation(qt_id, variation, data, version):
     assert isinstance(qt_id, int)
     assert isinstance(variation, int)
     assert isinstance(version, int)
+    TEMPLATE_CACHE.delete((qt_id, "qtvariation", version, variation))
     pick = cPickle.dumps(data)
     safe_data = psycopg2.Binary(pick)
     run_sql("INSERT INTO qtvariations (qtemplate, variation, data, version) "
@@ -1062,6 +1433,72 @@ def add_exam_q(user, exam, question, position):
     touch_user_exam(exam, user)
 
 
+def add_exam_qs(assignments):
+    """ Record a batch of exam question assignments using multi-row INSERTs.
+        Takes a list of (user, exam, question, position) tuples.
+        Doesn't check for existing assignments, the caller should.
+    """
+    assert isinstance(assignments, list)
+    for start in range(0, len(assignments), BATCH_SIZE):
+        chunk = assignments[start:start + BATCH_SIZE]
+        params = []
+        for (user, exam, question, position) in chunk:
+            params.extend([exam, user, position, question])
+        values = ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+        run_sql("INSERT INTO examquestions (exam, student, position, question) "
+                "VALUES %s;" % values, params)
+
+
+def get_exam_assigned(exam_id):
+    """ Return a set of (student, position) that already have a question
+        assigned in the exam.
+    """
+    assert isinstance(exam_id, int)
+    ret = run_sql("""SELECT student, position
+                     FROM examquestions
+                     WHERE exam = %s;""", [exam_id, ])
+    if not ret:
+        return set()
+    return set([(int(row[0]), int(row[1])) for row in ret])
+
+
+def get_exam_q_info_by_pos_student(exam, position, student):
+    # type: (int, int, int) -> (int, datetime.datetime or None) or None
+    """ Return (question, firstview) for the question at the given position
+        in the exam for the student, or None if there isn't one assigned yet.
+    """
+    assert isinstance(exam, int)
+    assert isinstance(position, int)
+    assert isinstance(student, int)
+    ret = run_sql("""SELECT eq.question, q.firstview
+                     FROM examquestions AS eq
+                     LEFT JOIN questions AS q ON q.question = eq.question
+                     WHERE eq.student = %s
+                       AND eq.position = %s
+                       AND eq.exam = %s;""",
+                  [student, position, exam])
+    if ret:
+        return int(ret[0][0]), ret[0][1]
+    return None
+
+
+def get_q_atts_generated(qt_id, version):
+    """ Return a set of (variation, name) for the image.gif and qtemplate.html
+        attachments that have already been generated for the template version.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    ret = run_sql("""SELECT variation, name
+                     FROM qattach
+                     WHERE qtemplate = %s
+                       AND version = %s
+                       AND name IN ('image.gif', 'qtemplate.html');""",
+                  [qt_id, version])
+    if not ret:
+        return set()
+    return set([(int(row[0]), row[1]) for row in ret])
+
+
 def get_student_q_practice_num(user_id, qt_id):
     """Return the number of times the given student has practiced the question
        Exclude assessed scores.
@@ -1100,27 +1537,6 @@ def secs_to_human(seconds):
     return "%d days ago" % int(seconds / 86400)
 
 
-def get_prac_stats_user_qt(user_id, qt_id):
-    """ Return Data on the scores of individual practices. it is used to
-        display Individual Practise Data section
-        Restricted by a certain time period which is 30 secs to 2 hours"""
-    assert isinstance(user_id, int)
-    assert isinstance(qt_id, int)
-    sql = """SELECT COUNT(question),MAX(score),MIN(score),AVG(score)
-             FROM questions WHERE qtemplate = %s AND student = %s;"""
-    params = [qt_id, user_id]
-    ret = run_sql(sql, params)
-    if ret:
-        i = ret[0]
-        if i[0]:
-            stats = {'num': int(i[0]),
-                     'max': float(i[1]),
-                     'min': float(i[2]),
-                     'avg': float(i[3])}
-            return stats
-    return None
-
-
 def get_student_q_practice_stats(user_id, qt_id, num=3):
     """Return data on the scores obtained while practicing the given question
        the last 'num' times. Exclude assessed scores. If num is not provided,
@@ -1149,69 +1565,65 @@ def get_student_q_practice_stats(user_id, qt_id, num=3):
         sql += " LIMIT '%d'" % num
     sql += ";"
     ret = run_sql(sql, params)
-    stats = []
     if ret:
-        for row in ret:
-            ageseconds = 10000000000  # could be from before we tracked it.
-            age = row[2]
-            try:
-                age = int(age)
-                ageseconds = age
-                if age > 63000000:    # more than two years
-                    age = "more than 2 years"
-                else:
-                    age = secs_to_human(age)
-            except (TypeError, ValueError):
-                age = "more than 2 years"
-            stats.append({
-                'score': float(row[0]),
-                'question': int(row[1]),
-                'age': age,
-                'ageseconds': ageseconds
-            })
-
+        stats = [_practice_attempt(row) for row in ret]
         return stats[::-1]   # reverse it so they're in time order
     return None
 
 
-def get_q_stats_class(course, qt_id):
-    """Fetch a bunch of statistics about the given question for the class
+def get_student_qts_practice_stats(user_id, qt_ids, num=3):
+    """ As get_student_q_practice_stats, for several question templates with
+        one query. Returns {qt_id: list of last 'num' practices}, leaving out
+        those with none.
     """
-    assert isinstance(course, int)
-    assert isinstance(qt_id, int)
-    sql = """SELECT COUNT(question),
-                    AVG(score),
-                    STDDEV(score),
-                    MAX(score),
-                    MIN(score)
-             FROM questions
-             WHERE qtemplate = %s
-             AND marktime < NOW()
-             AND (marktime - firstview) > '00:00:20'
-             AND (marktime - firstview) < '02:00:01'
-             AND student IN
-                (SELECT userid FROM usergroups WHERE groupid IN
-                  (SELECT groupid FROM groupcourses WHERE course = %s)
-             );
-          """
-    params = [qt_id, course]
-    ret = run_sql(sql, params)
-    if ret:
-        i = ret[0]
-        if i[1]:
-            if i[2]:
-                stats = {'count': int(i[0]),
-                         'avg': float(i[1]),
-                         'stddev': float(i[2]),
-                         'max': float(i[3]),
-                         'min': float(i[4])}
-            else:   # empty stddev from e.g. only 1 count
-                stats = {'count': int(i[0]),
-                         'avg': float(i[1]),
-                         'stddev': 0.0,
-                         'max': float(i[3]),
-                         'min': float(i[4])}
-            return stats
+    assert isinstance(user_id, int)
+    assert isinstance(num, int)
+    if not qt_ids:
+        return {}
+    ret = run_sql("""SELECT qtemplate, score, question, age
+                     FROM (SELECT qtemplate, score, question, marktime,
+                                  EXTRACT(epoch FROM (NOW() - marktime)) AS age,
+                                  row_number() OVER (PARTITION BY qtemplate
+                                                     ORDER BY marktime DESC) AS num
+                           FROM questions
+                           WHERE qtemplate = ANY(%s)
+                               AND student=%s
+                               AND status > 1
+                               AND exam < 1
+                               AND marktime > '2005-07-16 00:00:00.00'
+                               AND (marktime - firstview) > '00:00:20.00'
+                               AND (marktime - firstview) < '02:00:01.00'
+                          ) AS recent
+                     WHERE num <= %s OR %s = 0
+                     ORDER BY qtemplate, marktime ASC;""",
+                  [list(qt_ids), user_id, num, num])
+    stats = {}
+    for row in ret or []:
+        stats.setdefault(int(row[0]), []).append(_practice_attempt(row[1:]))
+    return stats
+
+
+def _practice_attempt(row):
+    """ Turn (score, question, age in seconds) into a dict for the
+        practice stats.
+    """
+    ageseconds = 10000000000  # could be from before we tracked it.
+    age = row[2]
+    try:
+        age = int(age)
+        ageseconds = age
+        if age > 63000000:    # more than two years
+            age = "more than 2 years"
+        else:
+            age = secs_to_human(age)
+    except (TypeError, ValueError):
+        age = "more than 2 years"
+    return {
+        'score': float(row[0]),
+        'question': int(row[1]),
+        'age': age,
+        'ageseconds': ageseconds
+    }
 
 
 def set_message(name, message):
@@ -1245,6 +1657,19 @@ def get_message(name):
     return ret[0][0]
 
 
+def touch_user_exams(exam_id, user_ids):
+    """ Update the lastchange field on several user exams at once.
+        See touch_user_exam.
+    """
+    assert isinstance(exam_id, int)
+    assert isinstance(user_ids, list)
+    if not user_ids:
+        return
+    sql = "UPDATE userexams SET lastchange=NOW() WHERE exam=%s AND student = ANY(%s);"
+    params = [exam_id, user_ids]
+    run_sql(sql, params)
+
+
 def touch_user_exam(exam_id, user_id):
     """ Update the lastchange field on a user exam so other places can tell that
         something changed. This should probably be done any time one of the
@@ -1498,6 +1923,66 @@ def clean_install_3_9_7():
     print "Installed v3.9.7 table structure."
 
 
+def clean_install_3_9_8():
+    """ Install a fresh blank v3.9.8 schema.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "emptyschema_398.sql")) as f:
+        sql = f.read()
+
+    run_sql(sql)
+    print "Installed v3.9.8 table structure."
+
+
+def clean_install_3_9_9():
+    """ Install a fresh blank v3.9.9 schema.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "emptyschema_399.sql")) as f:
+        sql = f.read()
+
+    run_sql(sql)
+    print "Installed v3.9.9 table structure."
+
+
+def clean_install_3_9_10():
+    """ Install a fresh blank v3.9.10 schema.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "emptyschema_3910.sql")) as f:
+        sql = f.read()
+
+    run_sql(sql)
+    print "Installed v3.9.10 table structure."
+
+
+def clean_install_3_9_11():
+    """ Install a fresh blank v3.9.11 schema.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "emptyschema_3911.sql")) as f:
+        sql = f.read()
+
+    run_sql(sql)
+    print "Installed v3.9.11 table structure."
+
+
+def clean_install_3_9_12():
+    """ Install a fresh blank v3.9.12 schema.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "emptyschema_3912.sql")) as f:
+        sql = f.read()
+
+    run_sql(sql)
+    print "Installed v3.9.12 table structure."
+
+
+def clean_install_3_9_13():
+    """ Install a fresh blank v3.9.13 schema.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "emptyschema_3913.sql")) as f:
+        sql = f.read()
+
+    run_sql(sql)
+    print "Installed v3.9.13 table structure."
+
+
 def upgrade_3_6_to_3_9_5(options):
     """ Given a 3.6 database, upgrade it to 3.9.3
     """
@@ -1608,6 +2093,60 @@ def upgrade_3_9_6_to_3_9_7(_):
     print "Migrated table structure from 3.9.6 to 3.9.7"
 
 
+def upgrade_3_9_7_to_3_9_8(_):
+    """ Given a 3.9.7 database, upgrade it to 3.9.8.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "migrate_397_to_398.sql")) as f:
+        sql = f.read()
+    run_sql(sql)
+    print "Migrated table structure from 3.9.7 to 3.9.8"
+
+
+def upgrade_3_9_8_to_3_9_9(_):
+    """ Given a 3.9.8 database, upgrade it to 3.9.9.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "migrate_398_to_399.sql")) as f:
+        sql = f.read()
+    run_sql(sql)
+    print "Migrated table structure from 3.9.8 to 3.9.9"
+
+
+def upgrade_3_9_9_to_3_9_10(_):
+    """ Given a 3.9.9 database, upgrade it to 3.9.10.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "migrate_399_to_3910.sql")) as f:
+        sql = f.read()
+    run_sql(sql)
+    print "Migrated table structure from 3.9.9 to 3.9.10"
+
+
+def upgrade_3_9_10_to_3_9_11(_):
+    """ Given a 3.9.10 database, upgrade it to 3.9.11.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "migrate_3910_to_3911.sql")) as f:
+        sql = f.read()
+    run_sql(sql)
+    print "Migrated table structure from 3.9.10 to 3.9.11"
+
+
+def upgrade_3_9_11_to_3_9_12(_):
+    """ Given a 3.9.11 database, upgrade it to 3.9.12.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "migrate_3911_to_3912.sql")) as f:
+        sql = f.read()
+    run_sql(sql)
+    print "Migrated table structure from 3.9.11 to 3.9.12"
+
+
+def upgrade_3_9_12_to_3_9_13(_):
+    """ Given a 3.9.12 database, upgrade it to 3.9.13.
+    """
+    with open(os.path.join(OaConfig.homedir, "sql", "migrate_3912_to_3913.sql")) as f:
+        sql = f.read()
+    run_sql(sql)
+    print "Migrated table structure from 3.9.12 to 3.9.13"
+
+
 def do_upgrade(options):
     """ Upgrade the database from an older version of OASIS.
     """
@@ -1617,26 +2156,56 @@ def do_upgrade(options):
         upgrade_3_6_to_3_9_5(options)
         upgrade_3_9_5_to_3_9_6(options)
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.1":
         upgrade_3_9_1_to_3_9_5(options)
         upgrade_3_9_5_to_3_9_6(options)
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.2":
         upgrade_3_9_2_to_3_9_5(options)
         upgrade_3_9_5_to_3_9_6(options)
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.3":
         upgrade_3_9_3_to_3_9_5(options)
         upgrade_3_9_5_to_3_9_6(options)
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.4":
         upgrade_3_9_4_to_3_9_5(options)
         upgrade_3_9_5_to_3_9_6(options)
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.5":
         do_repair()
@@ -1644,13 +2213,58 @@ def do_upgrade(options):
     if dbver == "3.9.5":
         upgrade_3_9_5_to_3_9_6(options)
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.6":
         do_repair()
         upgrade_3_9_6_to_3_9_7(options)
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
         return
     if dbver == "3.9.7":
-        print "Your database is already the latest version (3.9.7)"
+        upgrade_3_9_7_to_3_9_8(options)
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
+        return
+    if dbver == "3.9.8":
+        upgrade_3_9_8_to_3_9_9(options)
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
+        return
+    if dbver == "3.9.9":
+        upgrade_3_9_9_to_3_9_10(options)
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
+        return
+    if dbver == "3.9.10":
+        upgrade_3_9_10_to_3_9_11(options)
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
+        return
+    if dbver == "3.9.11":
+        upgrade_3_9_11_to_3_9_12(options)
+        upgrade_3_9_12_to_3_9_13(options)
+        return
+    if dbver == "3.9.12":
+        upgrade_3_9_12_to_3_9_13(options)
+        return
+    if dbver == "3.9.13":
+        print "Your database is already the latest version (3.9.13)"
     return
 
 
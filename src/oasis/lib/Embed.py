@@ -18,7 +18,7 @@
 import re
 
 from oasis.lib.OaExceptions import OaMarkerError
-from oasis.lib import DB, General
+from oasis.lib import DB, General, Questions
 
 from logging import getLogger
 
@@ -36,6 +36,7 @@ def mark_q(user_id, qtid, request):
 
     out = u""
     answers = {}
+    guesses = []
     for i in request.form.keys():
         part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
         if part:
@@ -44,11 +45,13 @@ def mark_q(user_id, qtid, request):
 
             value = request.form[i]
             answers["G%d" % part] = value
-            DB.save_guess(newqid, part, value)
+            guesses.append((newqid, part, value))
+    DB.save_guesses(guesses)
 
     if qid:
+        qctx = Questions.get_context(qid)
         try:
-            marks = General.mark_q(qid, answers)
+            marks = General.mark_q(qctx, answers)
             DB.set_q_status(qid, 3)    # 3 = marked
             DB.set_q_marktime(qid)
         except OaMarkerError:
@@ -56,7 +59,7 @@ def mark_q(user_id, qtid, request):
                    (user_id, qtid, request.form))
             marks = {}
 
-        out += General.render_mark_results(qid, marks)
+        out += General.render_mark_results(qctx, marks)
         parts = [int(var[1:])
                  for var in marks.keys()
                  if re.search("^A([0-9]+)$", var) > 0]
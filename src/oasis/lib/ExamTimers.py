@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" ExamTimers.py
+    Submit timed assessments that have run out of time.
+
+    The assessment page submits when the timer runs out, but only if the
+    student's browser is still there to do it. The Sweeper keeps the end
+    times of every started attempt in a heap, so it only has to look at the
+    front to find the next one due, and submits each one GRACE seconds after
+    it ends. scripts/run_marker runs one (with --timers-only if it's not
+    also marking), and run_hourly catches up on any it missed.
+"""
+
+import heapq
+import time
+
+from oasis.lib.DB import run_sql
+from oasis.lib import Exams, Audit
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+# Seconds after the end of the timer that an attempt is submitted, to allow
+# for the page submitting itself and clocks being a little out.
+GRACE = 30
+
+# How often to look for newly started attempts, in seconds.
+RELOAD_INTERVAL = 60
+
+# Attempts that ran out longer ago than this (seconds) are left alone. They
+# were abandoned before the sweeper was running.
+MAX_AGE = 24 * 60 * 60
+
+# userexams status for attempts that are started, or out of time
+ACTIVE_STATUS = (2, 3)
+
+
+def get_running(since):
+    """ Return [(endtime, exam_id, user_id), ...] for the started attempts at
+        timed assessments whose timers end after since (epoch seconds).
+    """
+    ret = run_sql("""SELECT t.endtime, t.exam, t.userid
+                     FROM examtimers AS t
+                     JOIN userexams AS u ON u.exam = t.exam AND u.student = t.userid
+                     JOIN exams AS e ON e.exam = t.exam
+                     WHERE u.status IN (%s, %s)
+                       AND e.duration > 0
+                       AND t.endtime > %s;""",
+                  [ACTIVE_STATUS[0], ACTIVE_STATUS[1], since])
+    if not ret:
+        return []
+    return [(float(row[0]), int(row[1]), int(row[2])) for row in ret]
+
+
+def submit_expired(exam_id, user_id):
+    """ Submit the attempt if it's still going and really has run out of
+        time. Returns True if it was submitted.
+    """
+    from oasis.lib import Assess
+
+    if Exams.get_user_status(user_id, exam_id) not in ACTIVE_STATUS:
+        return False
+    endtime = Exams.get_end_time(exam_id, user_id, fresh=True)
+    if endtime + GRACE > time.time():
+        return False
+    L.info("Assessment %s for user %s ran out of time, submitting." % (exam_id, user_id))
+    Audit.audit(3, user_id, user_id, "ExamTimers",
+                "Assessment %s ran out of time, submitted automatically." % exam_id)
+    if not Assess.mark_exam(user_id, exam_id):
+        L.warn("Problem marking assessment %s for user %s after it ran out of time." %
+               (exam_id, user_id))
+    return True
+
+
+class Sweeper(object):
+    """ Keeps the end times of running attempts in a heap and submits them
+        as they run out.
+    """
+
+    def __init__(self):
+        self.heap = []      # (endtime, exam_id, user_id)
+        self.known = {}     # (exam_id, user_id): endtime
+        self.last_load = 0
+
+    def load(self):
+        """ Add any attempts started since we last looked. Timers that
+            were reset and started again go in with their new end time.
+        """
+        for endtime, exam_id, user_id in get_running(time.time() - MAX_AGE):
+            if self.known.get((exam_id, user_id)) != endtime:
+                self.known[(exam_id, user_id)] = endtime
+                heapq.heappush(self.heap, (endtime, exam_id, user_id))
+        self.last_load = time.time()
+
+    def sweep(self):
+        """ Submit everything that's due. Returns how many were submitted. """
+        done = 0
+        now = time.time()
+        while self.heap and self.heap[0][0] + GRACE <= now:
+            endtime, exam_id, user_id = heapq.heappop(self.heap)
+            if self.known.get((exam_id, user_id)) != endtime:
+                continue  # reset since, it's in again with the new time
+            del self.known[(exam_id, user_id)]
+            try:
+                if submit_expired(exam_id, user_id):
+                    done += 1
+            except Exception as err:
+                L.error("Unable to submit assessment %s for user %s: %s" %
+                        (exam_id, user_id, err))
+        return done
+
+    def run(self, stop=None, poll=1.0):
+        """ Keep submitting attempts as they run out, until stop() is true. """
+        while not (stop and stop()):
+            if time.time() - self.last_load >= RELOAD_INTERVAL:
+                self.load()
+            self.sweep()
+            time.sleep(poll)
+
+
+def sweep_once():
+    """ Submit any running attempts that have run out of time, eg. from
+        run_hourly. Returns how many were submitted.
+    """
+    sweeper = Sweeper()
+    sweeper.load()
+    return sweeper.sweep()
@@ -9,6 +9,7 @@
 
 import time
 import json
+import random
 import datetime
 
 from .DB import run_sql, MC
@@ -17,10 +18,19 @@ from .Permissions import check_perm
 import DB
 import General
 import Courses
+import Cache
 from logging import getLogger
 
 L = getLogger("oasisqe")
 
+# A student's assessment timer only changes when it's reset, so we keep the
+# end times in memcache and for a little while in each process, rather than
+# looking them up on every page and autosave. A process that didn't do the
+# reset can have the old one for TIMER_LOCAL_TTL seconds, so check with
+# get_end_time(.., fresh=True) before acting on an expired timer.
+TIMER_LOCAL_TTL = 10
+TIMER_CACHE = Cache.LRUCache(1024 * 1024, ttl=TIMER_LOCAL_TTL)
+
 
 def save_score(exam_id, student, examtotal):
     """ Store the exam score.
@@ -34,6 +44,7 @@ def save_score(exam_id, student, examtotal):
                  VALUES (NOW(), %s, %s, 1, 'Submitted', %s);""",
             [exam_id, student, "%.1f" % examtotal])
     touchuserexam(exam_id, student)
+    MC.delete("exam-%s-gradebook" % exam_id)
 
 
 def set_duration(exam_id, duration):
@@ -226,20 +237,36 @@ def set_description(exam_id, description):
             [description, exam_id])
 
 
-def get_end_time(exam, user):
-    """ Return the time that an exam ends for the given user. """
+def get_end_time(exam, user, fresh=False):
+    """ Return the time that an exam ends for the given user, starting
+        their timer if it hasn't been.
+        If fresh is True, skip the cache.
+    """
     assert isinstance(exam, int)
     assert isinstance(user, int)
+    key = "examtimer-%s-%s" % (exam, user)
+    if not fresh:
+        found, endtime = TIMER_CACHE.get(key)
+        if found:
+            return endtime
+        obj = MC.get(key)
+        if obj:
+            endtime = float(obj)
+            TIMER_CACHE.set(key, endtime, 64)
+            return endtime
     ret = run_sql("""SELECT endtime FROM examtimers WHERE exam = %s AND userid = %s;""", [exam, user])
     if ret:
-        return float(ret[0][0])
-    ret = run_sql("SELECT duration FROM exams where exam = %s;", [exam, ])
-    duration = int(ret[0][0])
-    nowtime = time.time()
-    endtime = nowtime + (duration * 60)
-    run_sql("""INSERT INTO examtimers (userid, exam, endtime)
-               VALUES (%s, %s, %s)""", [user, exam, endtime])
-    return float(endtime)
+        endtime = float(ret[0][0])
+    else:
+        ret = run_sql("SELECT duration FROM exams where exam = %s;", [exam, ])
+        duration = int(ret[0][0])
+        nowtime = time.time()
+        endtime = float(nowtime + (duration * 60))
+        run_sql("""INSERT INTO examtimers (userid, exam, endtime)
+                   VALUES (%s, %s, %s)""", [user, exam, endtime])
+    MC.set(key, repr(endtime))
+    TIMER_CACHE.set(key, endtime, 64)
+    return endtime
 
 
 def set_end_time(exam, examend):
@@ -270,10 +297,24 @@ def get_num_questions(exam_id):
     return 0
 
 
+# Questions are generated before an assessment opens (pregenerate_instances),
+# with the student's userexams status left at 1 (unseen). Anything reporting
+# who has done an assessment should leave those out, with this condition on
+# questions (or examquestions) AS q.
+NOT_UNSEEN = """NOT EXISTS (SELECT 1 FROM userexams AS ue
+                            WHERE ue.exam = q.exam
+                              AND ue.student = q.student
+                              AND ue.status < 2)"""
+
+
 def get_exams_done(user):
     """ Return a list of assessments done by the user."""
     assert isinstance(user, int)
-    ret = run_sql("SELECT exam FROM examquestions WHERE student = %s GROUP BY exam", [user, ])
+    ret = run_sql("""SELECT q.exam
+                     FROM examquestions AS q
+                     WHERE q.student = %%s
+                       AND %s
+                     GROUP BY q.exam;""" % NOT_UNSEEN, [user, ])
     if not ret:
         return []
     exams = [int(row[0]) for row in ret]
@@ -293,12 +334,14 @@ def set_submit_time(student, exam, submittime=None):
     touchuserexam(exam, student)
 
 
-# FIXME: watch for memcache issues.
 def reset_end_time(exam, user):
     """ Reset the Exam timer for the student. This should let them resit the exam. """
     assert isinstance(exam, int)
     assert isinstance(user, int)
     run_sql("DELETE FROM examtimers WHERE exam = %s AND userid = %s;", [exam, user])
+    key = "examtimer-%s-%s" % (exam, user)
+    MC.delete(key)
+    TIMER_CACHE.delete(key)
     L.info("Exam %s timer reset for user %s" % (exam, user))
     touchuserexam(exam, user)
 
@@ -446,6 +489,43 @@ def _deserialize_examstruct(obj):
     return exam
 
 
+def _examstruct_from_row(row):
+    """ The cacheable part of the exam structure, from an exams row
+        (exam, title, owner, type, start, end, description, comments,
+         course, archived, duration, markstatus, instant, code)
+    """
+    return {'id': int(row[0]),
+            'title': row[1],
+            'owner': row[2],
+            'type': row[3],
+            'start': row[4],
+            'end': row[5],
+            'instructions': row[6],
+            'comments': row[7],
+            'cid': row[8],
+            'archived': row[9],
+            'duration': row[10],
+            'markstatus': row[11],
+            'instant': row[12],
+            'code': row[13]
+            }
+
+
+def _add_exam_times(exam, course):
+    """ Fill in the parts of the exam structure that depend on the current
+        time, and the course.
+    """
+    exam['future'] = General.is_future(exam['start'])
+    exam['past'] = General.is_past(exam['end'])
+    exam['soon'] = General.is_soon(exam['start'])
+    exam['recent'] = General.is_recent(exam['end'])
+    exam['active'] = General.is_now(exam['start'], exam['end'])
+    exam['start_epoch'] = int(exam['start'].strftime("%s"))  # used to sort
+    exam['period'] = General.human_dates(exam['start'], exam['end'])
+    exam['course'] = course
+    exam['start_human'] = exam['start'].strftime("%a %d %b")
+
+
 # TODO: Optimize. This is called quite a lot
 def get_exam_struct(exam_id, user_id=None, include_qtemplates=False,
                     include_stats=False):
@@ -462,7 +542,7 @@ def get_exam_struct(exam_id, user_id=None, include_qtemplates=False,
     if obj:
         exam = _deserialize_examstruct(obj)
     else:
-        sql = """SELECT "title", "owner", "type", "start", "end",
+        sql = """SELECT "exam", "title", "owner", "type", "start", "end",
                         "description", "comments", "course", "archived",
                         "duration", "markstatus", "instant", "code"
                  FROM "exams" WHERE "exam" = %s LIMIT 1;"""
@@ -470,35 +550,11 @@ def get_exam_struct(exam_id, user_id=None, include_qtemplates=False,
         ret = run_sql(sql, params)
         if not ret:
             raise KeyError("Exam %s not found." % exam_id)
-        row = ret[0]
-        exam = {'id': exam_id,
-                'title': row[0],
-                'owner': row[1],
-                'type': row[2],
-                'start': row[3],
-                'end': row[4],
-                'instructions': row[5],
-                'comments': row[6],
-                'cid': row[7],
-                'archived': row[8],
-                'duration': row[9],
-                'markstatus': row[10],
-                'instant': row[11],
-                'code': row[12]
-                }
+        exam = _examstruct_from_row(ret[0])
 
         MC.set(key, _serialize_examstruct(exam),
                60)  # 60 second cache. to take the edge off exam start peak load
-    course = Courses.get_course(exam['cid'])
-    exam['future'] = General.is_future(exam['start'])
-    exam['past'] = General.is_past(exam['end'])
-    exam['soon'] = General.is_soon(exam['start'])
-    exam['recent'] = General.is_recent(exam['end'])
-    exam['active'] = General.is_now(exam['start'], exam['end'])
-    exam['start_epoch'] = int(exam['start'].strftime("%s"))  # used to sort
-    exam['period'] = General.human_dates(exam['start'], exam['end'])
-    exam['course'] = course
-    exam['start_human'] = exam['start'].strftime("%a %d %b")
+    _add_exam_times(exam, Courses.get_course(exam['cid']))
 
     if include_qtemplates:
         exam['qtemplates'] = get_qts(exam_id)
@@ -513,6 +569,70 @@ def get_exam_struct(exam_id, user_id=None, include_qtemplates=False,
     return exam
 
 
+def get_exam_structs(exam_ids, user_id=None):
+    """ Return a list of exam structures, as from get_exam_struct(), for the
+        given exams in the same order. Exams that can't be found are left out.
+
+        For listing pages: the cached structures are fetched with one
+        memcache request and any missing with one query, and the user and
+        course information is looked up once rather than per exam.
+    """
+    assert isinstance(user_id, int) \
+        or user_id is None
+    exam_ids = [int(exam_id) for exam_id in exam_ids]
+    if not exam_ids:
+        return []
+    keys = dict([("exam-%s-struct" % exam_id, exam_id) for exam_id in exam_ids])
+    exams = {}
+    for key, obj in MC.get_multi(keys.keys()).iteritems():
+        if obj:
+            exams[keys[key]] = _deserialize_examstruct(obj)
+
+    missing = [exam_id for exam_id in set(exam_ids) if exam_id not in exams]
+    if missing:
+        sql = """SELECT "exam", "title", "owner", "type", "start", "end",
+                        "description", "comments", "course", "archived",
+                        "duration", "markstatus", "instant", "code"
+                 FROM "exams" WHERE "exam" = ANY(%s);"""
+        ret = run_sql(sql, [missing, ])
+        tocache = {}
+        if ret:
+            for row in ret:
+                exam = _examstruct_from_row(row)
+                exams[exam['id']] = exam
+                tocache["exam-%s-struct" % exam['id']] = _serialize_examstruct(exam)
+        if tocache:
+            MC.set_multi(tocache, 60)
+
+    done = set()
+    if user_id and exams:
+        ret = run_sql("""SELECT DISTINCT exam FROM marklog
+                         WHERE student = %s AND exam = ANY(%s);""",
+                      [user_id, exams.keys()])
+        if ret:
+            done = set([int(row[0]) for row in ret])
+
+    courses = {}
+    can_preview = {}
+    structs = []
+    for exam_id in exam_ids:
+        if exam_id not in exams:
+            L.warn("Exam %s not found." % exam_id)
+            continue
+        exam = exams[exam_id].copy()
+        cid = exam['cid']
+        if cid not in courses:
+            courses[cid] = Courses.get_course(cid)
+        _add_exam_times(exam, courses[cid])
+        if user_id:
+            if cid not in can_preview:
+                can_preview[cid] = check_perm(user_id, cid, "exampreview")
+            exam['is_done'] = exam_id in done
+            exam['can_preview'] = can_preview[cid]
+        structs.append(exam)
+    return structs
+
+
 def get_marks(group, exam_id):
     """ Fetch the marks for a given user group.
     """
@@ -524,8 +644,9 @@ def get_marks(group, exam_id):
         WHERE u.id = ug.userid
           AND ug.groupid = %s
           AND u.id = q.student
-          AND q.exam = %s;
-    """
+          AND q.exam = %%s
+          AND %s;
+    """ % NOT_UNSEEN
     params = [group.id, exam_id]
     ret = DB.run_sql(sql, params)
     results = {}
@@ -541,3 +662,139 @@ def get_marks(group, exam_id):
         }
 
     return results
+
+
+def get_group_results(group, exam_id):
+    """ Fetch the results of the assessment for the members of the group,
+        along with their user details, in one query.
+        Returns a list sorted by family name, of
+            {'id', 'uname', 'student_id', 'familyname', 'givenname', 'email',
+             'scores': {qtemplate: score}}
+    """
+    assert isinstance(exam_id, int)
+    ret = run_sql("""SELECT u.id, u.uname, u.student_id, u.familyname,
+                            u.givenname, u.email, q.qtemplate, q.score
+                     FROM usergroups AS ug
+                     JOIN users AS u ON u.id = ug.userid
+                     JOIN questions AS q ON q.student = u.id
+                     WHERE ug.groupid = %%s
+                       AND q.exam = %%s
+                       AND %s
+                     ORDER BY u.familyname, u.id;""" % NOT_UNSEEN, [group.id, exam_id])
+    students = []
+    if not ret:
+        return students
+    student = None
+    for row in ret:
+        if student is None or student['id'] != row[0]:
+            student = {
+                'id': row[0],
+                'uname': row[1],
+                'student_id': row[2],
+                'familyname': row[3],
+                'givenname': row[4],
+                'email': row[5],
+                'scores': {}
+            }
+            students.append(student)
+        student['scores'][row[6]] = row[7]
+    return students
+
+
+def pregenerate_instances(exam_id, group):
+    """ Generate question instances for every member of the group who doesn't
+        have them yet, so it doesn't have to happen one by one when the exam
+        opens. Questions and exam assignments are written with multi-row
+        INSERTs. Returns the number of questions created.
+    """
+    assert isinstance(exam_id, int)
+    students = group.members()
+    if not students:
+        return 0
+    ret = run_sql("""SELECT position, qtemplate
+                     FROM examqtemplates
+                     WHERE exam = %s
+                     ORDER BY position;""", [exam_id, ])
+    if not ret:
+        L.warn("Pre-generating exam %s with no qtemplates." % exam_id)
+        return 0
+    positions = {}
+    for row in ret:
+        position, qt_id = int(row[0]), int(row[1])
+        if qt_id > 0:
+            positions.setdefault(position, []).append(qt_id)
+
+    qtinfo = {}
+    for qt_id in set([qt for qts in positions.values() for qt in qts]):
+        version = DB.get_qt_version(qt_id)
+        qtinfo[qt_id] = {'version': version,
+                         'numvars': DB.get_qt_num_variations(qt_id, version),
+                         'name': DB.get_qt_name(qt_id)}
+
+    assigned = DB.get_exam_assigned(exam_id)
+    todo = []   # (student, position, qt_id, variation)
+    for student in students:
+        for position, qts in positions.iteritems():
+            if (student, position) in assigned:
+                continue
+            qt_id = random.choice(qts)
+            numvars = qtinfo[qt_id]['numvars']
+            if numvars < 1:
+                L.warn("No question variations (qtid=%d)" % qt_id)
+                continue
+            todo.append((student, position, qt_id, random.randint(1, numvars)))
+    if not todo:
+        return 0
+
+    q_ids = DB.create_qs([(qt_id, qtinfo[qt_id]['name'], student, 1, variation,
+                           qtinfo[qt_id]['version'], exam_id)
+                          for (student, position, qt_id, variation) in todo])
+    if not q_ids:
+        L.error("Failed pre-generating %d questions for exam %s" % (len(todo), exam_id))
+        return 0
+
+    # The generated html/image are per variation, only build the missing ones
+    needed = {}
+    for (student, position, qt_id, variation), q_id in zip(todo, q_ids):
+        needed.setdefault(qt_id, {}).setdefault(variation, q_id)
+    for qt_id, variations in needed.iteritems():
+        done = DB.get_q_atts_generated(qt_id, qtinfo[qt_id]['version'])
+        for variation, q_id in variations.iteritems():
+            General.gen_q_atts(qt_id, variation, qtinfo[qt_id]['version'], q_id,
+                               imageexists=(variation, "image.gif") in done,
+                               htmlexists=(variation, "qtemplate.html") in done)
+
+    DB.add_exam_qs([(student, exam_id, q_id, position)
+                    for (student, position, qt_id, variation), q_id in zip(todo, q_ids)])
+    # As create_user_exam() would, so they show as not started yet
+    students = list(set([row[0] for row in todo]))
+    run_sql("""INSERT INTO userexams (exam, student, status, score)
+               SELECT %s, s.student, 1, -1
+               FROM unnest(%s) AS s(student)
+               WHERE NOT EXISTS (SELECT 1 FROM userexams
+                                 WHERE exam = %s AND student = s.student);""",
+            [exam_id, students, exam_id])
+    DB.touch_user_exams(exam_id, students)
+    L.info("Pre-generated %d questions for exam %s, group %s" % (len(q_ids), exam_id, group.id))
+    return len(q_ids)
+
+
+def pregenerate_upcoming(hours=2):
+    """ Pre-generate question instances for all exams starting within the next
+        few hours, for every active group in their course.
+        Meant to be run periodically in the background.
+    """
+    assert isinstance(hours, int)
+    ret = run_sql("""SELECT exam, course
+                     FROM exams
+                     WHERE archived = '0'
+                       AND "start" > NOW() - interval '1 hour'
+                       AND "start" < NOW() + %s * interval '1 hour';""", [hours, ])
+    total = 0
+    if not ret:
+        return total
+    for row in ret:
+        exam_id, course_id = int(row[0]), int(row[1])
+        for group in Courses.get_groups(course_id).values():
+            total += pregenerate_instances(exam_id, group)
+    return total
@@ -22,7 +22,8 @@ import jinja2
 
 from oasis.lib.OaExceptions import OaMarkerError
 from . import Courses, Exams
-from oasis.lib import OaConfig, DB, Topics, script_funcs, OqeSmartmarkFuncs, Audit
+from oasis.lib import OaConfig, DB, Topics, script_funcs, OqeSmartmarkFuncs, Audit, Questions, \
+    QHtml, QScripts, Profiling
 from logging import getLogger
 
 
@@ -47,15 +48,18 @@ def get_topic_list(cid, numq=True):
     """     # TODO: magic numbers!
     tlist = []
     topics = Courses.get_topics(int(cid))
+    records = Topics.get_many(topics)
     for topic in topics:
+        if topic not in records:
+            continue
         if numq:
-            num = Topics.get_num_qs(topic)
+            num = records[topic]['numquestions']
         else:
             num = None
         tlist.append({'tid': topic,
-                      'name': Topics.get_name(topic),
+                      'name': records[topic]['title'],
                       'num': num,
-                      'visibility': Topics.get_vis(topic)})
+                      'visibility': records[topic]['visibility']})
     return tlist
 
 
@@ -88,9 +92,10 @@ def get_q_att(qid, name):
     """ Return (mimetype, data) with the relevant attachment.
         If it's not found in question, look in questiontemplate.
     """
-    qtid = DB.get_q_parent(qid)
-    variation = DB.get_q_variation(qid)
-    version = DB.get_q_version(qid)
+    qctx = Questions.get_context(qid)
+    qtid = qctx.qt_id
+    variation = qctx.variation
+    version = qctx.version
     # for the two biggies we hit the question first,
     # otherwise check the question template first
     if name == "image.gif" or name == "qtemplate.html":
@@ -152,7 +157,6 @@ def gen_q(qtid, student=0, exam=0, position=0, variation=None):
 
 def gen_q_from_var(qt_id, student, exam, position, version, variation):
     """ Generate a question given a specific variation. """
-    qvars = None
     q_id = DB.create_q(qt_id,
                        DB.get_qt_name(qt_id),
                        student,
@@ -165,7 +169,27 @@ def gen_q_from_var(qt_id, student, exam, position, version, variation):
         assert (q_id > 0)
     except (ValueError, TypeError, AssertionError):
         L.error("OaDB.createQuestion(%s,...) FAILED" % qt_id)
-    imageexists = DB.get_q_att_mimetype(qt_id, "image.gif", variation, version)
+    gen_q_atts(qt_id, variation, version, q_id)
+    try:
+        q_id = int(q_id)
+        assert (q_id > 0)
+    except (ValueError, TypeError, AssertionError):
+        L.error("generateQuestionFromVar(%s,%s), can't find qid %s? " %
+                (qt_id, student, q_id))
+    if exam >= 1:
+        DB.add_exam_q(student, exam, q_id, position)
+    return q_id
+
+
+def gen_q_atts(qt_id, variation, version, q_id, imageexists=None, htmlexists=None):
+    """ Make sure the generated image.gif and qtemplate.html attachments exist
+        for the given variation, creating them if needed. They're shared by
+        every question instance of that variation.
+        If imageexists or htmlexists are None, the database will be checked.
+    """
+    qvars = None
+    if imageexists is None:
+        imageexists = DB.get_q_att_mimetype(qt_id, "image.gif", variation, version)
     if not imageexists:
         if not qvars:
             qvars = DB.get_qt_variation(qt_id, variation, version)
@@ -179,17 +203,18 @@ def gen_q_from_var(qt_id, student, exam, position, version, variation):
                             "image/gif",
                             newimage,
                             version)
-    htmlexists = DB.get_q_att_mimetype(qt_id,
-                                       "qtemplate.html",
-                                       variation,
-                                       version)
+    if htmlexists is None:
+        htmlexists = DB.get_q_att_mimetype(qt_id,
+                                           "qtemplate.html",
+                                           variation,
+                                           version)
     if not htmlexists:
         if not qvars:
             qvars = DB.get_qt_variation(qt_id, variation, version)
-        html = DB.get_qt_att(qt_id, "qtemplate.html", version)
-        if html:
+        tmpl = QHtml.get_template(qt_id, version)
+        if tmpl:
             qvars['Oasis_qid'] = q_id
-            newhtml = gen_q_html(qvars, html)
+            newhtml = tmpl.render(qvars)
             L.info("generating new qattach qtemplate.html for %s" % q_id)
             DB.create_q_att(qt_id,
                             variation,
@@ -197,68 +222,11 @@ def gen_q_from_var(qt_id, student, exam, position, version, variation):
                             "application/oasis-html",
                             newhtml,
                             version)
-    try:
-        q_id = int(q_id)
-        assert (q_id > 0)
-    except (ValueError, TypeError, AssertionError):
-        L.error("generateQuestionFromVar(%s,%s), can't find qid %s? " %
-                (qt_id, student, q_id))
-    if exam >= 1:
-        DB.add_exam_q(student, exam, q_id, position)
-    return q_id
 
 
 def gen_q_html(qvars, html):
     """ Create an instance of the HTML """
-    html = html.replace("<IMG SRC>", '<IMG SRC="$IMAGES$image.gif" />')
-    # replace <ANSWERn size> with the correct HTML
-    rx_answern = re.compile(r'<ANSWER([0-9]+) ([0-9]+)>')
-    html = re.sub(rx_answern,
-                  (lambda x:
-                   """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' SIZE='%s' VALUE="VAL_%s"/>""" %
-                   (x.group(1), x.group(2), x.group(1))), html)
-    # replace <ANSWERn> with the correct HTML
-    rx_answern = re.compile(r'<ANSWER([0-9]+)>')
-    html = re.sub(rx_answern,
-                  (lambda x:
-                   """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' VALUE="VAL_%s"/>""" %
-                   (x.group(1), x.group(1))), html)
-    # replace <ANSWERn TEXT> with the correct HTML
-    rx_answern = re.compile(r'<ANSWER([0-9]+) TEXT>')
-    html = re.sub(rx_answern,
-                  (lambda x:
-                   """<TEXTAREA class='auto_save' NAME='ANS_%s' ROWS=6 COLS=100>VAL_%s</TEXTAREA>""" %
-                   (x.group(1), x.group(1))), html)
-    # Do multiple choice
-    # TODO: need to replace with regex at some point
-    #  '<ANSWER(.+?)\s+(.+?)\s+(.*?)>'
-    for i in range(1, 49):
-        (match, repl) = handle_multi_f(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-    for i in range(1, 49):
-        (match, repl) = handle_multi(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-    for i in range(1, 49):
-        (match, repl) = handle_multi_v(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-        # Do listbox
-    # TODO: need to replace with regex at some point
-    #  '<ANSWER(.+?)\s+(.+?)\s+(.*?)>'
-    for i in range(1, 49):
-        (match, repl) = handle_listbox(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-    for v in qvars.keys():
-        html = html.replace("<VAL %s>" % (v,),
-                            '%s' % (qvars[v]))
-        html = html.replace("<IMG SRC %s>" % (v,),
-                            '<IMG SRC="$STATIC$%s" />' % (qvars[v]))
-        html = html.replace("<ATT SRC %s>" % (v,),
-                            '<A HREF="$STATIC$%s" TARGET="_new">%s(View in New Window)</a>' % (qvars[v], qvars[v]))
-    return html
+    return QHtml.QTemplateHtml(html).render(qvars)
 
 
 def gen_q_image(qvars, image):
@@ -300,24 +268,7 @@ def handle_multi_f(html, answer, qvars):
         return None, None
     params = html[start + len("<ANSWER%d MULTIF " % answer):end - 1]
     match = html[start:end]
-    paramlist = params.split(',')
-    pout = ["", ]
-    if paramlist:
-        pout = ["", ]
-        pcount = 0
-        for param in paramlist:
-            pcount += 1
-            if param in qvars:
-                pout += ["<td CLASS='multichoicecell'>"]
-                pout += ["<INPUT class='auto_save' TYPE='radio' NAME='ANS_%d' VALUE='%d' Oa_CHK_%d_%d>%s</td>" % (
-                    answer, pcount, answer, pcount, qvars[param])]
-            else:
-                pout += ["""<FONT COLOR="red">ERROR IN QUESTION DATA</FONT>"""]
-
-    ret = "<table border=0><tr><td>Please choose one:</td>"
-    ret += ''.join(pout)
-    ret += "</tr></table><br />\n"
-    return match, ret
+    return match, QHtml.multi_f_html(answer, params.split(','), qvars)
 
 
 def handle_multi_v(html, answer, qvars):
@@ -336,26 +287,7 @@ def handle_multi_v(html, answer, qvars):
         return None, None
     params = html[start + len("<ANSWER%d MULTIV " % answer):end - 1]
     match = html[start:end]
-    paramlist = params.split(',')
-    pout = ["", ]
-    if paramlist:
-        pout = ["", ]
-        pcount = 0
-        for param in paramlist:
-            pcount += 1
-            pt = 'abcdefghijklmnopqrstuvwxyz'[pcount - 1]
-            if param in qvars:
-                pout += ["<tr><th>%s)</th><td>" % pt, ]
-                pout += "<INPUT class='auto_save' TYPE='radio' NAME='ANS_%d' VALUE='%d' Oa_CHK_%d_%d>" % (
-                    answer, pcount, answer, pcount)
-                pout += "</td><td CLASS='multichoicecell'> %s</td></tr>" % qvars[param]
-
-            else:
-                pout += ["""<tr><td>&nbsp;</td><td><FONT COLOR="red">ERROR IN QUESTION DATA</FONT></td></tr>"""]
-    ret = "<table border=0><tr><th>Please choose one:</th></tr>"
-    ret += ''.join(pout)
-    ret += "</table><br />\n"
-    return match, ret
+    return match, QHtml.multi_v_html(answer, params.split(','), qvars)
 
 
 def handle_multi(html, answer, qvars, shuffle=True):
@@ -371,27 +303,7 @@ def handle_multi(html, answer, qvars, shuffle=True):
         return None, None
     params = html[start + len("<ANSWER%d MULTI " % answer):end - 1]
     match = html[start:end]
-    paramlist = params.split(',')
-    pout = ["", ]
-    if paramlist:
-        pout = ["", ]
-        pcount = 0
-        for param in paramlist:
-            pcount += 1
-            if param in qvars:
-                pout += [
-                    "<td CLASS='multichoicecell'>",
-                    "<INPUT class='auto_save' TYPE='radio' NAME='ANS_%d' VALUE='%d' Oa_CHK_%d_%d> %s</td>" % (
-                        answer, pcount, answer, pcount, qvars[param])]
-            else:
-                pout += ["""<FONT COLOR="red">ERROR IN QUESTION DATA</FONT>"""]
-        # randomise the order in the list at least a little bit
-    if shuffle:
-        random.shuffle(pout)
-    ret = "<table border=0><tr><th>Please choose one:</th>"
-    ret += ''.join(pout)
-    ret += "</tr></table><br />\n"
-    return match, ret
+    return match, QHtml.multi_html(answer, params.split(','), qvars, shuffle)
 
 
 def handle_listbox(html, answer, qvars, shuffle=True):
@@ -410,100 +322,32 @@ def handle_listbox(html, answer, qvars, shuffle=True):
         return None, None
     params = html[start + len("<ANSWER%d SELECT " % answer):end - 1]
     match = html[start:end]
-    paramlist = params.split(',')
-    pout = ["", ]
-    if paramlist:
-        pout = ["", ]
-        pcount = 0
-        for param in paramlist:
-            pcount += 1
-            if param in qvars:
-                pout += ["""<OPTION VALUE='%d' Oa_SEL_%d_%d>%s</OPTION>""" %
-                         (pcount, answer, pcount, qvars[param])]
-            else:
-                pout += ["""<OPTION><FONT COLOR="red">ERROR IN QUESTION DATA</FONT></OPTION>"""]
-        # this should randomise the order in the list at least a little bit
-    if shuffle:
-        random.shuffle(pout)
-    ret = """<SELECT class='auto_save' NAME='ANS_%d'>Please choose:""" % answer
-    ret += """<OPTION VALUE='None'>--Choose--</OPTION>"""
-    ret += ''.join(pout)
-    ret += "</SELECT>\n"
-    return match, ret
-
-
-def render_q_html(q_id, readonly=False):
+    return match, QHtml.listbox_html(answer, params.split(','), qvars, shuffle)
+
+
+@Profiling.timed("render_q_html")
+def render_q_html(qctx, readonly=False):
     """ Fetch the question html and get it ready for display - replacing
-        links with appropriate targets and filling in form details."""
-    try:
-        q_id = int(q_id)
-        assert q_id > 0
-    except (ValueError, TypeError, AssertionError):
-        L.warn("renderQuestionHTML(%s,%s) called with bad qid?" % (q_id, readonly))
-    qt_id = DB.get_q_parent(q_id)
+        links with appropriate targets and filling in form details.
+        qctx is a Questions.QuestionContext (or a question ID)
+    """
     try:
-        qt_id = int(qt_id)
-        assert qt_id > 0
-    except (ValueError, TypeError, AssertionError):
+        qctx = Questions.get_context(qctx)
+    except (ValueError, TypeError, KeyError):
+        L.warn("renderQuestionHTML(%s,%s) called with bad qid?" % (qctx, readonly))
+        return "QuestionError"
+    q_id = qctx.id
+    qt_id = qctx.qt_id
+    if not qt_id:
         L.warn("renderQuestionHTML(%s,%s), getparent failed? " % (q_id, readonly))
-    variation = DB.get_q_variation(q_id)
-    version = DB.get_q_version(q_id)
-    data = DB.get_q_att(qt_id, "qtemplate.html", variation, version)
-    if not data:
+        return "QuestionError"
+    variation = qctx.variation
+    version = qctx.version
+    qhtml = QHtml.get_instance(qt_id, version, variation)
+    if not qhtml:
         L.warn("Unable to retrieve qtemplate for q_id: %s" % q_id)
         return "QuestionError"
-    try:
-        out = unicode(data, "utf-8")
-    except UnicodeDecodeError:
-        try:
-            out = unicode(DB.get_q_att(qt_id, "qtemplate.html", variation, version),
-                          "latin-1")
-        except UnicodeDecodeError as err:
-            L.error("unicode error decoding qtemplate for q_id %s: %s" % (q_id, err))
-            raise
-    out = out.replace("This question is not verified yet, please report any error!", "")
-
-    out = out.replace("ANS_", "Q_%d_ANS_" % (q_id,))
-    out = out.replace("$IMAGES$",
-                      "%s/att/qatt/%s/%s/%s/" %
-                      (OaConfig.parentURL, qt_id, version, variation))
-    out = out.replace("$APPLET$",
-                      "%s/att/qatt/%s/%s/%s/" %
-                      (OaConfig.parentURL, qt_id, version, variation))
-    out = out.replace("$STATIC$",
-                      "%s/att/qtatt/%s/%s/%s/" %
-                      (OaConfig.parentURL, qt_id, version, variation))
-    if readonly:
-        out = out.replace("<INPUT ", "<INPUT READONLY ")
-        out = out.replace("<SELECT ", "<SELECT DISABLED=DISABLED STYLE='color: black;'")
-    guesses = DB.get_q_guesses(q_id)
-    for guess in guesses.keys():
-        # noinspection PyComparisonWithNone,PyPep8
-        if guesses[guess] == None:  # If it's 0 we want to leave it alone
-            guesses[guess] = ""
-        if guesses[guess] == "None":
-            guesses[guess] = ""
-            # for each question
-    if guesses:
-        for ques in range(25, 0, -1):
-            if ("G%d" % ques) in guesses:
-                out = out.replace("VAL_%d" % ques, htmlesc(guesses["G%d" % ques]))
-                for part in range(50, 0, -1):
-                    if guesses["G%d" % ques] == "%s.0" % part or guesses["G%d" % ques] == "%s" % part:
-                        out = out.replace("Oa_SEL_%d_%d" % (ques, part),
-                                          "SELECTED")
-                        out = out.replace("Oa_CHK_%d_%d" % (ques, part),
-                                          "CHECKED")
-                    else:
-                        out = out.replace("Oa_SEL_%d_%d" % (ques, part),
-                                          "")
-                        out = out.replace("Oa_CHK_%d_%d" % (ques, part),
-                                          "")
-            else:
-                out = out.replace("VAL_%d" % (ques,), "")
-    for ques in range(25, 0, -1):
-        out = out.replace("VAL_%d" % (ques,), "")
-    return out
+    return qhtml.render(q_id, DB.get_q_guesses(q_id), readonly)
 
 
 # parseExpo interprets an input like "1.602 x 10^19" and returns
@@ -681,8 +525,10 @@ def mark_q_script(qvars, script, answer):
         qid = qvars['OaQID']
     except KeyError:
         qid = -1
+    if isinstance(script, basestring):
+        script = QScripts.QScript(script, "__marker.py")
     try:
-        exec(script, qvars)
+        script.run(qvars)
     except BaseException:
         (etype, value, tb) = sys.exc_info()
         script_funcs.q_log(qid,
@@ -721,8 +567,10 @@ def mark_q_script(qvars, script, answer):
     return marks
 
 
-def render_mark_results_standard(qid, marks):
-    """Display a nice little HTML table showing the marking for the question. """
+def render_mark_results_standard(qctx, marks):
+    """Display a nice little HTML table showing the marking for the question.
+       qctx is a Questions.QuestionContext (or a question ID)
+    """
     out = u""
     parts = [int(var[1:])
              for var in marks.keys()
@@ -747,18 +595,21 @@ def render_mark_results_standard(qid, marks):
         out += u"<tr><th>&nbsp;</th><th valign='top'>Overall Comment:</th><td colspan='4'>%s</td></tr>" % (
             marks['C0'],)
     out += u"</table>\n<hr />"
-    out += render_q_html(qid, readonly=True)
+    out += render_q_html(qctx, readonly=True)
     return out
 
 
-def render_mark_results_script(qtid, qid, marks, script):
+def render_mark_results_script(qctx, marks, script):
     """Run the provided script to show the marking for the
        question.
+       qctx is a Questions.QuestionContext (or a question ID)
     """
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
-    qvars = DB.get_qt_variation(qtid, variation, version)
-    questionhtml = render_q_html(qid, readonly=True)
+    qctx = Questions.get_context(qctx)
+    qid = qctx.id
+    qvars = qctx.qvars()
+    if qvars is None:
+        qvars = {}
+    questionhtml = render_q_html(qctx, readonly=True)
     reshtml = ""
     qvars["__builtins__"] = {'MyFuncs': OqeSmartmarkFuncs,
                              'withinTolerance': script_funcs.within_tolerance,
@@ -807,8 +658,10 @@ def render_mark_results_script(qtid, qid, marks, script):
         qvars['comments'][comment] = marks['C%d' % comment]
     qvars['numparts'] = len(answers)
     qvars['parts'] = range(1, len(answers) + 1)
+    if isinstance(script, basestring):
+        script = QScripts.QScript(script, "__results.py")
     try:
-        exec(script, qvars)
+        script.run(qvars)
     except BaseException:
         (etype, value, tb) = sys.exc_info()
         script_funcs.q_log(qid,
@@ -828,7 +681,7 @@ def render_mark_results_script(qtid, qid, marks, script):
                        "error",
                        "__results.py",
                        "'resultsHTML' not set, using standard renderer.")
-    return render_mark_results_standard(qid, marks)
+    return render_mark_results_standard(qctx, marks)
 
 
 def render_mark_results(qid, marks):
@@ -839,37 +692,39 @@ def render_mark_results(qid, marks):
        set variable "resultsHTML" to contain a suitable string for putting
        in an HTML page.
     """
-    qtid = DB.get_q_parent(qid)
-    renderscript = DB.get_qt_att(qtid, "__results.py")
+    qctx = Questions.get_context(qid)
+    renderscript = QScripts.get_script(qctx.qt_id, "__results.py")
     if not renderscript:
-        resultshtml = render_mark_results_standard(qid, marks)
+        resultshtml = render_mark_results_standard(qctx, marks)
     else:
-        resultshtml = render_mark_results_script(qtid, qid, marks, renderscript)
+        resultshtml = render_mark_results_script(qctx, marks, renderscript)
     return resultshtml
 
 
+@Profiling.timed("mark_q")
 def mark_q(qid, answers):
     """ Mark the question according to the answers given in a dictionary and
         return the result in a dictionary:
         input:    {"A1":"0.345", "A2":"fred", "A3":"-26" }
         return:   {"M1": Mark One, "C1": Comment One, "M2": Mark Two..... }
+        qid may be a Questions.QuestionContext
     """
-    qtid = DB.get_q_parent(qid)
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
-    qvars = DB.get_qt_variation(qtid, variation, version)
+    qctx = Questions.get_context(qid)
+    qtid = qctx.qt_id
+    qvars = qctx.qvars()
     if not qvars:
         qvars = {}
-        L.warn("markQuestion(%s, %s) unable to retrieve variables." % (qid, answers))
-    qvars['OaQID'] = int(qid)
-    marktype = DB.get_qt_marker(qtid)
+        L.warn("markQuestion(%s, %s) unable to retrieve variables." % (qctx.id, answers))
+    qvars['OaQID'] = qctx.id
+    marktype = qctx.marker
     if marktype == 1:    # standard
         marks = mark_q_standard(qvars, answers)
     else:
-        # We want the latest version of the marker, so no version given
-        markerscript = DB.get_qt_att(qtid, "__marker.py")
+        # We want the latest version of the marker, not the question's
+        version = DB.get_qt_version(qtid)
+        markerscript = QScripts.get_script(qtid, "__marker.py", version)
         if not markerscript:
-            markerscript = DB.get_qt_att(qtid, "marker.py")
+            markerscript = QScripts.get_script(qtid, "marker.py", version)
             L.info("'marker.py' should now be called '__marker.py' (qtid=%s)" % qtid)
         if not markerscript:
             L.info("Unable to retrieve marker script for smart marker question (qtid=%s)!" % qtid)
@@ -942,9 +797,12 @@ def get_exam_q(exam, page, user_id):
     """ Find the appropriate exam question for the user.
         Generate it if there isn't one already.
     """
-    qid = DB.get_exam_q_by_pos_student(exam, page, user_id)
-    if qid is not False:
-        return int(qid)
+    info = DB.get_exam_q_info_by_pos_student(exam, page, user_id)
+    if info:
+        qid, firstview = info
+        if not firstview:  # it may have been pre-generated, never seen
+            DB.set_q_viewtime(qid)
+        return qid
     qid = int(gen_exam_q(exam, page, user_id))
     try:
         qid = int(qid)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" Gradebook.py
+    The results of an assessment for every student in the course's groups,
+    as shown on the course admin results page.
+
+    Built with one query and kept in memcache until a mark changes, since
+    staff reload the results page a lot during and after an assessment.
+"""
+
+import json
+from datetime import datetime
+
+from oasis.lib.DB import run_sql, MC
+from oasis.lib import Exams
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+# Positions in each student row
+UID, UNAME, FAMILYNAME, GIVENNAME, STUDENT_ID, SCORES, TOTAL, FIRSTVIEW, MARKTIME = range(9)
+
+# Exams.save_score() and changing the questions clear the cache, but group
+# membership changes don't, so don't keep it forever.
+CACHE_TIME = 600
+
+
+def _timestr(when):
+    if when is None:
+        return None
+    return when.strftime("%Y-%m-%d %H:%M")
+
+
+def get_results(course_id, exam_id):
+    """ Return the results of the assessment for the active groups in the
+        course:
+            {'generated': when it was worked out,
+             'questions': Exams.get_qts_list(exam_id),
+             'groups': [{'id', 'name', 'title', 'students': [row, ...]}]}
+
+        Each student row is a list, see UID, UNAME, ... for the positions.
+        row[SCORES] has one list per question position, with the score
+        (or None) for each question template at that position. FIRSTVIEW and
+        MARKTIME are the first time they viewed a question and the last time
+        one was marked.
+    """
+    assert isinstance(course_id, int)
+    assert isinstance(exam_id, int)
+    key = "exam-%s-gradebook" % exam_id
+    obj = MC.get(key)
+    if obj:
+        gradebook = json.loads(obj)
+        if gradebook['course'] == course_id:
+            return gradebook
+
+    questions = Exams.get_qts_list(exam_id)
+    columns = {}  # qtemplate: (position index, index within position)
+    for pidx, pos in enumerate(questions):
+        for qidx, qt in enumerate(pos):
+            columns[qt['id']] = (pidx, qidx)
+
+    ret = run_sql("""SELECT g.id, g.name, g.title,
+                            u.id, u.uname, u.familyname, u.givenname, u.student_id,
+                            q.qtemplate, q.score, q.firstview, q.marktime
+                     FROM ugroups AS g
+                     JOIN groupcourses AS gc ON gc.groupid = g.id
+                     JOIN periods AS p ON p.id = g.period
+                     LEFT JOIN usergroups AS ug ON ug.groupid = g.id
+                     LEFT JOIN questions AS q ON q.student = ug.userid AND q.exam = %%s
+                                              AND %s
+                     LEFT JOIN users AS u ON u.id = q.student
+                     WHERE g.active = TRUE
+                       AND gc.course = %%s
+                     ORDER BY g.id, u.familyname, u.id;""" % Exams.NOT_UNSEEN,
+                  [exam_id, course_id])
+    groups = []
+    group = None
+    student = None
+    for row in ret or []:
+        if group is None or group['id'] != row[0]:
+            group = {'id': row[0], 'name': row[1], 'title': row[2], 'students': []}
+            groups.append(group)
+            student = None
+        if row[3] is None:  # no questions in this assessment
+            continue
+        if student is None or student[UID] != row[3]:
+            student = [row[3], row[4], row[5], row[6], row[7],
+                       [[None] * len(pos) for pos in questions],
+                       0.0, None, None]
+            group['students'].append(student)
+        score = row[9]
+        if row[8] in columns:
+            pidx, qidx = columns[row[8]]
+            student[SCORES][pidx][qidx] = score
+        if score:
+            student[TOTAL] += score
+        if row[10] and (student[FIRSTVIEW] is None or row[10] < student[FIRSTVIEW]):
+            student[FIRSTVIEW] = row[10]
+        if row[11] and (student[MARKTIME] is None or row[11] > student[MARKTIME]):
+            student[MARKTIME] = row[11]
+
+    for group in groups:
+        for student in group['students']:
+            student[FIRSTVIEW] = _timestr(student[FIRSTVIEW])
+            student[MARKTIME] = _timestr(student[MARKTIME])
+
+    gradebook = {
+        'course': course_id,
+        'generated': datetime.now().strftime("%H:%M, %a %d %b %Y"),
+        'questions': questions,
+        'groups': groups
+    }
+    MC.set(key, json.dumps(gradebook), CACHE_TIME)
+    return gradebook
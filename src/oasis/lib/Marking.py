@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" Marking.py
+    Queue of submitted assessments waiting to be marked.
+
+    When marking_queue is on, submitting an assessment just records a job in
+    the markjobs table and the student is shown a "being marked" page. Worker
+    processes (scripts/run_marker) claim jobs one at a time and mark them with
+    Assess.mark_exam_now().
+
+    Job status:
+        0 = queued
+        1 = being marked
+        2 = done
+        3 = failed
+"""
+
+import datetime
+import time
+import traceback
+
+from oasis.lib.DB import run_sql, IntegrityError
+from oasis.lib import Exams
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+JOB_QUEUED = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_FAILED = 3
+
+# A job still running after this many seconds is assumed to belong to a
+# worker that died, and is queued again.
+JOB_TIMEOUT = 600
+
+# Give up on a job after it has failed this many times.
+MAX_ATTEMPTS = 3
+
+
+def enqueue(user_id, exam_id):
+    """ Submit the assessment and queue it for marking.
+        The assessment is marked as submitted (status 4) straight away so the
+        student can't make further changes while it waits.
+        Returns True.
+    """
+    assert isinstance(user_id, int)
+    assert isinstance(exam_id, int)
+    Exams.set_user_status(user_id, exam_id, 4)
+    Exams.set_submit_time(user_id, exam_id)
+    try:
+        run_sql("""INSERT INTO markjobs (exam, student)
+                   SELECT %s, %s
+                   WHERE NOT EXISTS (SELECT 1 FROM markjobs
+                                     WHERE exam = %s AND student = %s
+                                       AND status < %s);""",
+                [exam_id, user_id, exam_id, user_id, JOB_DONE])
+    except IntegrityError:
+        # Submitted twice at once, the other request already queued it.
+        pass
+    L.info("Queued assessment %s by user %s for marking" % (exam_id, user_id))
+    return True
+
+
+def get_job_status(user_id, exam_id):
+    """ Return the status of the latest marking job for the assessment,
+        or None if it has never been queued.
+    """
+    assert isinstance(user_id, int)
+    assert isinstance(exam_id, int)
+    ret = run_sql("""SELECT status FROM markjobs
+                     WHERE exam = %s AND student = %s
+                     ORDER BY id DESC LIMIT 1;""", [exam_id, user_id])
+    if not ret:
+        return None
+    return int(ret[0][0])
+
+
+def is_pending(user_id, exam_id):
+    """ Is the assessment waiting to be marked, or being marked now? """
+    return get_job_status(user_id, exam_id) in (JOB_QUEUED, JOB_RUNNING)
+
+
+def count_pending():
+    """ How many jobs are waiting to be marked or being marked. """
+    ret = run_sql("""SELECT COUNT(*) FROM markjobs WHERE status < %s;""",
+                  [JOB_DONE, ])
+    if not ret:
+        return 0
+    return int(ret[0][0])
+
+
+def claim(worker):
+    """ Take the oldest queued job, marking it as running by the given worker.
+        Returns {'id', 'exam', 'student', 'created'} or None if there's
+        nothing to do.
+
+        If two workers go for the same job, one of them waits for the other
+        and then gets nothing back, and will try again next time round.
+    """
+    ret = run_sql("""UPDATE markjobs
+                     SET status = %s, attempts = attempts + 1,
+                         started = NOW(), worker = %s
+                     WHERE id = (SELECT id FROM markjobs
+                                 WHERE status = %s
+                                 ORDER BY id LIMIT 1
+                                 FOR UPDATE)
+                       AND status = %s
+                     RETURNING id, exam, student, created;""",
+                  [JOB_RUNNING, worker, JOB_QUEUED, JOB_QUEUED])
+    if not ret:
+        return None
+    row = ret[0]
+    return {'id': int(row[0]),
+            'exam': int(row[1]),
+            'student': int(row[2]),
+            'created': row[3]}
+
+
+def finish(job_id, success, message=None):
+    """ Record the result of a job. A failed job is queued again unless it
+        has already had MAX_ATTEMPTS tries.
+    """
+    assert isinstance(job_id, int)
+    if success:
+        run_sql("""UPDATE markjobs SET status = %s, finished = NOW(), message = %s
+                   WHERE id = %s;""", [JOB_DONE, message, job_id])
+        return
+    run_sql("""UPDATE markjobs
+               SET status = CASE WHEN attempts < %s THEN %s ELSE %s END,
+                   finished = NOW(), message = %s
+               WHERE id = %s;""",
+            [MAX_ATTEMPTS, JOB_QUEUED, JOB_FAILED, message, job_id])
+
+
+def requeue_stale():
+    """ Queue again any jobs that have been running too long, their worker
+        has probably died. Returns how many there were.
+    """
+    ret = run_sql("""UPDATE markjobs SET status = %s, worker = NULL
+                     WHERE status = %s AND started < %s
+                     RETURNING id;""",
+                  [JOB_QUEUED, JOB_RUNNING,
+                   datetime.datetime.now() - datetime.timedelta(seconds=JOB_TIMEOUT)])
+    if not ret:
+        return 0
+    for row in ret:
+        L.warn("Marking job %s timed out, queued again." % row[0])
+    return len(ret)
+
+
+def run_next(worker):
+    """ Claim and mark the next job in the queue.
+        Returns False if the queue was empty, True otherwise.
+    """
+    from oasis.lib import Assess
+
+    job = claim(worker)
+    if not job:
+        return False
+    user_id = job['student']
+    exam_id = job['exam']
+    if Exams.get_user_status(user_id, exam_id) >= 5 and Exams.is_done_by(user_id, exam_id):
+        finish(job['id'], True, "already marked")
+        return True
+    try:
+        ok = Assess.mark_exam_now(user_id, exam_id, submittime=job['created'])
+    except BaseException as err:
+        if not isinstance(err, Exception):  # KeyboardInterrupt, SystemExit
+            finish(job['id'], False, "interrupted")
+            raise
+        L.error("Marking job %s (exam %s, user %s) failed: %s" %
+                (job['id'], exam_id, user_id, traceback.format_exc()))
+        finish(job['id'], False, repr(err))
+        return True
+    if ok:
+        finish(job['id'], True)
+    else:
+        L.warn("Marking job %s (exam %s, user %s) had problems." %
+               (job['id'], exam_id, user_id))
+        finish(job['id'], False, "marking problem")
+    return True
+
+
+def process_jobs(worker="inline", max_jobs=None):
+    """ Mark everything in the queue now, eg. from run_hourly to catch up
+        if no workers were running. Returns the number of jobs done.
+    """
+    requeue_stale()
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        if not run_next(worker):
+            break
+        done += 1
+    return done
+
+
+def worker_loop(worker, poll=1.0, max_jobs=None, stop=None):
+    """ Keep marking jobs, checking the queue every poll seconds when it's
+        empty. Returns after max_jobs jobs, if given, or when stop() is true.
+    """
+    done = 0
+    last_sweep = 0
+    while not (stop and stop()):
+        if time.time() - last_sweep > 60:
+            requeue_stale()
+            last_sweep = time.time()
+        if run_next(worker):
+            done += 1
+            if max_jobs and done >= max_jobs:
+                break
+        else:
+            time.sleep(poll)
+    return done
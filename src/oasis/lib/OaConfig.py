@@ -48,6 +48,11 @@ dbuname = cp.get("db", "uname")
 dbname = cp.get("db", "dbname")
 dbpass = cp.get("db", "pass")
 dbport = cp.get("db", "port")
+dbpool_min = cp.getint("db", "pool_min")
+dbpool_max = cp.getint("db", "pool_max")
+dbpool_timeout = cp.getint("db", "pool_timeout")
+slow_query_ms = cp.getint("db", "slow_query_ms")
+slow_query_log = cp.get("db", "slow_query_log")
 
 oasisdbconnectstring = "host=%s port=%s dbname=%s user=%s password='%s'" % \
                        (dbhost, dbport, dbname, dbuname, dbpass)
@@ -57,7 +62,14 @@ contact_url = cp.get("web", "contact_url", False)
 if len(contact_url) < 3:
     contact_url = False
 memcache_enable = cp.getboolean("cache", "memcache_enable")
+memcache_servers = cp.get("cache", "memcache_servers")
+memcache_timeout = cp.getfloat("cache", "memcache_timeout")
+memcache_fail_threshold = cp.getint("cache", "memcache_fail_threshold")
+memcache_retry = cp.getint("cache", "memcache_retry")
 uniqueKey = cp.get("cache", "cachekey")
+local_cache_mb = cp.getint("cache", "local_cache_mb")
+local_cache_ttl = cp.getint("cache", "local_cache_ttl")
+compiled_cache_mb = cp.getint("cache", "compiled_cache_mb")
 
 logfile = cp.get("app", "logfile")
 _ll = cp.getint("app", "loglevel")
@@ -67,7 +79,15 @@ else:
     loglevel = [logging.FATAL, logging.CRITICAL, logging.ERROR, logging.WARN, logging.INFO][_ll - 1]
 
 profile_log = cp.get("app", "profile_log")
+profile_requests = cp.getboolean("app", "profile_requests")
+profile_dir = cp.get("app", "profile_dir")
 feed_path = cp.get("app", "feed_path")
+script_max_seconds = cp.getfloat("app", "script_max_seconds")
+script_max_steps = cp.getint("app", "script_max_steps")
+marking_queue = cp.getboolean("app", "marking_queue")
+audit_spill_file = cp.get("app", "audit_spill_file")
+attachment_dir = cp.get("app", "attachment_dir")
+attachment_accel = cp.get("app", "attachment_accel")
 open_registration = cp.getboolean("web", "open_registration")
 enable_local_login = cp.getboolean("web", "enable_local_login")
 enable_webauth_login = cp.getboolean("web", "enable_webauth_login")
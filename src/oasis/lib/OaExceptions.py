@@ -11,3 +11,11 @@ class OaMarkerError(Exception):
     """
 
     pass
+
+
+class OaScriptLimitError(BaseException):
+    """A question script has run for too long and been stopped. It's not an
+       Exception so the script's own "except Exception:" won't catch it.
+    """
+
+    pass
@@ -5,7 +5,11 @@
 
 """ Contains db access functions for users, groups, permissions and courses """
 
+import json
+import time
+
 from oasis.lib.DB import run_sql, MC
+from oasis.lib import Cache
 
 PERMS = {'sysadmin': 1, 'useradmin': 2,
          'courseadmin': 3, 'coursecoord': 4,
@@ -17,53 +21,107 @@ PERMS = {'sysadmin': 1, 'useradmin': 2,
          'syscourses': 19, 'surveyresults': 20}
 
 
+# Each user's permissions are loaded in one go and kept as a bitmask per
+# course, bit n set for permission n, in memcached and in each process.
+# add_perm() and delete_perm() bump the user's version counter in memcached,
+# which moves the memcached copy to a new key. Other processes notice within
+# LOCAL_TTL seconds, the process making the change straight away.
+CACHE_TIME = 3600
+LOCAL_TTL = 10
+PERM_CACHE = Cache.LRUCache(1024 * 1024, ttl=LOCAL_TTL)
+
+# Permission 0 on a course gives every permission on that course.
+ALL_PERMS = 0
+
+
+def _version(user_id):
+    """ The version of the user's permissions, or None if memcached isn't
+        there. Starts from the time rather than 0 so a counter that has been
+        evicted doesn't come back as a version that's been used before.
+    """
+    key = "permission-%s-version" % user_id
+    version = MC.get(key)
+    if version is None:
+        version = MC.incr(key, 0, initial=int(time.time()))
+    if version is None:
+        return None
+    return int(version)
+
+
+def _load_perms(user_id):
+    """ Read the user's permissions from the database.
+        Returns {'super': bool, 'any': mask, 'courses': {course: mask}}
+        where 'any' is all their permissions, on whatever course.
+    """
+    ret = run_sql("""SELECT course, permission
+                     FROM permissions
+                     WHERE userid=%s;""", [user_id, ])
+    perms = {'super': False, 'any': 0, 'courses': {}}
+    for course, permission in ret or []:
+        if permission == 1:
+            perms['super'] = True
+        bit = 1 << int(permission)
+        perms['any'] |= bit
+        if course is not None:
+            course = int(course)
+            perms['courses'][course] = perms['courses'].get(course, 0) | bit
+    return perms
+
+
+def get_user_perms(user_id):
+    """ Return the user's permissions, as from _load_perms(), from the cache
+        if we can.
+    """
+    user_id = int(user_id)
+    found, perms = PERM_CACHE.get(user_id)
+    if found:
+        return perms
+    version = _version(user_id)
+    key = "permission-%s-v%s" % (user_id, version)
+    obj = None
+    if version is not None:
+        obj = MC.get(key)
+    if obj:
+        perms = json.loads(obj)
+        perms['courses'] = dict([(int(course), mask)
+                                 for course, mask in perms['courses'].items()])
+    else:
+        perms = _load_perms(user_id)
+        if version is not None:
+            MC.set(key, json.dumps(perms), CACHE_TIME)
+    PERM_CACHE.set(user_id, perms, 64 + 32 * len(perms['courses']))
+    return perms
+
+
+def _clear_perms(user_id):
+    """ Their permissions have changed, stop using the cached ones.
+        A counter that has been evicted starts again from the time, not from
+        a version that may still be cached.
+    """
+    user_id = int(user_id)
+    PERM_CACHE.delete(user_id)
+    MC.incr("permission-%s-version" % user_id, initial=int(time.time()))
+
+
 def check_perm(user_id, group_id, perm):
     """ Check to see if the user has the permission on the given course. """
     permission = 0
     if not isinstance(perm, int):  # we have a string name so look it up
         if perm in PERMS:
             permission = PERMS[perm]
-    key = "permission-%s-super" % user_id
-    obj = MC.get(key)
-    if obj:
+    else:
+        permission = perm
+    perms = get_user_perms(user_id)
+    # If they're superuser, let em do anything
+    if perms['super']:
         return True
-        # If they're superuser, let em do anything
-    ret = run_sql("""SELECT "id"
-                     FROM permissions
-                     WHERE userid=%s
-                       AND permission=1;""",
-                  [user_id, ])
-    if ret:
-        MC.set(key, True)
+    bit = 1 << permission
+    # If we're asking for course -1 it means any course will do.
+    if group_id == -1 and perms['any'] & bit:
         return True
-        # If we're asking for course -1 it means any course will do.
-    if group_id == -1:
-        ret = run_sql("""SELECT "id"
-                         FROM permissions
-                         WHERE userid=%s
-                           AND permission=%s;""",
-                      [user_id, permission])
-        if ret:
-            return True
-        # Do they have the permission explicitly?
-    ret = run_sql("""SELECT "id"
-                     FROM permissions
-                     WHERE course=%s
-                       AND userid=%s
-                       AND permission=%s;""",
-                  [group_id, user_id, permission])
-    if ret:
-        return True
-        # Now check for global override
-    ret = run_sql("""SELECT "id"
-                     FROM permissions
-                     WHERE course=%s
-                       AND userid=%s
-                       AND permission='0';""",
-                  [group_id, user_id])
-    if ret:
-        return True
-    return False
+    # Do they have the permission explicitly, or the global override?
+    mask = perms['courses'].get(group_id, 0)
+    return bool(mask & (bit | 1 << ALL_PERMS))
 
 
 def satisfy_perms(uid, group_id, permlist):
@@ -78,21 +136,19 @@ def satisfy_perms(uid, group_id, permlist):
 
 def delete_perm(uid, group_id, perm):
     """Remove a permission. """
-    key = "permission-%s-super" % (uid,)
-    MC.delete(key)
     run_sql("""DELETE FROM permissions
                WHERE userid=%s
                  AND course=%s
                  AND permission=%s""",
             [uid, group_id, perm])
+    _clear_perms(uid)
 
 
 def add_perm(uid, course_id, perm):
     """ Assign a permission."""
-    key = "permission-%s-super" % (uid,)
-    MC.delete(key)
     run_sql("""INSERT INTO permissions (course, userid, permission)
                VALUES (%s, %s, %s) """, [course_id, uid, perm])
+    _clear_perms(uid)
 
 
 def get_course_perms(course_id):
@@ -14,10 +14,17 @@
 
 
 import Queue
+import bisect
+import hashlib
+import re
+import threading
+import time
 import OaConfig
+import Profiling
 from logging import getLogger
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_UNKNOWN
+from psycopg2 import errorcodes
 import memcache
 
 try:
@@ -27,8 +34,166 @@ except AttributeError:
 
 L = getLogger("oasisqe")
 
+# Statements slower than this are written to the slow query log, with their
+# parameters.
+SLOW_L = getLogger("oasisqe.slowsql")
+try:
+    slow_query_secs = OaConfig.slow_query_ms / 1000.0 if OaConfig.slow_query_ms > 0 else None
+except AttributeError:
+    slow_query_secs = None
+
 disable_mc_cache = False
 
+# Our memcached keys include a generation number, kept in memcached, so all
+# of this install's keys can be dropped without touching other installs
+# sharing the server. Processes re-read it this often (seconds).
+GENERATION_CHECK = 10
+
+# Only keep statistics for this many different ad-hoc statements, the rest are
+# counted together.
+MAX_STATEMENTS = 500
+OTHER_STATEMENTS = "(other)"
+
+# Make statements that only differ in how many values they were given the same.
+_REPEATED_PARAMS = re.compile(r"%s(\s*,\s*%s)+")
+_REPEATED_ROWS = re.compile(r"\(%s, \.\.\.\)(\s*,\s*\(%s, \.\.\.\))+")
+
+
+class Histogram(object):
+    """ Counts of how long something took, in buckets up to each of BOUNDS
+        seconds and one for anything longer. Not thread safe by itself.
+    """
+
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+              0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, seconds):
+        """ Count one more. """
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+    def buckets(self):
+        """ [[upper bound, count], ...], the last upper bound is None. """
+        return [[bound, count] for bound, count in
+                zip(list(self.BOUNDS) + [None], self.counts)]
+
+
+class StatementStats(object):
+    """ How often a statement is run, how long it takes and how many rows
+        it returns or changes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.histogram = Histogram()
+
+    def record(self, seconds, rows=None):
+        """ Count a run of the statement that took the given time. """
+        with self.lock:
+            self.calls += 1
+            self.total_time += seconds
+            self.max_time = max(self.max_time, seconds)
+            if rows and rows > 0:
+                self.rows += rows
+            self.histogram.add(seconds)
+
+    def stats(self):
+        """ Usage statistics, times are in seconds.
+        :return: dict
+        """
+        with self.lock:
+            return {'name': self.name,
+                    'calls': self.calls,
+                    'total': self.total_time,
+                    'max': self.max_time,
+                    'avg': self.total_time / self.calls if self.calls else 0.0,
+                    'rows': self.rows,
+                    'histogram': self.histogram.buckets()}
+
+
+# Statistics for statements run through run_sql, by normalize_sql()
+STATEMENTS = {}
+STATEMENTS_LOCK = threading.Lock()
+
+
+def normalize_sql(sql):
+    """ The statement with whitespace tidied up and lists of parameters
+        shortened, so we count it the same however many values it's given.
+    """
+    sql = " ".join(sql.split())
+    sql = _REPEATED_PARAMS.sub("%s, ...", sql)
+    return _REPEATED_ROWS.sub("(%s, ...), ...", sql)
+
+
+def statement_stats(sql):
+    """ The StatementStats for an ad-hoc statement, created if needed. """
+    key = normalize_sql(sql)
+    try:
+        return STATEMENTS[key]
+    except KeyError:
+        pass
+    with STATEMENTS_LOCK:
+        if key not in STATEMENTS:
+            if len(STATEMENTS) >= MAX_STATEMENTS:
+                key = OTHER_STATEMENTS
+                if key not in STATEMENTS:
+                    STATEMENTS[key] = StatementStats(key)
+            else:
+                STATEMENTS[key] = StatementStats(key)
+        return STATEMENTS[key]
+
+
+def all_statement_stats():
+    """ Statistics for every statement run through run_sql, most total
+        time first.
+    """
+    with STATEMENTS_LOCK:
+        statements = STATEMENTS.values()
+    return sorted([stmt.stats() for stmt in statements],
+                  key=lambda stmt: stmt['total'], reverse=True)
+
+
+def _log_if_slow(seconds, name, params, rows):
+    if slow_query_secs is not None and seconds >= slow_query_secs:
+        SLOW_L.warn("%.0fms rows=%s %s (%s)" % (seconds * 1000, rows,
+                                                " ".join(name.split()),
+                                                repr(params)[:1000]))
+
+
+class Query(StatementStats):
+    """ A statement we run often enough that it's worth having postgres parse
+        and plan it once per connection rather than every time.
+        sql uses %s placeholders like run_sql. fetch says whether it returns
+        rows. Keeps count of how often it's run and how long that takes.
+
+        example:
+
+        GET_NAME = Query("get_name", "SELECT name FROM users WHERE id=%s;", fetch=True)
+        dbc.run_query(GET_NAME, [user_id])
+    """
+
+    def __init__(self, name, sql, fetch=False):
+        StatementStats.__init__(self, name)
+        self.sql = sql
+        self.fetch = fetch
+        parts = sql.split("%s")
+        self.num_params = len(parts) - 1
+        statement = parts[0]
+        for num, part in enumerate(parts[1:]):
+            statement += "$%d%s" % (num + 1, part)
+        # No parameters are passed with these so psycopg2 leaves % alone.
+        self.prepare_sql = "PREPARE oa_%s AS %s" % (name, statement.replace("%%", "%"))
+        self.execute_sql = "EXECUTE oa_%s" % name
+        if self.num_params:
+            self.execute_sql += " (%s)" % ", ".join(["%s"] * self.num_params)
+
 
 class DbConn(object):
     """Manage a single database connection."""
@@ -41,10 +206,17 @@ class DbConn(object):
         L.info("DB Encoding is %s" % self.conn.encoding)
         if not self.conn:
             L.warn("DB relogin failed!")
-
-    def run_sql(self, sql, params=None, quiet=False):
-        """ Execute SQL commands over the connection. """
+        self.broken = False
+        self.last_used = time.time()
+        self.prepared = set()   # names of the Query's prepared on this connection
+
+    def run_sql(self, sql, params=None, quiet=False, fetch=None):
+        """ Execute SQL commands over the connection.
+            If fetch isn't given, we guess whether there are rows to return
+            from the SQL.
+        """
 #        L.error("DB SQL '%s' (%s) quiet=%s" % (sql, repr(params), quiet))
+        begin = time.time()
         try:
             cur = self.conn.cursor()
             if not params:
@@ -52,55 +224,245 @@ class DbConn(object):
             else:
                 rec = cur.execute(sql, params)
 
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+            # The connection itself is probably gone, have the pool replace it
+            self.broken = True
+            L.error("DB Connection Error (%s) '%s' (%s)" % (err, sql, repr(params)))
+            raise
         except BaseException as err:
             if not quiet:
                 L.error("DB Error (%s) '%s' (%s)" % (err, sql, repr(params)))
                 raise
             return None
 
-        if (sql.split()[0].upper() in ("SELECT", "SHOW", "DESC", "DESCRIBE")
-                or "RETURNING" in sql.upper()):
+        if fetch is None:
+            fetch = (sql.split()[0].upper() in ("SELECT", "SHOW", "DESC", "DESCRIBE")
+                     or "RETURNING" in sql.upper())
+        if fetch:
             recset = cur.fetchall()
-            cur.close()
-            return recset
+            rows = len(recset)
         else:
+            recset = rec
+            rows = cur.rowcount
+        cur.close()
+        elapsed = time.time() - begin
+        statement_stats(sql).record(elapsed, rows)
+        Profiling.record_sql(sql, elapsed, rows)
+        _log_if_slow(elapsed, sql, params, rows)
+        return recset
+
+    def run_query(self, query, params=None):
+        """ Execute a Query, preparing it first if this connection hasn't
+            seen it before.
+        """
+        begin = time.time()
+        cur = self.conn.cursor()
+        try:
+            try:
+                try:
+                    self._execute_prepared(cur, query, params)
+                except psycopg2.Error as err:
+                    # Something reset the session and forgot it, or we forgot it.
+                    if err.pgcode == errorcodes.INVALID_SQL_STATEMENT_NAME:
+                        self.prepared.discard(query.name)
+                    elif err.pgcode == errorcodes.DUPLICATE_PREPARED_STATEMENT:
+                        self.prepared.add(query.name)
+                    else:
+                        raise
+                    self._execute_prepared(cur, query, params)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as err:
+                self.broken = True
+                L.error("DB Connection Error (%s) '%s' (%s)" % (err, query.name, repr(params)))
+                raise
+            except BaseException as err:
+                L.error("DB Error (%s) '%s' (%s)" % (err, query.name, repr(params)))
+                raise
+            if query.fetch:
+                res = cur.fetchall()
+                rows = len(res)
+            else:
+                res = None
+                rows = cur.rowcount
+        finally:
             cur.close()
-            return rec
+        elapsed = time.time() - begin
+        query.record(elapsed, rows)
+        Profiling.record_sql(query.name, elapsed, rows)
+        _log_if_slow(elapsed, query.name, params, rows)
+        return res
+
+    def _execute_prepared(self, cur, query, params):
+        if query.name not in self.prepared:
+            cur.execute(query.prepare_sql)
+            self.prepared.add(query.name)
+        if query.num_params:
+            cur.execute(query.execute_sql, params)
+        else:
+            cur.execute(query.execute_sql)
+
+    def is_healthy(self, max_idle=None):
+        """ Check the connection is still usable. This is cheap unless it's
+            been idle longer than max_idle seconds, in which case we ping the
+            server since it may have dropped us without psycopg2 noticing.
+        """
+        if self.broken or self.conn.closed:
+            return False
+        if self.conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if max_idle is not None and time.time() - self.last_used > max_idle:
+            try:
+                cur = self.conn.cursor()
+                cur.execute("SELECT 1;")
+                cur.close()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                return False
+        return True
+
+    def close(self):
+        """ Close the connection, ignoring any errors since it's probably
+            already broken.
+        """
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+
+
+class DbPoolTimeout(Exception):
+    """ Timed out waiting for a free database connection.
+    """
+
+    pass
 
 
 class DbPool(object):
     """ Manage a pool of DbConn.
         users should grab a database connection with start(), run sql
         commands with run_sql() and then release it back to the pool with
-        finish(). 
-        Will initialise the pool with the given number of parallel connections.
+        finish().
+        Will initialise the pool with minsize parallel connections, growing on
+        demand up to maxsize. Connections are health checked when they're
+        handed out and broken ones are replaced.
 
         example:
 
-        dbpool = DbPool("dbname=oasis user=oasisuser",10)
+        dbpool = DbPool("dbname=oasis user=oasisuser", 3, 10)
         dbc = dbpool.start()
         dbc.run_sql("SELECT * FROM users WHERE user=%s;", userid)
         dbpool.finish(dbc)
     """
 
-    def __init__(self, connectstring, size):
-        self.size = size
-        self.connqueue = Queue.Queue(size)
-        for _ in range(0, size):
+    def __init__(self, connectstring, minsize, maxsize=None, timeout=30, max_idle=60):
+        """ timeout is how long (seconds) start() will wait for a connection
+            before raising DbPoolTimeout. Connections idle longer than max_idle
+            seconds are pinged before being handed out.
+        """
+        if not maxsize or maxsize < minsize:
+            maxsize = minsize
+        self.connectstring = connectstring
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.connqueue = Queue.Queue(maxsize)
+        self.size = 0
+        self._reset_stats()
+        for _ in range(0, minsize):
             self.connqueue.put(DbConn(connectstring))
+            self.size += 1
+
+    def _reset_stats(self):
+        """ Zero the usage counters. """
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.use_total = 0.0
+        self.use_max = 0.0
+        self.timeouts = 0
+        self.replaced = 0
+        self.wait_histogram = Histogram()
+
+    def _grow(self):
+        """ Create a new connection if we're allowed to, otherwise None.
+        """
+        with self.lock:
+            if self.size >= self.maxsize:
+                return None
+            self.size += 1
+        try:
+            dbc = DbConn(self.connectstring)
+        except psycopg2.Error as err:
+            with self.lock:
+                self.size -= 1
+            L.error("DB Pool unable to add connection: %s" % err)
+            return None
+        L.info("DB Pool grown to %d connections" % self.size)
+        return dbc
+
+    def _replace(self, dbc):
+        """ Swap a broken connection for a new one. If we can't reconnect the
+            pool shrinks and the error is raised.
+        """
+        dbc.close()
+        with self.lock:
+            self.replaced += 1
+        try:
+            return DbConn(self.connectstring)
+        except psycopg2.Error:
+            with self.lock:
+                self.size -= 1
+            raise
 
     def start(self):
-        """Fetch a db connection from the pool (will block until one becomes
-           available), and begin a transaction on it.
+        """Fetch a db connection from the pool, and begin a transaction on it.
+           Will create a new connection if none are free and we're below
+           maxsize, otherwise wait up to timeout seconds for one.
         """
-        if self.connqueue.qsize() < 3:
-            L.info("DB Pool getting low! %d" % self.connqueue.qsize())
-        dbc = self.connqueue.get(True)
+        begin = time.time()
+        try:
+            dbc = self.connqueue.get(False)
+        except Queue.Empty:
+            dbc = self._grow()
+            if not dbc:
+                L.info("DB Pool exhausted, waiting. %d" % self.size)
+                try:
+                    dbc = self.connqueue.get(True, self.timeout)
+                except Queue.Empty:
+                    with self.lock:
+                        self.timeouts += 1
+                    L.error("DB Pool timed out after %ss waiting for a connection." % self.timeout)
+                    raise DbPoolTimeout("No database connection free after %ss" % self.timeout)
+        if not dbc.is_healthy(self.max_idle):
+            L.warn("DB Pool replacing broken connection.")
+            dbc = self._replace(dbc)
+        now = time.time()
+        waited = now - begin
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.wait_histogram.add(waited)
+        dbc.checkout_time = now
         return dbc
 
     def finish(self, dbc):
-        """Put the db connection back in the pool."""
-        # TODO: check for errors and reset connection if any
+        """Put the db connection back in the pool. Broken connections are
+           replaced, or dropped if we can't reconnect right now.
+        """
+        now = time.time()
+        used = now - getattr(dbc, "checkout_time", now)
+        dbc.last_used = now
+        with self.lock:
+            self.use_total += used
+            self.use_max = max(self.use_max, used)
+        if dbc.broken:
+            L.warn("DB Pool replacing connection that failed while in use.")
+            try:
+                dbc = self._replace(dbc)
+            except psycopg2.Error as err:
+                L.error("DB Pool unable to reconnect: %s" % err)
+                return
         self.connqueue.put(dbc)
 
     def __len__(self):
@@ -115,13 +477,34 @@ class DbPool(object):
         """
         return self.size
 
+    def stats(self):
+        """ Usage statistics, for monitoring.
+        :return: dict : times are in seconds.
+        """
+        with self.lock:
+            checkouts = self.checkouts
+            return {
+                'size': self.size,
+                'free': self.connqueue.qsize(),
+                'min': self.minsize,
+                'max': self.maxsize,
+                'checkouts': checkouts,
+                'wait_avg': self.wait_total / checkouts if checkouts else 0.0,
+                'wait_max': self.wait_max,
+                'use_avg': self.use_total / checkouts if checkouts else 0.0,
+                'use_max': self.use_max,
+                'timeouts': self.timeouts,
+                'replaced': self.replaced,
+                'wait_histogram': self.wait_histogram.buckets()
+            }
+
 
 # noinspection PyUnusedLocal
 class FakeMCConn(object):
     """ Dummy memcached connector for when we don't want to use memcached.
     """
 
-    def __init__(self, connectstring):
+    def __init__(self, connectstring, timeout=None, retry=None):
         L.info("Starting dummy memcached interface.")
 
     # noinspection PyMethodMayBeStatic
@@ -134,6 +517,21 @@ class FakeMCConn(object):
         """Return nothing. """
         return None
 
+    # noinspection PyMethodMayBeStatic
+    def get_multi(self, keys):
+        """Return nothing. """
+        return {}
+
+    # noinspection PyMethodMayBeStatic
+    def set_multi(self, mapping, expiry=None):
+        """Pretend to store items. """
+        return []
+
+    # noinspection PyMethodMayBeStatic
+    def incr(self, key, delta=1, expiry=None, initial=None):
+        """Pretend to count. """
+        return None
+
     # noinspection PyMethodMayBeStatic
     def delete(self, key):
         """Do nothing."""
@@ -145,141 +543,401 @@ class FakeMCConn(object):
         """
         return None
 
+    # noinspection PyMethodMayBeStatic
+    def flush_all(self):
+        """ Do nothing
+        """
+        return None
+
+    # noinspection PyMethodMayBeStatic
+    def new_generation(self):
+        """ Do nothing
+        """
+        return True
+
+    # noinspection PyMethodMayBeStatic
+    def is_dead(self):
+        """ Never down. """
+        return False
+
 
 class MCConn(object):
     """ Look after a connection to a memcached server.
-        Just a simple wrapper with some logging. """
+        Just a simple wrapper with some logging. The memcache client keeps
+        a separate socket per thread, so this can be shared between threads.
+        Errors are raised for MCPool to deal with.
+    """
 
-    def __init__(self, connectstring):
+    def __init__(self, connectstring, timeout=None, retry=None):
 
-        self.conn = memcache.Client([connectstring], debug=0)
+        kwargs = {'debug': 0}
+        if timeout:
+            kwargs['socket_timeout'] = timeout
+        if retry:
+            kwargs['dead_retry'] = retry
+        self.connectstring = connectstring
+        self.conn = memcache.Client([connectstring], **kwargs)
         if not self.conn:
             L.error("Memcache login failed!")
+        self.gen_key = ("%s-generation" % uniqueKey).encode("utf-8")
+        self.generation = None
+        self.gen_checked = 0
+
+    def _generation(self):
+        """ The generation our keys are in on this server. Starts from the
+            time, so one that has been lost doesn't come back as one that's
+            been used before.
+        """
+        now = time.time()
+        if self.generation is None or now - self.gen_checked > GENERATION_CHECK:
+            gen = self.conn.get(self.gen_key)
+            if gen is None:
+                self.conn.add(self.gen_key, int(now))
+                gen = self.conn.get(self.gen_key)
+            if gen is not None:
+                self.generation = int(gen)
+                self.gen_checked = now
+        return self.generation or 0
+
+    def new_generation(self):
+        """ Move to a new generation, which drops all our keys on this
+            server. Other processes follow within GENERATION_CHECK seconds.
+            Returns True if it worked.
+        """
+        gen = self.conn.incr(self.gen_key)
+        if gen is None:
+            self.conn.add(self.gen_key, int(time.time()))
+            gen = self.conn.get(self.gen_key)
+        if gen is None:
+            return False
+        self.generation = int(gen)
+        self.gen_checked = time.time()
+        return True
+
+    def _key(self, key):
+        """ Our keys are prefixed so several installs can share a server. """
+        key = "%s-g%s-%s" % (uniqueKey, self._generation(), key)
+        return key.encode("utf-8")
 
     def set(self, key, value, expiry=None):
         """ store item. """
         if disable_mc_cache:
             return True
-        key = "%s-%s" % (uniqueKey, key)
-        key = key.encode("utf-8")
-        try:
-            if expiry:
-                res = self.conn.set(key, value, expiry)
-            else:
-                res = self.conn.set(key, value)
-            L.info("OaPool:MCConn:set(%s, %s, %s)" % (key, value, expiry))
-        except BaseException as err:
-            # it's possible that something went wrong
-            L.error("Memcache Error. (%s)" % err)
-            return False
-
+        key = self._key(key)
+        if expiry:
+            res = self.conn.set(key, value, expiry)
+        else:
+            res = self.conn.set(key, value)
+        L.info("OaPool:MCConn:set(%s, %s, %s)" % (key, value, expiry))
         return res
 
     def get(self, key):
         """ fetch item."""
         if disable_mc_cache:
             return None
-        key = "%s-%s" % (uniqueKey, key)
-        key = key.encode("utf-8")
-        try:
-            res = self.conn.get(key)
+        return self.conn.get(self._key(key))
 
-        except BaseException as err:
-            # it's possible that something went wrong
-            L.error("Memcache Error. (%s)" % err)
-            return False
+    def get_multi(self, keys):
+        """ fetch several items, returns a dict of those found. """
+        if disable_mc_cache:
+            return {}
+        prefix = self._key("")
+        return self.conn.get_multi([k.encode("utf-8") for k in keys], key_prefix=prefix)
 
+    def set_multi(self, mapping, expiry=None):
+        """ store several items. Returns the list of keys that failed. """
+        if disable_mc_cache:
+            return []
+        prefix = self._key("")
+        safe = dict([(k.encode("utf-8"), v) for k, v in mapping.iteritems()])
+        return self.conn.set_multi(safe, expiry or 0, key_prefix=prefix)
+
+    def incr(self, key, delta=1, expiry=None, initial=None):
+        """ add delta to a counter, starting it at initial (default delta)
+            if it's not there. Returns the new value.
+        """
+        if disable_mc_cache:
+            return None
+        if initial is None:
+            initial = delta
+        key = self._key(key)
+        res = self.conn.incr(key, delta)
+        if res is None:
+            if self.conn.add(key, initial, expiry or 0):
+                return initial
+            res = self.conn.incr(key, delta)  # someone else started it
         return res
 
     def delete(self, key):
         """ remove item."""
         if disable_mc_cache:
             return None
-        key = "%s-%s" % (uniqueKey, key)
-        key = key.encode("utf-8")
-        try:
-            res = self.conn.delete(key)
-
-        except IOError as err:
-            # it's possible that something went wrong
-            L.error("Memcache Error. (%s)" % err)
-            return False
-
-        return res
+        return self.conn.delete(self._key(key))
 
     def flush_all(self):
-        """ Clear the cache
+        """ Clear our keys from the cache. Other installs sharing the server
+            keep theirs.
         """
         if disable_mc_cache:
             return None
-        return self.conn.flush_all()
+        return self.new_generation()
 
+    def is_dead(self):
+        """ The memcache client marks a server dead for a while when it
+            can't reach it.
+        """
+        now = time.time()
+        return any(getattr(srv, "deaduntil", 0) > now for srv in self.conn.servers)
 
-# nowadays memcache-client comes with its own pool, but this works and I haven't
-# had time to evaluate the memcache one.
-class MCPool(object):
-    """ Look after a pool of connections to the memcached. As well as reducing
-        total number of connections used, libmemcache also doesn't appear to be
-        threadsafe, so this gives us some protection.
+
+class HashRing(object):
+    """ Consistent hashing of keys to servers, so adding or removing a
+        server only moves a small share of the keys.
     """
 
-    def __init__(self, connectstring, size):
-        """Call with the connection string and a number of
-           connections to put in the pool.
-        """
+    def __init__(self, nodes, replicas=100):
+        self.ring = []
+        for node in nodes:
+            for i in range(0, replicas):
+                self.ring.append((self._hash("%s-%d" % (node, i)), node))
+        self.ring.sort()
+        self.hashes = [h for h, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        """ Which node should look after the key. """
+        if not self.ring:
+            return None
+        pos = bisect.bisect(self.hashes, self._hash(key))
+        if pos == len(self.ring):
+            pos = 0
+        return self.ring[pos][1]
+
+
+class MCServer(object):
+    """ One memcached server, with a circuit breaker. After fail_threshold
+        errors in a row we stop talking to it for retry seconds and act as if
+        there were no cache. When it comes back we drop our keys on it (by
+        moving to a new generation), since any deletes sent while it was away
+        were lost.
+    """
 
-        self.connqueue = Queue.Queue(size)
-        self.size = size
-        for _ in range(0, size):
+    def __init__(self, conn, fail_threshold, retry):
+        self.conn = conn
+        self.fail_threshold = fail_threshold
+        self.retry = retry
+        self.failures = 0
+        self.open_until = 0
+        self.tripped = False
+        self.lock = threading.Lock()
+
+    def available(self):
+        """ Should we be sending requests to it? """
+        if not self.tripped:
+            return True
+        if time.time() < self.open_until:
+            return False
+        with self.lock:
+            if not self.tripped:
+                return True
+            # Half open, try it again.
             try:
-                if not OaConfig.memcache_enable:
-                    mc = FakeMCConn
-                else:
-                    mc = MCConn
-            except AttributeError:
+                ok = self.conn.new_generation() and not self.conn.is_dead()
+            except BaseException as err:
+                L.error("Memcache Error. (%s)" % err)
+                ok = False
+            if not ok:
+                self.open_until = time.time() + self.retry
+                return False
+            L.warn("Memcache server %s back, dropped our old keys." %
+                   getattr(self.conn, "connectstring", ""))
+            self.tripped = False
+            self.failures = 0
+        return True
+
+    def succeeded(self):
+        """ Record that a request worked. """
+        if self.failures:
+            self.failures = 0
+
+    def failed(self):
+        """ Record that a request failed, maybe tripping the breaker. """
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.fail_threshold and not self.tripped:
+                self.tripped = True
+                self.open_until = time.time() + self.retry
+                L.error("Memcache server %s unavailable, not using it for %ss." %
+                        (getattr(self.conn, "connectstring", ""), self.retry))
+
+
+class MCPool(object):
+    """ Look after our memcached servers. Keys are spread over the servers
+        by consistent hashing. Each server has a circuit breaker so if it goes
+        down we carry on as if the cache was empty rather than waiting on it.
+
+        Nothing is serialized through a queue any more: the memcache client
+        keeps a separate connection per thread.
+    """
+
+    def __init__(self, servers, size=None, timeout=None, fail_threshold=5, retry=30):
+        """ servers can be a "host:port" string, a comma separated list of
+            them, or a list. size is ignored and only kept for compatibility.
+            timeout is the socket timeout in seconds.
+        """
+        if isinstance(servers, basestring):
+            servers = [srv.strip() for srv in servers.split(",") if srv.strip()]
+        try:
+            if not OaConfig.memcache_enable:
+                mc = FakeMCConn
+            else:
                 mc = MCConn
-            self.connqueue.put(mc(connectstring))
+        except AttributeError:
+            mc = MCConn
+        self.fake = FakeMCConn("")
+        self.servers = {}
+        for srv in servers:
+            self.servers[srv] = MCServer(mc(srv, timeout, retry), fail_threshold, retry)
+        self.ring = HashRing(self.servers.keys())
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+        self.histogram = Histogram()
+
+    def _server(self, key):
+        """ The MCServer responsible for the key, or None if it's down. """
+        srv = self.servers.get(self.ring.get_node(key))
+        if srv and srv.available():
+            return srv
+        return None
+
+    def _call(self, srv, method, default, *args):
+        """ Run the request against the server, tracking failures. """
+        if not srv:
+            return getattr(self.fake, method)(*args)
+        begin = time.time()
+        try:
+            res = getattr(srv.conn, method)(*args)
+        except BaseException as err:
+            L.error("Memcache Error. (%s)" % err)
+            srv.failed()
+            with self.lock:
+                self.errors += 1
+            return default
+        elapsed = time.time() - begin
+        with self.lock:
+            self.requests += 1
+            self.histogram.add(elapsed)
+        Profiling.record("memcache", elapsed)
+        if srv.conn.is_dead():
+            srv.failed()
+        else:
+            srv.succeeded()
+        return res
+
+    def _count(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
 
     def get(self, key):
         """Get an item from the cache. """
-        if self.connqueue.qsize() < 3:
-            L.warn("Memcache Pool getting low! %d" % self.connqueue.qsize())
-        dbc = self.connqueue.get(True)
-        res = dbc.get(key)
-        self.connqueue.put(dbc)
+        res = self._call(self._server(key), "get", None, key)
+        if res is None:
+            self._count(0, 1)
+        else:
+            self._count(1, 0)
         return res
 
     def set(self, key, value, expiry=None):
         """Put an item into the cache. """
-        dbc = self.connqueue.get(True)
-        res = dbc.set(key, value, expiry)
-        self.connqueue.put(dbc)
-        return res
+        return self._call(self._server(key), "set", False, key, value, expiry)
 
     def delete(self, key):
         """Remove an item from the cache. """
-        dbc = self.connqueue.get(True)
-        res = dbc.delete(key)
-        self.connqueue.put(dbc)
-        return res
+        return self._call(self._server(key), "delete", False, key)
+
+    def incr(self, key, delta=1, expiry=None, initial=None):
+        """ Add delta to a counter in the cache, creating it at initial
+            (default delta) if needed.
+            Returns the new value, or None if the cache isn't available.
+        """
+        return self._call(self._server(key), "incr", None, key, delta, expiry, initial)
+
+    def get_multi(self, keys):
+        """ Get several items from the cache with one request per server.
+            Returns a dict of the ones found.
+        """
+        byserver = {}
+        for key in keys:
+            byserver.setdefault(self.ring.get_node(key), []).append(key)
+        found = {}
+        for node, nkeys in byserver.iteritems():
+            srv = self.servers.get(node)
+            if srv and not srv.available():
+                srv = None
+            res = self._call(srv, "get_multi", {}, nkeys)
+            if res:
+                found.update(res)
+        self._count(len(found), len(keys) - len(found))
+        return found
+
+    def set_multi(self, mapping, expiry=None):
+        """ Put several items into the cache with one request per server.
+            Returns a list of keys that weren't stored.
+        """
+        byserver = {}
+        for key, value in mapping.iteritems():
+            byserver.setdefault(self.ring.get_node(key), {})[key] = value
+        failed = []
+        for node, nmapping in byserver.iteritems():
+            srv = self.servers.get(node)
+            if srv and not srv.available():
+                srv = None
+            res = self._call(srv, "set_multi", nmapping.keys(), nmapping, expiry)
+            if res:
+                failed += res
+        return failed
 
     def flush_all(self):
         """ Clear the cache
         """
-
-        dbc = self.connqueue.get(True)
-        res = dbc.flush_all()
-        self.connqueue.put(dbc)
-        return res
+        for srv in self.servers.values():
+            self._call(srv if srv.available() else None, "flush_all", None)
 
     def __len__(self):
         """
-        :return: integer : the number of free entries in the pool.
+        :return: integer : the number of servers currently in use.
         """
-        return self.connqueue.qsize()
+        return len([srv for srv in self.servers.values() if not srv.tripped])
 
     def total(self):
         """
-        :return: integer : the number of db connections.
+        :return: integer : the number of memcached servers.
         """
-        return self.size
+        return len(self.servers)
+
+    def stats(self):
+        """ Usage statistics, for monitoring. Lookups made while a server
+            is unavailable count as misses.
+        :return: dict
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'servers': len(self.servers),
+                'up': len(self),
+                'requests': self.requests,
+                'errors': self.errors,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'histogram': self.histogram.buckets()
+            }
@@ -7,11 +7,11 @@
 """
 
 import re
-from oasis.lib import General
+from oasis.lib import General, Questions
 
 from oasis.lib.Permissions import check_perm
 from oasis.lib.OaExceptions import OaMarkerError
-from . import DB, Topics
+from . import DB, Topics, Stats
 from logging import getLogger
 
 L = getLogger("oasisqe")
@@ -89,13 +89,17 @@ def get_sorted_qlist_wstats(course_id, topic_id, user_id=None):
     questions = [question for question in questionlist
                  if question['position'] > 0]
     questions.sort(cmp_question_position)
+    qt_ids = [question['qtid'] for question in questions]
+    recent = DB.get_student_qts_practice_stats(user_id, qt_ids, 3)
+    class_stats = Stats.get_course_prac_summaries(course_id, qt_ids)
+    student_stats = Stats.get_student_prac_summaries(user_id, qt_ids)
     for question in questions:
         try:
             question['maxscore'] = DB.get_qt_maxscore(question['qtid'])
         except KeyError:
             question['maxscore'] = 0
 
-        stats_1 = DB.get_student_q_practice_stats(user_id, question['qtid'], 3)
+        stats_1 = recent.get(question['qtid'])
         if stats_1:  # Last practices
             # Date of last practice
             question['age'] = stats_1[(len(stats_1) - 1)]['age']
@@ -117,7 +121,7 @@ def get_sorted_qlist_wstats(course_id, topic_id, user_id=None):
             question['stats'] = stats_1
         else:
             question['stats'] = None
-        stats_2 = DB.get_q_stats_class(course_id, question['qtid'])
+        stats_2 = class_stats.get(question['qtid'])
         if not stats_2:  # no stats, make some up
             stats_2 = {'num': 0, 'max': 0, 'min': 0, 'avg': 0}
             percentage = 0
@@ -127,7 +131,7 @@ def get_sorted_qlist_wstats(course_id, topic_id, user_id=None):
             else:
                 percentage = int(stats_2['avg'] / stats_2['max'] * 100)
         question['classpercent'] = str(percentage) + "%"
-        user_stats = DB.get_prac_stats_user_qt(user_id, question['qtid'])
+        user_stats = student_stats.get(question['qtid'])
         if not user_stats:
             indivpercentage = 0
         else:
@@ -192,6 +196,7 @@ def get_next_prev_pos(qt_id, topic_id):
 def mark_q(user_id, topic_id, q_id, request):
     """Mark the question and return the results"""
     answers = {}
+    guesses = []
     for i in request.form.keys():
         part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
         if part:
@@ -200,19 +205,29 @@ def mark_q(user_id, topic_id, q_id, request):
             if newqid == q_id:
                 value = request.form[i]
                 answers["G%d" % part] = value
-                DB.save_guess(newqid, part, value)
+                guesses.append((newqid, part, value))
             else:
                 L.warn("received guess for wrong question? (%d,%d,%d,%s)" %
                        (user_id, topic_id, q_id, request.form))
+    DB.save_guesses(guesses)
+    qctx = Questions.get_context(q_id)
+    first_mark = DB.get_q_marktime(q_id) is None
+    old_score = None
+    if not first_mark:
+        old_score = DB.get_q_score(q_id)
     try:
-        marks = General.mark_q(q_id, answers)
+        marks = General.mark_q(qctx, answers)
         DB.set_q_status(q_id, 3)    # 3 = marked
-        DB.set_q_marktime(q_id)
+        if first_mark:
+            # Keep the first, the practice stats have already counted it in
+            # that hour.
+            DB.set_q_marktime(q_id)
+            Stats.count_practice()
     except OaMarkerError:
         L.warn("Marker Error - (%d, %d, %d, %s)" %
                (user_id, topic_id, q_id, request.form))
         marks = {}
-    q_body = General.render_mark_results(q_id, marks)
+    q_body = General.render_mark_results(qctx, marks)
     parts = [int(var[1:])
              for var in marks.keys()
              if re.search(r"^A([0-9]+)$", var) > 0]
@@ -223,4 +238,10 @@ def mark_q(user_id, topic_id, q_id, request):
             total += float(marks['M%d' % (part,)])
     DB.update_q_score(q_id, total)    # 3 = marked
     DB.set_q_status(q_id, 2)
+    if first_mark:
+        if marks:
+            Stats.record_practice(q_id)
+    elif old_score is not None and old_score != DB.get_q_score(q_id):
+        # The summaries already have it, with the score it had before.
+        Stats.rescore_practice(q_id, old_score)
     return q_body
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" Profiling.py
+    Where the time goes in a single request.
+
+    start() begins collecting for the current thread and stop() returns what
+    was collected. In between, the database and memcache pools report each
+    statement and request with record_sql() and record(), and functions
+    wrapped with @timed report their time. When nothing is being profiled
+    these cost a thread local lookup.
+"""
+
+import threading
+import time
+from functools import wraps
+
+_local = threading.local()
+
+
+class RequestProfile(object):
+    """ What one request spent its time on. Times are in seconds. """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.wall = None
+        self.counts = {}   # category: calls
+        self.times = {}    # category: seconds
+        self.sql = {}      # statement: [calls, seconds, rows]
+
+    def add(self, category, seconds):
+        self.counts[category] = self.counts.get(category, 0) + 1
+        self.times[category] = self.times.get(category, 0.0) + seconds
+
+    def add_sql(self, statement, seconds, rows):
+        self.add("sql", seconds)
+        entry = self.sql.setdefault(statement, [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        if rows and rows > 0:
+            entry[2] += rows
+
+    def finish(self):
+        self.wall = time.time() - self.start
+
+    def summary(self):
+        """ One line: wall time and calls/time for each category. """
+        parts = ["%s %.1fms" % (self.name, (self.wall or 0.0) * 1000)]
+        for category in sorted(self.counts):
+            parts.append("%s=%d/%.1fms" % (category, self.counts[category],
+                                            self.times[category] * 1000))
+        return " ".join(parts)
+
+    def report(self, top=20):
+        """ The summary, then the statements that took longest in total. """
+        lines = [self.summary()]
+        stmts = sorted(self.sql.items(), key=lambda item: item[1][1], reverse=True)
+        for statement, (calls, seconds, rows) in stmts[:top]:
+            lines.append("    %7.1fms %4dx rows=%-5d %s" %
+                         (seconds * 1000, calls, rows, " ".join(statement.split())[:300]))
+        if len(stmts) > top:
+            lines.append("    ... %d more statements" % (len(stmts) - top))
+        return "\n".join(lines)
+
+
+def start(name):
+    """ Start profiling the current thread. """
+    _local.profile = RequestProfile(name)
+    return _local.profile
+
+
+def stop():
+    """ Stop profiling the current thread. Returns the RequestProfile, or
+        None if we weren't.
+    """
+    profile = getattr(_local, "profile", None)
+    _local.profile = None
+    if profile:
+        profile.finish()
+    return profile
+
+
+def active():
+    """ The RequestProfile being collected in this thread, or None. """
+    return getattr(_local, "profile", None)
+
+
+def record(category, seconds):
+    """ Count a call in the given category, if we're profiling. """
+    profile = getattr(_local, "profile", None)
+    if profile:
+        profile.add(category, seconds)
+
+
+def record_sql(statement, seconds, rows=None):
+    """ Count a database statement, if we're profiling. """
+    profile = getattr(_local, "profile", None)
+    if profile:
+        profile.add_sql(statement, seconds, rows)
+
+
+def timed(category):
+    """ Decorator that records the time spent in the function under
+        category, if we're profiling.
+    """
+    def decorator(func):
+        @wraps(func)
+        def call_fn(*args, **kwargs):
+            profile = getattr(_local, "profile", None)
+            if not profile:
+                return func(*args, **kwargs)
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.add(category, time.time() - begin)
+        return call_fn
+    return decorator
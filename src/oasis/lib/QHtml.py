@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" QHtml.py
+    Question HTML, parsed once into literal text and placeholders so it can
+    be filled in with a single pass.
+
+    There are two stages:
+
+    QTemplateHtml - the question template's qtemplate.html, with tags like
+        <ANSWER1 MULTI a,b,c> and <VAL A>, filled in with the variables of
+        a variation when it's generated.
+
+    QInstanceHtml - the generated qtemplate.html of a variation, with the
+        form field names, previous answers (VAL_1, Oa_CHK_1_2, ...) and
+        attachment URLs filled in each time it's displayed.
+
+    The source of both never changes for a given version, so the parsed
+    forms are kept in DB.COMPILED_CACHE.
+"""
+
+import re
+import random
+import jinja2
+
+from oasis.lib import OaConfig, DB
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+# Placeholder kinds
+T_MULTIF = 1
+T_MULTI = 2
+T_MULTIV = 3
+T_SELECT = 4
+T_VAL = 5
+T_IMGSRC = 6
+T_ATTSRC = 7
+I_ANS = 10
+I_VAL = 11
+I_SEL = 12
+I_CHK = 13
+I_INPUT = 14
+I_SELECT = 15
+
+_QT_TAGS = re.compile(
+    r'<IMG SRC>'
+    r'|<ANSWER(?P<sized>[0-9]+) (?P<size>[0-9]+)>'
+    r'|<ANSWER(?P<text>[0-9]+) TEXT>'
+    r'|<ANSWER(?P<plain>[0-9]+)>'
+    r'|<ANSWER(?P<choice>[0-9]+) (?P<ctype>MULTIF|MULTIV|MULTI|SELECT) (?P<params>[^>]*)>'
+    r'|<(?P<vtype>VAL|IMG SRC|ATT SRC) (?P<var>[^>]*)>')
+
+_CHOICE_TYPES = {"MULTIF": T_MULTIF,
+                 "MULTI": T_MULTI,
+                 "MULTIV": T_MULTIV,
+                 "SELECT": T_SELECT}
+
+_VAR_TYPES = {"VAL": T_VAL,
+              "IMG SRC": T_IMGSRC,
+              "ATT SRC": T_ATTSRC}
+
+_INST_TAGS = re.compile(
+    r'ANS_'
+    r'|VAL_(?P<val>[0-9]+)'
+    r'|Oa_(?P<otype>SEL|CHK)_(?P<ques>[0-9]+)_(?P<part>[0-9]+)'
+    r'|<INPUT '
+    r'|<SELECT ')
+
+NOT_VERIFIED = "This question is not verified yet, please report any error!"
+
+
+def multi_f_html(answer, paramlist, qvars):
+    """ HTML for <ANSWERn MULTIF a,b,c,d,e> (radio buttons, in order)
+    """
+    pout = ["", ]
+    if paramlist:
+        pout = ["", ]
+        pcount = 0
+        for param in paramlist:
+            pcount += 1
+            if param in qvars:
+                pout += ["<td CLASS='multichoicecell'>"]
+                pout += ["<INPUT class='auto_save' TYPE='radio' NAME='ANS_%d' VALUE='%d' Oa_CHK_%d_%d>%s</td>" % (
+                    answer, pcount, answer, pcount, qvars[param])]
+            else:
+                pout += ["""<FONT COLOR="red">ERROR IN QUESTION DATA</FONT>"""]
+
+    ret = "<table border=0><tr><td>Please choose one:</td>"
+    ret += ''.join(pout)
+    ret += "</tr></table><br />\n"
+    return ret
+
+
+def multi_v_html(answer, paramlist, qvars):
+    """ HTML for <ANSWERn MULTIV a,b,c,d> (radio buttons, in order, listed
+        vertically)
+    """
+    pout = ["", ]
+    if paramlist:
+        pout = ["", ]
+        pcount = 0
+        for param in paramlist:
+            pcount += 1
+            pt = 'abcdefghijklmnopqrstuvwxyz'[pcount - 1]
+            if param in qvars:
+                pout += ["<tr><th>%s)</th><td>" % pt, ]
+                pout += "<INPUT class='auto_save' TYPE='radio' NAME='ANS_%d' VALUE='%d' Oa_CHK_%d_%d>" % (
+                    answer, pcount, answer, pcount)
+                pout += "</td><td CLASS='multichoicecell'> %s</td></tr>" % qvars[param]
+
+            else:
+                pout += ["""<tr><td>&nbsp;</td><td><FONT COLOR="red">ERROR IN QUESTION DATA</FONT></td></tr>"""]
+    ret = "<table border=0><tr><th>Please choose one:</th></tr>"
+    ret += ''.join(pout)
+    ret += "</table><br />\n"
+    return ret
+
+
+def multi_html(answer, paramlist, qvars, shuffle=True):
+    """ HTML for <ANSWERn MULTI a,b,c,d> (radio buttons)
+    """
+    pout = ["", ]
+    if paramlist:
+        pout = ["", ]
+        pcount = 0
+        for param in paramlist:
+            pcount += 1
+            if param in qvars:
+                pout += [
+                    "<td CLASS='multichoicecell'>",
+                    "<INPUT class='auto_save' TYPE='radio' NAME='ANS_%d' VALUE='%d' Oa_CHK_%d_%d> %s</td>" % (
+                        answer, pcount, answer, pcount, qvars[param])]
+            else:
+                pout += ["""<FONT COLOR="red">ERROR IN QUESTION DATA</FONT>"""]
+        # randomise the order in the list at least a little bit
+    if shuffle:
+        random.shuffle(pout)
+    ret = "<table border=0><tr><th>Please choose one:</th>"
+    ret += ''.join(pout)
+    ret += "</tr></table><br />\n"
+    return ret
+
+
+def listbox_html(answer, paramlist, qvars, shuffle=True):
+    """ HTML for <ANSWERn SELECT a,b,c,d,e> (SELECT box)
+    """
+    pout = ["", ]
+    if paramlist:
+        pout = ["", ]
+        pcount = 0
+        for param in paramlist:
+            pcount += 1
+            if param in qvars:
+                pout += ["""<OPTION VALUE='%d' Oa_SEL_%d_%d>%s</OPTION>""" %
+                         (pcount, answer, pcount, qvars[param])]
+            else:
+                pout += ["""<OPTION><FONT COLOR="red">ERROR IN QUESTION DATA</FONT></OPTION>"""]
+        # this should randomise the order in the list at least a little bit
+    if shuffle:
+        random.shuffle(pout)
+    ret = """<SELECT class='auto_save' NAME='ANS_%d'>Please choose:""" % answer
+    ret += """<OPTION VALUE='None'>--Choose--</OPTION>"""
+    ret += ''.join(pout)
+    ret += "</SELECT>\n"
+    return ret
+
+
+class QTemplateHtml(object):
+    """ A question template's qtemplate.html, ready to have the variables of
+        a variation filled in.
+    """
+
+    def __init__(self, html):
+        """ Split the html into literal text and placeholder tuples. Tags
+            that can be filled in without the variables are done now.
+        """
+        tokens = []
+        pos = 0
+        for match in _QT_TAGS.finditer(html):
+            tokens.append(html[pos:match.start()])
+            pos = match.end()
+            grp = match.groupdict()
+            if grp['sized']:
+                tokens.append("""<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' SIZE='%s' VALUE="VAL_%s"/>""" %
+                              (grp['sized'], grp['size'], grp['sized']))
+            elif grp['text']:
+                tokens.append("""<TEXTAREA class='auto_save' NAME='ANS_%s' ROWS=6 COLS=100>VAL_%s</TEXTAREA>""" %
+                              (grp['text'], grp['text']))
+            elif grp['plain']:
+                tokens.append("""<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' VALUE="VAL_%s"/>""" %
+                              (grp['plain'], grp['plain']))
+            elif grp['choice']:
+                tokens.append((_CHOICE_TYPES[grp['ctype']],
+                               int(grp['choice']),
+                               grp['params'].split(',')))
+            elif grp['vtype']:
+                tokens.append((_VAR_TYPES[grp['vtype']],
+                               grp['var'],
+                               match.group(0)))
+            else:
+                tokens.append('<IMG SRC="$IMAGES$image.gif" />')
+        tokens.append(html[pos:])
+        self.tokens = [tok for tok in tokens if tok != ""]
+        self.size = len(html) * 2
+
+    def render(self, qvars, shuffle=True):
+        """ Return the html with the given variables filled in.
+            Multiple choice options are shuffled, unless shuffle is False.
+        """
+        out = []
+        for tok in self.tokens:
+            if isinstance(tok, basestring):
+                out.append(tok)
+                continue
+            kind = tok[0]
+            if kind == T_MULTIF:
+                out.append(multi_f_html(tok[1], tok[2], qvars))
+            elif kind == T_MULTI:
+                out.append(multi_html(tok[1], tok[2], qvars, shuffle))
+            elif kind == T_MULTIV:
+                out.append(multi_v_html(tok[1], tok[2], qvars))
+            elif kind == T_SELECT:
+                out.append(listbox_html(tok[1], tok[2], qvars, shuffle))
+            elif tok[1] not in qvars:
+                out.append(tok[2])  # leave it as it was
+            elif kind == T_VAL:
+                out.append('%s' % (qvars[tok[1]],))
+            elif kind == T_IMGSRC:
+                out.append('<IMG SRC="$STATIC$%s" />' % (qvars[tok[1]],))
+            elif kind == T_ATTSRC:
+                out.append('<A HREF="$STATIC$%s" TARGET="_new">%s(View in New Window)</a>' %
+                           (qvars[tok[1]], qvars[tok[1]]))
+        return ''.join(out)
+
+
+class QInstanceHtml(object):
+    """ The generated qtemplate.html of a variation, ready to have the
+        question ID and student's answers filled in for display.
+    """
+
+    def __init__(self, html, qt_id, version, variation):
+        """ Split the (unicode) html into literal text and placeholder tuples.
+            The attachment URLs only depend on the variation so are filled
+            in now.
+        """
+        html = html.replace(NOT_VERIFIED, "")
+        qatt = u"%s/att/qatt/%s/%s/%s/" % (OaConfig.parentURL, qt_id, version, variation)
+        qtatt = u"%s/att/qtatt/%s/%s/%s/" % (OaConfig.parentURL, qt_id, version, variation)
+        tokens = []
+        pos = 0
+        for match in _INST_TAGS.finditer(html):
+            tokens.append(html[pos:match.start()])
+            pos = match.end()
+            grp = match.groupdict()
+            text = match.group(0)
+            if grp['val']:
+                tokens.append((I_VAL, "G%d" % int(grp['val'])))
+            elif grp['otype']:
+                part = int(grp['part'])
+                tokens.append((I_SEL if grp['otype'] == "SEL" else I_CHK,
+                               "G%d" % int(grp['ques']),
+                               ("%s" % part, "%s.0" % part)))
+            elif text == "ANS_":
+                tokens.append((I_ANS,))
+            elif text == "<INPUT ":
+                tokens.append((I_INPUT,))
+            else:
+                tokens.append((I_SELECT,))
+        tokens.append(html[pos:])
+        self.tokens = []
+        for tok in tokens:
+            if isinstance(tok, basestring):
+                if tok == "":
+                    continue
+                tok = tok.replace("$IMAGES$", qatt)
+                tok = tok.replace("$APPLET$", qatt)
+                tok = tok.replace("$STATIC$", qtatt)
+            self.tokens.append(tok)
+        self.size = len(html) * 2
+
+    def render(self, q_id, guesses, readonly=False):
+        """ Return the html for the question, with the given guesses
+            ({"G1": "3", ...}) filled in. If readonly, the fields can't be
+            changed.
+        """
+        ans = u"Q_%d_ANS_" % (q_id,)
+        out = []
+        for tok in self.tokens:
+            if isinstance(tok, basestring):
+                out.append(tok)
+                continue
+            kind = tok[0]
+            if kind == I_ANS:
+                out.append(ans)
+            elif kind == I_VAL:
+                guess = guesses.get(tok[1])
+                # noinspection PyComparisonWithNone,PyPep8
+                if guess == None or guess == "None":  # If it's 0 we want to leave it alone
+                    guess = ""
+                out.append(jinja2.escape(guess))
+            elif kind == I_SEL or kind == I_CHK:
+                if guesses.get(tok[1]) in tok[2]:
+                    out.append(u"SELECTED" if kind == I_SEL else u"CHECKED")
+            elif kind == I_INPUT:
+                out.append(u"<INPUT READONLY " if readonly else u"<INPUT ")
+            elif kind == I_SELECT:
+                out.append(u"<SELECT DISABLED=DISABLED STYLE='color: black;'" if readonly else u"<SELECT ")
+        return u''.join(out)
+
+
+def get_template(qt_id, version):
+    """ Return the QTemplateHtml for the question template version,
+        or None if it doesn't have a qtemplate.html
+    """
+    key = ("qtemplate", qt_id, version)
+    found, tmpl = DB.COMPILED_CACHE.get(key)
+    if found:
+        return tmpl
+    html = DB.get_qt_att(qt_id, "qtemplate.html", version)
+    if not html:
+        return None
+    tmpl = QTemplateHtml(html)
+    DB.COMPILED_CACHE.set(key, tmpl, tmpl.size)
+    return tmpl
+
+
+def get_instance(qt_id, version, variation):
+    """ Return the QInstanceHtml for the variation, or None if it doesn't
+        have a qtemplate.html
+    """
+    key = ("qinstance", qt_id, version, variation)
+    found, inst = DB.COMPILED_CACHE.get(key)
+    if found:
+        return inst
+    data = DB.get_q_att(qt_id, "qtemplate.html", variation, version)
+    if not data:
+        return None
+    try:
+        html = unicode(data, "utf-8")
+    except UnicodeDecodeError:
+        try:
+            html = unicode(data, "latin-1")
+        except UnicodeDecodeError as err:
+            L.error("unicode error decoding qtemplate for qt_id %s variation %s: %s" %
+                    (qt_id, variation, err))
+            raise
+    inst = QInstanceHtml(html, qt_id, version, variation)
+    DB.COMPILED_CACHE.set(key, inst, inst.size)
+    return inst
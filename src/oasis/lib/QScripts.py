@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" QScripts.py
+    Question template scripts (__marker.py, __results.py), compiled once per
+    (qt_id, version) and run with a limit on how long they can take.
+
+    When compiled, a call to a "tick" function is put at the top of every
+    loop body and function, which stops the script once it has used up its
+    time or its steps (loop iterations and function calls). A script stuck in
+    one long builtin call can't be stopped this way, but the builtins scripts
+    are given don't include anything that runs for long.
+"""
+
+import ast
+import time
+
+from oasis.lib import OaConfig, DB
+from oasis.lib.OaExceptions import OaScriptLimitError
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+TICK = "__oa_tick__"
+
+
+class _AddTicks(ast.NodeTransformer):
+    """ Put a call to TICK at the start of each loop body and function. """
+
+    @staticmethod
+    def _tick(node):
+        call = ast.Expr(value=ast.Call(func=ast.Name(id=TICK, ctx=ast.Load()),
+                                       args=[], keywords=[],
+                                       starargs=None, kwargs=None))
+        pos = 0
+        if isinstance(node, ast.FunctionDef) and ast.get_docstring(node, clean=False) is not None:
+            pos = 1  # after the docstring, so it's still one
+        node.body.insert(pos, ast.copy_location(call, node.body[0]))
+        return node
+
+    def visit_For(self, node):
+        self.generic_visit(node)
+        return self._tick(node)
+
+    def visit_While(self, node):
+        self.generic_visit(node)
+        return self._tick(node)
+
+    def visit_FunctionDef(self, node):
+        self.generic_visit(node)
+        return self._tick(node)
+
+
+class _Budget(object):
+    """ The TICK function for one run of a script. Keeps raising
+        OaScriptLimitError once the limits are passed, so a script that
+        catches it stops at the next loop or call anyway.
+    """
+
+    def __init__(self, name, max_seconds, max_steps):
+        self.name = name
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.deadline = time.time() + max_seconds
+        self.steps = 0
+
+    def __call__(self):
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise OaScriptLimitError("%s stopped after %s steps" %
+                                     (self.name, self.max_steps))
+        if time.time() > self.deadline:
+            raise OaScriptLimitError("%s stopped after %s seconds" %
+                                     (self.name, self.max_seconds))
+
+
+class QScript(object):
+    """ A compiled question script.
+    """
+
+    def __init__(self, source, name="<script>"):
+        """ Compile the source. A script that doesn't compile raises its
+            SyntaxError when run, like exec would.
+        """
+        self.name = name
+        self.size = len(source)
+        self.code = None
+        self.error = None
+        try:
+            if TICK in source:
+                raise SyntaxError("%s is a reserved name" % TICK)
+            tree = ast.parse(source, name)
+            tree = ast.fix_missing_locations(_AddTicks().visit(tree))
+            self.code = compile(tree, name, "exec")
+        except SyntaxError as err:
+            self.error = err
+
+    def run(self, namespace, max_seconds=None, max_steps=None):
+        """ exec the script in the given namespace (dictionary), which
+            should have __builtins__ set to what the script may use.
+            Raises OaScriptLimitError if it takes too long, or anything the
+            script raises.
+        """
+        if self.error:
+            raise self.error
+        if max_seconds is None:
+            max_seconds = OaConfig.script_max_seconds
+        if max_steps is None:
+            max_steps = OaConfig.script_max_steps
+        budget = _Budget(self.name, max_seconds, max_steps)
+        builtins = namespace.get("__builtins__")
+        if isinstance(builtins, dict):
+            builtins[TICK] = budget
+        else:
+            namespace[TICK] = budget
+        try:
+            exec(self.code, namespace)
+        except OaScriptLimitError as err:
+            L.warn("Question script limit reached: %s" % err)
+            raise
+
+
+def get_script(qt_id, name, version=None):
+    """ Return the QScript for the question template attachment, or None if
+        there isn't one. If version isn't given, the latest is used.
+    """
+    if version is None:
+        version = DB.get_qt_version(qt_id)
+    key = ("script", qt_id, name, version)
+    found, script = DB.COMPILED_CACHE.get(key)
+    if found:
+        return script
+    source = DB.get_qt_att(qt_id, name, version)
+    if not source:
+        return None
+    script = QScript(source, "%s (qtemplate %s, version %s)" % (name, qt_id, version))
+    if script.error:
+        L.warn("Unable to compile %s: %s" % (script.name, script.error))
+    DB.COMPILED_CACHE.set(key, script, script.size * 4)
+    return script
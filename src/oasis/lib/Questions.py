@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# This code is under the GNU Affero General Public License
+# http://www.gnu.org/licenses/agpl-3.0.html
+
+""" Questions.py
+    Information about question instances, gathered up so the rendering and
+    marking code doesn't have to go back to the database for each piece.
+"""
+
+from flask import g, has_request_context
+
+from oasis.lib import DB
+from oasis.lib.DB import run_sql
+from logging import getLogger
+
+L = getLogger("oasisqe")
+
+
+class QuestionContext(object):
+    """ The parent template, version, variation, marker and status of a
+        question instance, loaded with one query. The variables come from
+        the template cache (see DB.get_qt_variation).
+
+        Use get_context() rather than creating these directly, so they're
+        shared for the life of the request.
+    """
+
+    def __init__(self, q_id):
+        """ Load the question from the database or raise KeyError.
+        """
+        assert isinstance(q_id, int)
+        sql = """SELECT q.qtemplate, q.version, q.variation, q.status,
+                        q.student, q.exam, qt.marker
+                 FROM questions AS q
+                 LEFT JOIN qtemplates AS qt ON qt.qtemplate = q.qtemplate
+                 WHERE q.question = %s;"""
+        ret = run_sql(sql, [q_id, ])
+        if not ret:
+            raise KeyError("Question %s not found" % q_id)
+        row = ret[0]
+        self.id = q_id
+        self.qt_id = int(row[0]) if row[0] is not None else None
+        self.version = int(row[1]) if row[1] is not None else None
+        self.variation = int(row[2]) if row[2] is not None else None
+        self.status = int(row[3]) if row[3] is not None else None
+        self.student = row[4]
+        self.exam = row[5]
+        self.marker = int(row[6]) if row[6] is not None else None
+
+    def qvars(self):
+        """ Return a copy of the question variables, or None if there aren't
+            any. It's a copy since the markers modify them as they go.
+        """
+        if not self.qt_id or self.variation is None or self.version is None:
+            return None
+        return DB.get_qt_variation(self.qt_id, self.variation, self.version)
+
+
+def get_context(q_id):
+    """ Return the QuestionContext for the question. Within a Flask request it
+        is only loaded once, later calls get the same object.
+    """
+    if isinstance(q_id, QuestionContext):
+        return q_id
+    q_id = int(q_id)
+    if not has_request_context():
+        return QuestionContext(q_id)
+    contexts = getattr(g, "_question_contexts", None)
+    if contexts is None:
+        contexts = {}
+        g._question_contexts = contexts
+    if q_id not in contexts:
+        contexts[q_id] = QuestionContext(q_id)
+    return contexts[q_id]
@@ -3,8 +3,11 @@
     Functionality for importing and exporting spreadsheets.
 """
 
-from oasis.lib import Courses, Exams, Users2
-from openpyxl.writer.excel import save_virtual_workbook
+import csv
+import tempfile
+from StringIO import StringIO
+
+from oasis.lib import Courses, Exams
 from openpyxl.workbook import Workbook
 
 from logging import getLogger
@@ -12,71 +15,73 @@ from logging import getLogger
 
 L = getLogger("oasisqe")
 
+# Size of the pieces a spreadsheet is sent to the browser in.
+CHUNK_SIZE = 64 * 1024
 
-def exam_results_as_spreadsheet(course_id, group, exam_id):
-    """ Export the assessment results as a XLSX spreadsheet """
 
+def exam_results_rows(course_id, group, exam_id):
+    """ Generate the rows of the assessment results export, a few heading
+        rows and then one for each student, sorted by family name.
+    """
     course = Courses.get_course(course_id)
     exam = Exams.get_exam_struct(exam_id, course_id)
-
-    uids = set([])
-    totals = {}
-
-    results = Exams.get_marks(group, exam_id)
-    for user_id in results:
-        uids.add(user_id)
-        if user_id not in totals:
-            totals[user_id] = 0.0
-        for qt, val in results[user_id].iteritems():
-            totals[user_id] += val['score']
-
     questions = Exams.get_qts_list(exam_id)
-    users = {}
-    for uid in uids:
-        users[uid] = Users2.get_user(uid)
-
-    wb = Workbook()
-
-    ws = wb.get_active_sheet()
-
-    ws.title = "Results"
-
-    ws.cell(row=1, column=0).value = course['name']
-    ws.cell(row=1, column=1).value = course['title']
-    ws.cell(row=2, column=0).value = "Assessment:"
-    ws.cell(row=2, column=1).value = exam['title']
-    ws.cell(row=3, column=0).value = "Group:"
-    ws.cell(row=3, column=1).value = group.name
-
-    col = 5
-    qcount = 1
-    for _ in questions:
-        ws.cell(row=4, column=col).value = "Q%s" % qcount
-        qcount += 1
-        col += 1
-
-    ws.cell(row=4, column=col).value = "Total"
-
-    row = 5
-    sortusers = users.keys()
-    sortusers.sort(key=lambda us: users[us]['familyname'])
-
-    for user_id in sortusers:
-        result = results[user_id]
-        ws.cell(row=row, column=0).value = users[user_id]['uname']
-        ws.cell(row=row, column=1).value = users[user_id]['student_id']
-        ws.cell(row=row, column=2).value = users[user_id]['familyname']
-        ws.cell(row=row, column=3).value = users[user_id]['givenname']
-        ws.cell(row=row, column=4).value = users[user_id]['email']
-        col = 5
 
+    yield [course['name'], course['title']]
+    yield ["Assessment:", exam['title']]
+    yield ["Group:", group.name]
+    yield [None] * 5 + ["Q%s" % (qcount + 1) for qcount in range(len(questions))] + ["Total"]
+
+    for student in Exams.get_group_results(group, exam_id):
+        scores = student['scores']
+        row = [student['uname'],
+               student['student_id'],
+               student['familyname'],
+               student['givenname'],
+               student['email']]
         for pos in questions:
             for qt in pos:
-                if qt['id'] in result:
-                    ws.cell(row=row, column=col).value = result[qt['id']]['score']
-                    col += 1
+                if qt['id'] in scores:
+                    row.append(scores[qt['id']])
+        row.append(sum([score for score in scores.values() if score]))
+        yield row
+
 
-        ws.cell(row=row, column=col).value = totals[user_id]
-        row += 1
+def exam_results_as_csv(course_id, group, exam_id):
+    """ Export the assessment results as CSV, generated a line at a time. """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in exam_results_rows(course_id, group, exam_id):
+        writer.writerow([val.encode("utf-8") if isinstance(val, unicode) else val
+                         for val in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
 
-    return save_virtual_workbook(wb)
+
+def exam_results_as_spreadsheet(course_id, group, exam_id):
+    """ Export the assessment results as a XLSX spreadsheet, generated in
+        pieces. The rows are written out to a temporary file as they are
+        made rather than held in memory.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="Results")
+    for row in exam_results_rows(course_id, group, exam_id):
+        ws.append(row)
+
+    tmpf = tempfile.TemporaryFile()
+    wb.save(tmpf)
+    tmpf.seek(0)
+    return _read_chunks(tmpf)
+
+
+def _read_chunks(fileobj):
+    """ Generate the contents of the file a piece at a time, then close it. """
+    try:
+        while True:
+            data = fileobj.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        fileobj.close()
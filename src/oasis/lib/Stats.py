@@ -9,51 +9,102 @@
     other components to use.
 """
 
+import math
 from datetime import datetime, timedelta
 import DB
+from DB import MC
 
 
-def prac_q_count(year, month, day, hour, qtemplate):
-    """ Fetch the practice count for the given time/qtemplate or return
-        False if not found. Can be used when deciding if to INSERT or UPDATE.
-        Note: may return 0 if count is zero, is not same as not exist (False)
+# config entry holding the marktime practice stats are up to
+HWM_NAME = "stats_prac_marktime"
+
+# Questions marked in the last minute may still be being saved, leave them
+# for the next update.
+LAG = timedelta(minutes=1)
+
+# How long the live per minute practice counters are kept in memcache.
+LIVE_TIME = 3 * 60 * 60
+
+
+def count_practice():
+    """ Count a practice question being marked, for the live load figures.
+        These are only kept in memcache, stats_prac_q_course is worked out
+        from the questions themselves by update_prac_stats().
     """
-    sql = """SELECT "qtemplate", "hour", "day", "month", "year", "number", "when"
-                FROM stats_prac_q_course
-                 WHERE hour=%s
-                 AND month=%s
-                 AND day=%s
-                 AND year=%s
-                 AND qtemplate=%s;"""
-    params = [hour, month, day, year, qtemplate]
-    res = DB.run_sql(sql, params)
-    if not res or len(res) == 0:
-        return False
-    return int(res[0][0])
+    MC.incr("prac-count-%s" % datetime.now().strftime("%Y%m%d%H%M"), 1, LIVE_TIME)
 
 
-def add_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
-    """ Insert a practice count for the given time/qtemplate """
-    sql = """INSERT INTO stats_prac_q_course ("qtemplate", "hour", "day",
-                                              "month", "year", "number",
-                                              "when", "avgscore")
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);"""
-    params = [qtemplate,  hour, day,
-              month, year, count,
-              datetime(year=year, hour=hour, day=day, month=month), avgscore]
-    DB.run_sql(sql, params)
+def live_prac_load(minutes=60):
+    """ Return a list of (time, count) of practice questions marked each
+        minute, for the last few minutes up to now. Counts are 0 if memcache
+        isn't available.
+    """
+    now = datetime.now()
+    times = [(now - timedelta(minutes=ago)).strftime("%Y%m%d%H%M")
+             for ago in range(minutes - 1, -1, -1)]
+    found = MC.get_multi(["prac-count-%s" % when for when in times])
+    return [("%s-%s-%s %s:%s" % (when[0:4], when[4:6], when[6:8], when[8:10], when[10:12]),
+             int(found.get("prac-count-%s" % when, 0)))
+            for when in times]
 
 
-def update_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
-    """ Insert a practice count for the given time/qtemplate """
-    sql = """UPDATE stats_prac_q_course SET "number" = %s, "avgscore" = %s
-                 WHERE hour=%s
-                 AND month=%s
-                 AND day=%s
-                 AND year=%s
-                 AND qtemplate=%s;"""
-    params = [count, avgscore, hour, month, day, year, qtemplate]
-    DB.run_sql(sql, params)
+def update_prac_stats(end=None):
+    """ Bring the practice stats in stats_prac_q_course and the daily totals
+        in stats_prac_daily up to date. Only the hours (or days, for the
+        daily totals) since the last update are recalculated, so it is cheap
+        enough to run every few minutes. The first time, it goes through the
+        whole database.
+    """
+    if not end:
+        end = datetime.now() - LAG
+    end = end.strftime("%Y-%m-%d %H:%M:%S")
+    # The hour the last update stopped in is redone, since it will have only
+    # been partly done.
+    start = """COALESCE((SELECT date_trunc('hour', "value"::timestamp)
+                         FROM config WHERE "name" = '%s'),
+                        '1990-01-01'::timestamp)""" % HWM_NAME
+    # No INSERT .. ON CONFLICT before PostgreSQL 9.5, and the table has no
+    # unique key, so replace the hours being redone. Sent together these
+    # run in one transaction, and the lock stops two updates overlapping.
+    sql = """LOCK TABLE stats_prac_q_course IN EXCLUSIVE MODE;
+             DELETE FROM stats_prac_q_course
+                 WHERE "when" >= %(start)s;
+             INSERT INTO stats_prac_q_course ("qtemplate", "hour", "day",
+                                              "month", "year", "number",
+                                              "when", "avgscore")
+                 SELECT qtemplate,
+                        EXTRACT(HOUR FROM date_trunc('hour', marktime)),
+                        EXTRACT(DAY FROM date_trunc('hour', marktime)),
+                        EXTRACT(MONTH FROM date_trunc('hour', marktime)),
+                        EXTRACT(YEAR FROM date_trunc('hour', marktime)),
+                        COUNT(question),
+                        date_trunc('hour', marktime),
+                        AVG(score)
+                 FROM questions
+                 WHERE (exam = '0' OR exam IS NULL)
+                   AND marktime >= %(start)s
+                   AND marktime < %%s::timestamp
+                 GROUP BY qtemplate, date_trunc('hour', marktime);
+             DELETE FROM stats_prac_daily
+                 WHERE "day" >= date_trunc('day', %(start)s);
+             INSERT INTO stats_prac_daily ("day", "qtemplate", "number")
+                 SELECT marktime::date, qtemplate, COUNT(question)
+                 FROM questions
+                 WHERE (exam = '0' OR exam IS NULL)
+                   AND marktime >= date_trunc('day', %(start)s)
+                   AND marktime < %%s::timestamp
+                 GROUP BY marktime::date, qtemplate;
+             INSERT INTO stats_prac_daily ("day", "qtemplate", "number")
+                 SELECT "day", 0, SUM("number")
+                 FROM stats_prac_daily
+                 WHERE "day" >= date_trunc('day', %(start)s)
+                 GROUP BY "day";
+             UPDATE config SET "value" = %%s WHERE "name" = '%(hwm)s';
+             INSERT INTO config ("name", "value")
+                 SELECT '%(hwm)s', %%s
+                 WHERE NOT EXISTS (SELECT 1 FROM config
+                                   WHERE "name" = '%(hwm)s');""" % {'start': start, 'hwm': HWM_NAME}
+    DB.run_sql(sql, [end, end, end, end])
 
 
 def populate_prac_q_count(start=None, end=None):
@@ -62,175 +113,264 @@ def populate_prac_q_count(start=None, end=None):
          If start not given, go back to the start of the database. If end not
          given go until now.
     """
-    if not end:
-        end = datetime.now()
-    if not start:
-        start = datetime(2000, 1, 1)
-
-    sql = """ SELECT COUNT(question) AS practices,
-                EXTRACT (YEAR FROM marktime) as year,
-                     EXTRACT (MONTH FROM marktime) as month,
-                     EXTRACT (DAY FROM marktime) as day,
-                     EXTRACT (HOUR FROM marktime) as hour,
-                     qtemplate AS qtemplate,
-                     AVG(score) AS avgscore
-              FROM questions
-              WHERE (exam = '0' or exam is null)
-              AND marktime >= %s
-              AND marktime <= %s
-              GROUP BY
-                     EXTRACT (YEAR FROM marktime),
-                     EXTRACT (MONTH FROM marktime),
-                     EXTRACT (DAY FROM marktime),
-                     EXTRACT (HOUR FROM marktime),
-                     qtemplate;
-                     """
-    params = [start, end]
-    res = DB.run_sql(sql, params)
-    if not res:
-        return False
+    if start:
+        # Recalculate from the start of that hour
+        start = start.replace(minute=0, second=0, microsecond=0)
+        start = start.strftime("%Y-%m-%d %H:%M:%S")
+        DB.run_sql("""UPDATE config SET "value" = %s WHERE "name" = %s;
+                      INSERT INTO config ("name", "value")
+                          SELECT %s, %s
+                          WHERE NOT EXISTS (SELECT 1 FROM config
+                                            WHERE "name" = %s);""",
+                   [start, HWM_NAME, HWM_NAME, start, HWM_NAME])
+    else:
+        DB.run_sql("""DELETE FROM config WHERE "name" = %s;""", [HWM_NAME, ])
+    update_prac_stats(end)
+
+
+def record_practice(q_id):
+    """ Add a newly marked practice question to the summaries of the
+        student's practice of that question template, and of the class's in
+        each course they are in, in stats_prac_student and
+        stats_prac_course. The class summaries only count practices that
+        took between 20 seconds and 2 hours, in the courses the student is
+        in when it's marked. Later enrolment changes don't move it.
+    """
+    assert isinstance(q_id, int)
+    # No INSERT .. ON CONFLICT before PostgreSQL 9.5, so update the summaries
+    # we have and add the ones we don't. Sent together these run in one
+    # transaction.
+    sql = """UPDATE stats_prac_student AS s
+                 SET number = s.number + 1,
+                     total = s.total + q.score,
+                     totalsq = s.totalsq + q.score * q.score,
+                     min = LEAST(s.min, q.score),
+                     max = GREATEST(s.max, q.score)
+                 FROM questions AS q
+                 WHERE q.question = %s
+                   AND q.score IS NOT NULL
+                   AND s.student = q.student
+                   AND s.qtemplate = q.qtemplate;
+             INSERT INTO stats_prac_student (student, qtemplate, number,
+                                             total, totalsq, min, max)
+                 SELECT q.student, q.qtemplate, 1,
+                        q.score, q.score * q.score, q.score, q.score
+                 FROM questions AS q
+                 WHERE q.question = %s
+                   AND q.score IS NOT NULL
+                   AND NOT EXISTS (SELECT 1 FROM stats_prac_student AS s
+                                   WHERE s.student = q.student
+                                     AND s.qtemplate = q.qtemplate);
+             UPDATE stats_prac_course AS s
+                 SET number = s.number + 1,
+                     total = s.total + q.score,
+                     totalsq = s.totalsq + q.score * q.score,
+                     min = LEAST(s.min, q.score),
+                     max = GREATEST(s.max, q.score)
+                 FROM questions AS q
+                 WHERE q.question = %s
+                   AND q.score IS NOT NULL
+                   AND (q.marktime - q.firstview) > '00:00:20'
+                   AND (q.marktime - q.firstview) < '02:00:01'
+                   AND s.qtemplate = q.qtemplate
+                   AND s.course IN (SELECT gc.course
+                                    FROM usergroups AS ug
+                                    JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                                    WHERE ug.userid = q.student);
+             INSERT INTO stats_prac_course (course, qtemplate, number,
+                                            total, totalsq, min, max)
+                 SELECT DISTINCT gc.course, q.qtemplate, 1,
+                        q.score, q.score * q.score, q.score, q.score
+                 FROM questions AS q
+                 JOIN usergroups AS ug ON ug.userid = q.student
+                 JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                 WHERE q.question = %s
+                   AND q.score IS NOT NULL
+                   AND (q.marktime - q.firstview) > '00:00:20'
+                   AND (q.marktime - q.firstview) < '02:00:01'
+                   AND NOT EXISTS (SELECT 1 FROM stats_prac_course AS s
+                                   WHERE s.course = gc.course
+                                     AND s.qtemplate = q.qtemplate);"""
+    try:
+        DB.run_sql(sql, [q_id, q_id, q_id, q_id])
+    except DB.IntegrityError:
+        # Another practice added the same summary at the same time, try
+        # again now it's there to update.
+        DB.run_sql(sql, [q_id, q_id, q_id, q_id])
+
+
+def rescore_practice(q_id, old_score):
+    """ A practice question already in the summaries has been marked again,
+        change its score in them from old_score to what it is now. The
+        totals are adjusted by the difference, min and max are worked out
+        again from the questions when the old score may have been one of
+        them.
+    """
+    assert isinstance(q_id, int)
+    old_score = float(old_score)
+    # Sent together these run in one transaction. The questions already have
+    # the new score, so the min and max worked out include it.
+    sql = """UPDATE stats_prac_student AS s
+                 SET total = s.total - o.score + q.score,
+                     totalsq = s.totalsq - o.score * o.score + q.score * q.score,
+                     min = CASE WHEN s.min < o.score THEN LEAST(s.min, q.score)
+                           ELSE (SELECT MIN(p.score)
+                                 FROM questions AS p
+                                 WHERE p.student = s.student
+                                   AND p.qtemplate = s.qtemplate
+                                   AND (p.exam = 0 OR p.exam IS NULL)
+                                   AND p.marktime IS NOT NULL
+                                   AND p.score IS NOT NULL) END,
+                     max = CASE WHEN s.max > o.score THEN GREATEST(s.max, q.score)
+                           ELSE (SELECT MAX(p.score)
+                                 FROM questions AS p
+                                 WHERE p.student = s.student
+                                   AND p.qtemplate = s.qtemplate
+                                   AND (p.exam = 0 OR p.exam IS NULL)
+                                   AND p.marktime IS NOT NULL
+                                   AND p.score IS NOT NULL) END
+                 FROM questions AS q, (SELECT %s::float AS score) AS o
+                 WHERE q.question = %s
+                   AND q.score IS NOT NULL
+                   AND s.student = q.student
+                   AND s.qtemplate = q.qtemplate;
+             UPDATE stats_prac_course AS s
+                 SET total = s.total - o.score + q.score,
+                     totalsq = s.totalsq - o.score * o.score + q.score * q.score,
+                     min = CASE WHEN s.min < o.score THEN LEAST(s.min, q.score)
+                           ELSE (SELECT MIN(p.score)
+                                 FROM questions AS p
+                                 WHERE p.qtemplate = s.qtemplate
+                                   AND (p.exam = 0 OR p.exam IS NULL)
+                                   AND p.score IS NOT NULL
+                                   AND (p.marktime - p.firstview) > '00:00:20'
+                                   AND (p.marktime - p.firstview) < '02:00:01'
+                                   AND p.student IN (SELECT ug.userid
+                                                     FROM usergroups AS ug
+                                                     JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                                                     WHERE gc.course = s.course)) END,
+                     max = CASE WHEN s.max > o.score THEN GREATEST(s.max, q.score)
+                           ELSE (SELECT MAX(p.score)
+                                 FROM questions AS p
+                                 WHERE p.qtemplate = s.qtemplate
+                                   AND (p.exam = 0 OR p.exam IS NULL)
+                                   AND p.score IS NOT NULL
+                                   AND (p.marktime - p.firstview) > '00:00:20'
+                                   AND (p.marktime - p.firstview) < '02:00:01'
+                                   AND p.student IN (SELECT ug.userid
+                                                     FROM usergroups AS ug
+                                                     JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                                                     WHERE gc.course = s.course)) END
+                 FROM questions AS q, (SELECT %s::float AS score) AS o
+                 WHERE q.question = %s
+                   AND q.score IS NOT NULL
+                   AND (q.marktime - q.firstview) > '00:00:20'
+                   AND (q.marktime - q.firstview) < '02:00:01'
+                   AND s.qtemplate = q.qtemplate
+                   AND s.course IN (SELECT gc.course
+                                    FROM usergroups AS ug
+                                    JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                                    WHERE ug.userid = q.student);"""
+    DB.run_sql(sql, [old_score, q_id, old_score, q_id])
+
+
+def _summary(row):
+    """ Turn (number, total, totalsq, min, max) into a dict of
+        {'num', 'count', 'avg', 'stddev', 'min', 'max'}
+    """
+    num = int(row[0])
+    avg = row[1] / num
+    stddev = 0.0
+    if num > 1:
+        stddev = math.sqrt(max(0.0, (row[2] - row[1] * row[1] / num) / (num - 1)))
+    return {'num': num,
+            'count': num,
+            'avg': avg,
+            'stddev': stddev,
+            'min': float(row[3]),
+            'max': float(row[4])}
+
+
+def get_student_prac_summaries(user_id, qt_ids):
+    """ Return the summaries of the student's practice of the given question
+        templates, {qt_id: {'num', 'avg', 'stddev', 'min', 'max'}}.
+        Those they haven't practiced are left out.
+    """
+    assert isinstance(user_id, int)
+    if not qt_ids:
+        return {}
+    ret = DB.run_sql("""SELECT qtemplate, number, total, totalsq, min, max
+                        FROM stats_prac_student
+                        WHERE student = %s
+                          AND qtemplate = ANY(%s);""", [user_id, list(qt_ids)])
+    return dict([(int(row[0]), _summary(row[1:])) for row in ret or []])
+
+
+def get_course_prac_summaries(course_id, qt_ids):
+    """ Return the summaries of the class's practice of the given question
+        templates, {qt_id: {'num', 'avg', 'stddev', 'min', 'max'}}.
+        Those nobody has practiced are left out.
+    """
+    assert isinstance(course_id, int)
+    if not qt_ids:
+        return {}
+    ret = DB.run_sql("""SELECT qtemplate, number, total, totalsq, min, max
+                        FROM stats_prac_course
+                        WHERE course = %s
+                          AND qtemplate = ANY(%s);""", [course_id, list(qt_ids)])
+    return dict([(int(row[0]), _summary(row[1:])) for row in ret or []])
+
+
+def _daily_series(res, start_time, end_time):
+    """ Turn ("day", "number") rows into a list of ("YYYY-MM-DD", count),
+        with 0 entries at the start and end so graphs scale correctly.
+    """
+    data = []
+    first = "%04d-%02d-%02d" % (start_time.year, start_time.month, start_time.day)
+    last = "%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day)
     for row in res:
-        data = {
-            'count': int(row[0]),
-            'year': int(row[1]),
-            'month': int(row[2]),
-            'day': int(row[3]),
-            'hour': int(row[4]),
-            'qtemplate': int(row[5]),
-            'avgscore': float(row[6])
-        }
-        exist_count = prac_q_count(data['year'],
-                                   data['month'],
-                                   data['day'],
-                                   data['hour'],
-                                   data['qtemplate'])
-        if exist_count is False:  # could be 0
-            add_prac_q_count(data['year'],
-                             data['month'],
-                             data['day'],
-                             data['hour'],
-                             data['qtemplate'],
-                             data['count'],
-                             data['avgscore'])
-        else:
-            update_prac_q_count(data['year'],
-                                data['month'],
-                                data['day'],
-                                data['hour'],
-                                data['qtemplate'],
-                                data['count'],
-                                data['avgscore'])
+        day = row[0].strftime("%Y-%m-%d")
+        if not data and day != first:
+            data.append((first, 0))
+        data.append((day, int(row[1])))
+    if data and not data[-1][0] == last:
+        data.append((last, 0))
+    return data
 
 
 def daily_prac_q_count(start_time, end_time, qt_id):
     """ Return a list of daily count of practices for the given qtemplate
         over the time period
     """
-    sql = """SELECT "year", "month", "day", sum("number")
-             FROM "stats_prac_q_course"
-             WHERE "qtemplate"=%s
-               AND "when" >= %s
-               AND "when" <= %s
-             GROUP BY "year","month","day"
-             ORDER BY "year","month","day" ASC;"""
-    params = [qt_id, start_time, end_time]
+    sql = """SELECT "day", "number"
+             FROM "stats_prac_daily"
+             WHERE "qtemplate" = %s
+               AND "day" >= %s
+               AND "day" <= %s
+             ORDER BY "day" ASC;"""
+    params = [qt_id, start_time.date(), end_time.date()]
     res = DB.run_sql(sql, params)
-    if not res:
-        res = []
-    data = []
-    first = True
-    for row in res:
-        if first:
-            # if the data doesn't start with a value,
-            # set a 0 entry so graphs scale correctly
-            if not (int(row[1]) == start_time.month
-                    and int(row[2]) == start_time.day
-                    and int(row[0] == start_time.year)):
-                data.append(("%04d-%02d-%02d" % (start_time.year, start_time.month, start_time.day), 0))
-            first = False
-
-        dt = datetime.strptime("%04d-%02d-%02d" % (int(row[0]), int(row[1]), int(row[2])), "%Y-%m-%d")
-        data.append((dt.strftime("%Y-%m-%d"), int(row[3])))
-
-    if len(res) >= 1 and not data[-1][0] == "%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day):
-        data.append(("%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day), 0))
-    return data
-#
-#
-# def daily_prac_q_scores(start_time, end_time, qt_id):
-#     """ Return a list of daily count of practices for the given qtemplate over
-#        the time period
-#     """
-#     sql = """SELECT "year", "month", "day", sum("number"), sum("avgscore")
-#              FROM "stats_prac_q_course"
-#              WHERE "qtemplate"=%s
-#                AND "when" >= %s
-#                AND "when" <= %s
-#              GROUP BY "year","month","day"
-#              ORDER BY "year","month","day" ASC;"""
-#     params = (qt_id, start_time, end_time)
-#     res = DB.run_sql(sql, params)
-#     if not res:
-#         res = []
-#     data = []
-#     first = True
-#     for row in res:
-#         if first: # if the data doesn't start with any values, set a 0 entry,
-#                   #  so graphs scale correctly
-#             if not (int(row[1]) == start_time.month
-#                     and int(row[2]) == start_time.day
-#                     and int(row[0] == start_time.year)):
-#
-#                 data.append(("%04d-%02d-%02d" % (start_time.year, start_time.month, start_time.day), 0))
-#             first = False
-#         dt = datetime.strptime("%04d-%02d-%02d" %(int(row[0]), int(row[1]), int(row[2])), "%Y-%m-%d")
-#         data.append((dt.strftime("%Y-%m-%d"), row[4] / row[3]))
-#     if len(res) >= 1 \
-#         and not data[-1][0] == "%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day):
-#
-#         data.append(("%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day), 0))
-#     return data
+    return _daily_series(res or [], start_time, end_time)
 
 
 def daily_prac_load(start_time, end_time):
     """ Return a list of daily counts of practices for the whole system """
-    sql = """SELECT "year", "month", "day", sum("number") from "stats_prac_q_course"
-             WHERE "when" >= %s
-               AND "when" <= %s
-             GROUP BY "year","month","day"
-             ORDER BY "year","month","day" ASC;"""
-    params = [start_time, end_time]
+    sql = """SELECT "day", "number"
+             FROM "stats_prac_daily"
+             WHERE "qtemplate" = 0
+               AND "day" >= %s
+               AND "day" <= %s
+             ORDER BY "day" ASC;"""
+    params = [start_time.date(), end_time.date()]
     res = DB.run_sql(sql, params)
-    if not res:
-        res = []
-    data = []
-    first = True
-    for row in res:
-        if first:
-            # if the data doesn't start with any values, set a 0 entry,
-            # so graphs scale correctly
-            if not (int(row[1]) == start_time.month
-                    and int(row[2]) == start_time.day
-                    and int(row[0] == start_time.year)):
-                data.append(("%04d-%02d-%02d" % (start_time.year, start_time.month, start_time.day), 0))
-            first = False
-        dt = datetime.strptime("%04d-%02d-%02d" % (int(row[0]), int(row[1]), int(row[2])), "%Y-%m-%d")
-        data.append((dt.strftime("%Y-%m-%d"), row[3]))
-    if len(res) >= 1 and not data[-1][0] == "%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day):
-
-        data.append(("%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day), 0))
-    return data
+    return _daily_series(res or [], start_time, end_time)
 
 
 def do_daily_stats_update():
-    """ To be run daily. Will update stats for the last few days to now.
-        Do the last two weeks, should cover most temporary outages
+    """ Bring the stats up to date. Despite the name this can be run as
+        often as wanted, only what has changed since last time is done.
     """
-
-    now = datetime.now()
-    twoweek = timedelta(days=14)
-    st = now-twoweek
-    populate_prac_q_count(start=st)
+    update_prac_stats()
 
 
 def do_initial_stats_update():
@@ -238,7 +378,4 @@ def do_initial_stats_update():
         Will update stats from the beginning of the database, to now.
         May take a while.
     """
-
-    now = datetime.now()
-    st = datetime(1990, 1, 1)
-    populate_prac_q_count(start=st, end=now)
+    populate_prac_q_count()
@@ -54,6 +54,74 @@ def get_topic(topic_id):
     return topic
 
 
+def get_many(topic_ids):
+    """ Fetch the topic dictionaries, as get_topic(), for several topics at
+        once, along with 'numquestions' as from get_num_qs().
+        Returns a dict keyed by topic id. Topics that don't exist are left out.
+
+        Cached values are fetched with one memcache request and anything
+        missing is loaded with one query.
+    """
+    topic_ids = [int(topic_id) for topic_id in topic_ids]
+    if not topic_ids:
+        return {}
+    reckeys = dict([("topic-%s-record" % tid, tid) for tid in topic_ids])
+    numkeys = dict([("topic-%s-numquestions" % tid, tid) for tid in topic_ids])
+    found = MC.get_multi(reckeys.keys() + numkeys.keys())
+    topics = {}
+    nums = {}
+    for key, obj in found.iteritems():
+        if key in reckeys:
+            topics[reckeys[key]] = json.loads(obj)
+        elif key in numkeys:
+            nums[numkeys[key]] = int(obj)
+
+    missing = [tid for tid in set(topic_ids)
+               if tid not in topics or tid not in nums]
+    if missing:
+        sql = """SELECT t.topic, t.course, t.title, t.visibility, t.position,
+                        t.archived,
+                        (SELECT COUNT(DISTINCT qt.position)
+                         FROM questiontopics AS qt
+                         WHERE qt.topic = t.topic
+                           AND qt.position > 0)
+                 FROM topics AS t
+                 WHERE t.topic = ANY(%s);"""
+        ret = run_sql(sql, [missing, ])
+        records = {}
+        numqs = {}
+        if ret:
+            for row in ret:
+                topic = {
+                    'id': row[0],
+                    'course': row[1],
+                    'title': row[2],
+                    'visibility': row[3],
+                    'position': row[4],
+                    'archived': row[5]
+                }
+                if topic['position'] is None or topic['position'] is "None":
+                    topic['position'] = 0
+                tid = int(row[0])
+                if tid not in topics:
+                    topics[tid] = topic
+                    records["topic-%s-record" % tid] = json.dumps(topic)
+                if tid not in nums:
+                    nums[tid] = int(row[6])
+                    numqs["topic-%s-numquestions" % tid] = nums[tid]
+        if records:
+            MC.set_multi(records)
+        if numqs:
+            MC.set_multi(numqs, 180)  # 3 minute cache, as get_num_qs
+
+    for tid, topic in topics.items():
+        if tid in nums:
+            topic['numquestions'] = nums[tid]
+        else:   # cached, but since deleted
+            del topics[tid]
+    return topics
+
+
 def get_name(topic_id):
     """Fetch the name of a topic."""
     return get_topic(topic_id)['title']
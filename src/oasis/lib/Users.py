@@ -10,14 +10,24 @@
 import hashlib
 import json
 import random
+import time
 from logging import getLogger
 import bcrypt
 
 from oasis.lib.DB import run_sql, MC
+from oasis.lib import Cache
 
 
 L = getLogger("oasisqe")
 
+# User records are kept in memcache, and for a little while in each
+# process. Changing a user bumps their version in memcache, which moves the
+# memcache copy to a new key, and drops the copy in this process. Other
+# processes notice within RECORD_LOCAL_TTL seconds.
+RECORD_LOCAL_TTL = 60
+RECORD_CACHE_TIME = 24 * 60 * 60
+RECORD_CACHE = Cache.LRUCache(4 * 1024 * 1024, ttl=RECORD_LOCAL_TTL)
+
 
 def get_version():
     """ Fetch the current version of the user table.
@@ -55,75 +65,143 @@ def incr_version():
     return -1
 
 
-def get_user_record(user_id):
-    """ Fetch info about the user
-        returns  {'id', 'uname', 'givenname', 'lastname', 'fullname', and more!}
-    """
-    # TODO: clear the cache entry when we change any of these values
-    key = "user-%s-record" % (user_id,)
-    obj = MC.get(key)
-    if obj:
-        return json.loads(obj)
-    sql = """SELECT id, uname, givenname, familyname, student_id,
-                    acctstatus, email, expiry, source, confirmed, display_name
-                    FROM users
-                    WHERE id=%s"""
-    params = [user_id, ]
-    ret = run_sql(sql, params)
-    if ret:
-        fullname = ""
-        display_name = ""
-        row = ret[0]
-        if row[1]:
-            uname = unicode(row[1], 'utf-8')
-        else:
-            uname = u""
-        if row[2]:
-            givenname = unicode(row[2], 'utf-8')
-        else:
-            givenname = u""
-        if row[3]:
-            familyname = unicode(row[3], 'utf-8')
+def _user_record(row):
+    """ Turn a row from the users table into our user record. """
+    user_id = int(row[0])
+    fullname = ""
+    display_name = ""
+    if row[1]:
+        uname = unicode(row[1], 'utf-8')
+    else:
+        uname = u""
+    if row[2]:
+        givenname = unicode(row[2], 'utf-8')
+    else:
+        givenname = u""
+    if row[3]:
+        familyname = unicode(row[3], 'utf-8')
+    else:
+        familyname = u""
+    if row[10]:
+        display_name = unicode(row[10], 'utf-8')
+    if len(givenname)>0 or len(familyname) > 0:
+        fullname = u"%s %s" % (givenname, familyname)
+
+    user_rec = {'id': user_id,
+                'uname': uname,
+                'givenname': givenname,
+                'familyname': familyname,
+                'fullname': fullname,
+                'student_id': row[4],
+                'acctstatus': row[5],
+                'email': row[6],
+                'expiry': row[7],
+                'source': row[8],
+                'confirmed': row[9],
+                'display_name': display_name
+                }
+    if row[9] is True \
+            or row[9] == "true" \
+            or row[9] == "TRUE" \
+            or row[9] == "" \
+            or row[9] is None:
+
+        user_rec['confirmed'] = True
+    else:
+        user_rec['confirmed'] = False
+
+    if not display_name:
+        if len(fullname) > 0:
+            user_rec['display_name'] = fullname
+        elif len(user_rec['email']) > 0:
+            user_rec['display_name'] = user_rec['email']
         else:
-            familyname = u""
-        if row[10]:
-            display_name = unicode(row[10], 'utf-8')
-        if len(givenname)>0 or len(familyname) > 0:
-            fullname = u"%s %s" % (givenname, familyname)
-
-        user_rec = {'id': user_id,
-                    'uname': uname,
-                    'givenname': givenname,
-                    'familyname': familyname,
-                    'fullname': fullname,
-                    'student_id': ret[0][4],
-                    'acctstatus': ret[0][5],
-                    'email': ret[0][6],
-                    'expiry': ret[0][7],
-                    'source': ret[0][8],
-                    'confirmed': ret[0][9],
-                    'display_name': display_name
-                    }
-        if ret[0][9] is True \
-                or ret[0][9] == "true" \
-                or ret[0][9] == "TRUE" \
-                or ret[0][9] == "" \
-                or ret[0][9] is None:
-
-            user_rec['confirmed'] = True
+            user_rec['display_name'] = "Unknown"
+    return user_rec
+
+
+def _record_versions(user_ids):
+    """ The version of each user's record, {user_id: version}. Users are
+        left out if memcache isn't available.
+        Versions start from the time rather than 0 so a counter that has been
+        evicted doesn't come back as a version that's been used before.
+    """
+    keys = dict([("user-%s-version" % user_id, user_id) for user_id in user_ids])
+    found = MC.get_multi(keys.keys())
+    versions = {}
+    for key, user_id in keys.items():
+        version = found.get(key)
+        if version is None:
+            version = MC.incr(key, 0, initial=int(time.time()))
+        if version is not None:
+            versions[user_id] = int(version)
+    return versions
+
+
+def _user_changed(user_id):
+    """ Something in their record changed, stop using cached copies.
+        A counter that has been evicted starts again from the time, not from
+        a version that may still be cached.
+    """
+    user_id = int(user_id)
+    RECORD_CACHE.delete(user_id)
+    MC.incr("user-%s-version" % user_id, initial=int(time.time()))
+
+
+def get_user_records(user_ids):
+    """ Fetch info about several users at once, from the cache where we can
+        and with one query for the rest.
+        returns {user_id: record} as from get_user_record(), leaving out any
+        that don't exist. user_ids may be strings (eg. from a form), the
+        returned ids are always ints.
+    """
+    records = {}
+    misses = []
+    for user_id in set([int(user_id) for user_id in user_ids]):
+        found, user_rec = RECORD_CACHE.get(user_id)
+        if found:
+            records[user_id] = user_rec
         else:
-            user_rec['confirmed'] = False
+            misses.append(user_id)
+    if not misses:
+        return records
+
+    versions = _record_versions(misses)
+    keys = dict([("user-%s-record-v%s" % (user_id, version), user_id)
+                 for user_id, version in versions.items()])
+    cached = MC.get_multi(keys.keys())
+    for key, obj in cached.items():
+        user_id = keys[key]
+        records[user_id] = json.loads(obj)
+        RECORD_CACHE.set(user_id, records[user_id], len(obj))
+    misses = [user_id for user_id in misses if user_id not in records]
+    if not misses:
+        return records
+
+    ret = run_sql("""SELECT id, uname, givenname, familyname, student_id,
+                            acctstatus, email, expiry, source, confirmed, display_name
+                     FROM users
+                     WHERE id = ANY(%s);""", [misses, ])
+    tocache = {}
+    for row in ret or []:
+        user_rec = _user_record(row)
+        user_id = user_rec['id']
+        records[user_id] = user_rec
+        obj = json.dumps(user_rec)
+        RECORD_CACHE.set(user_id, user_rec, len(obj))
+        if user_id in versions:
+            tocache["user-%s-record-v%s" % (user_id, versions[user_id])] = obj
+    if tocache:
+        MC.set_multi(tocache, RECORD_CACHE_TIME)
+    return records
 
-        if not display_name:
-            if len(fullname) > 0:
-                user_rec['display_name'] = fullname
-            elif len(user_rec['email']) > 0:
-                user_rec['display_name'] = user_rec['email']
-            else:
-                user_rec['display_name'] = "Unknown"
 
-        MC.set(key, json.dumps(user_rec))
-        return user_rec
+def get_user_record(user_id):
+    """ Fetch info about the user
+        returns  {'id', 'uname', 'givenname', 'lastname', 'fullname', and more!}
+        or None if they don't exist.
+    """
+    return get_user_records([user_id]).get(int(user_id))
 
 
 def set_password(user_id, clearpass):
@@ -323,6 +401,7 @@ def set_confirm(uid):
     """ The user has confirmed, mark their record."""
     run_sql("""UPDATE "users" SET confirmed='TRUE' WHERE id=%s;""", [uid, ])
     incr_version()
+    _user_changed(uid)
 
 
 def set_confirm_code(uid, code):
@@ -330,6 +409,7 @@ def set_confirm_code(uid, code):
     run_sql("""UPDATE "users" SET "confirmation_code" = %s WHERE "id" = %s;""",
             [code, uid])
     incr_version()
+    _user_changed(uid)
 
 
 def gen_confirm_code():
@@ -343,36 +423,40 @@ def set_studentid(uid, stid):
     """ Update student ID."""
     run_sql("""UPDATE "users" SET student_id = %s WHERE "id" = %s;""", [stid, uid])
     incr_version()
+    _user_changed(uid)
 
 
 def set_givenname(uid, name):
     """ Update Given Name."""
     run_sql("""UPDATE "users" SET givenname = %s WHERE "id" = %s;""", [name, uid])
     incr_version()
+    _user_changed(uid)
 
 
 def set_familyname(uid, name):
     """ Update Family Name."""
     run_sql("""UPDATE "users" SET familyname = %s WHERE "id" = %s;""", [name, uid])
     incr_version()
+    _user_changed(uid)
 
 
 def set_display_name(uid, name):
     """ Update Display Name."""
     run_sql("""UPDATE "users" SET display_name = %s WHERE "id" = %s;""", [name, uid])
     incr_version()
+    _user_changed(uid)
 
 
 def update_last_seen(uid,):
     """ Update Last Seen to now."""
     run_sql("""UPDATE "users" SET last_seen = NOW() WHERE "id" = %s;""", [uid,])
-    incr_version()
 
 
 def set_email(uid, email):
     """ Update Email."""
     run_sql("""UPDATE "users" SET email = %s WHERE "id" = %s;""", [email, uid])
     incr_version()
+    _user_changed(uid)
 
 
 # Human readable symbols
@@ -2,7 +2,12 @@
 
 from unittest import TestCase
 import datetime
-from oasis.lib import DB, Groups, Periods, Courses
+import json
+import os
+import shutil
+import tempfile
+import threading
+from oasis.lib import DB, Groups, Periods, Courses, Users, Permissions, Audit, OaConfig
 
 
 class TestGroups(TestCase):
@@ -115,3 +120,154 @@ class TestGroups(TestCase):
 
         groups[5].flush_members()
         self.assertEqual(groups[5].members(), [])
+
+
+class TestPermissions(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        DB.MC.flush_all()
+
+    def test_perm_changes(self):
+        """ Cached permissions should follow add_perm and delete_perm
+        """
+        user_id = Users.create("permtest1", "", "Perm", "Test", 1, "PT01")
+        course1_id = Courses.create("PERM01", "Test permissions 1", 1, 1)
+        course2_id = Courses.create("PERM02", "Test permissions 2", 1, 1)
+
+        self.assertFalse(Permissions.check_perm(user_id, course1_id, "viewmarks"))
+        self.assertFalse(Permissions.check_perm(user_id, -1, "viewmarks"))
+
+        Permissions.add_perm(user_id, course1_id, Permissions.PERMS['viewmarks'])
+        self.assertTrue(Permissions.check_perm(user_id, course1_id, "viewmarks"))
+        self.assertTrue(Permissions.check_perm(user_id, -1, "viewmarks"))
+        self.assertFalse(Permissions.check_perm(user_id, course2_id, "viewmarks"))
+        self.assertFalse(Permissions.check_perm(user_id, course1_id, "altermarks"))
+        self.assertTrue(Permissions.satisfy_perms(user_id, course1_id,
+                                                  ("altermarks", "viewmarks")))
+
+        Permissions.delete_perm(user_id, course1_id, Permissions.PERMS['viewmarks'])
+        self.assertFalse(Permissions.check_perm(user_id, course1_id, "viewmarks"))
+        self.assertFalse(Permissions.check_perm(user_id, -1, "viewmarks"))
+
+        Permissions.add_perm(user_id, course2_id, 0)
+        self.assertTrue(Permissions.check_perm(user_id, course2_id, "altermarks"))
+        self.assertFalse(Permissions.check_perm(user_id, course1_id, "altermarks"))
+
+        Permissions.add_perm(user_id, 0, Permissions.PERMS['sysadmin'])
+        self.assertTrue(Permissions.check_perm(user_id, course1_id, "altermarks"))
+        Permissions.delete_perm(user_id, 0, Permissions.PERMS['sysadmin'])
+        self.assertFalse(Permissions.check_perm(user_id, course1_id, "altermarks"))
+
+    def test_perm_counter_evicted(self):
+        """ Losing the version counter from memcached mustn't bring back
+            permissions that have since been removed, and string user ids
+            (as from forms) clear the same cache entries as ints.
+        """
+        user_id = Users.create("permtest2", "", "Perm", "Test", 1, "PT02")
+        course_id = Courses.create("PERM03", "Test permissions 3", 1, 1)
+
+        Permissions.add_perm(user_id, course_id, Permissions.PERMS['viewmarks'])
+        self.assertTrue(Permissions.check_perm(user_id, course_id, "viewmarks"))
+
+        DB.MC.delete("permission-%s-version" % user_id)
+        Permissions.delete_perm(str(user_id), course_id, Permissions.PERMS['viewmarks'])
+        self.assertFalse(Permissions.check_perm(user_id, course_id, "viewmarks"))
+        self.assertFalse(Permissions.check_perm(str(user_id), course_id, "viewmarks"))
+        version = DB.MC.get("permission-%s-version" % user_id)
+        if version is not None:  # memcached is running
+            self.assertTrue(int(version) > 1)
+
+
+class TestAudit(TestCase):
+
+    def setUp(self):
+        Audit.flush()
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_spill_file = OaConfig.audit_spill_file
+        OaConfig.audit_spill_file = os.path.join(self.tmpdir, "audit.spill")
+        self.obj_id = Users.create(self._testMethodName, "", "Audit", "Test", 1, "")
+
+    def tearDown(self):
+        Audit.flush()
+        OaConfig.audit_spill_file = self.old_spill_file
+        shutil.rmtree(self.tmpdir)
+
+    def messages(self):
+        return sorted([record['message']
+                       for record in Audit.get_records_by_object(self.obj_id)])
+
+    def spilled(self):
+        if not os.path.exists(OaConfig.audit_spill_file):
+            return []
+        with open(OaConfig.audit_spill_file) as f:
+            return [json.loads(line)[5] for line in f]
+
+    def test_audit_flush(self):
+        """ flush() writes what's queued, and audit() starts a new writer
+            afterwards.
+        """
+        Audit.audit(1, self.obj_id, self.obj_id, "TestAudit", "first")
+        Audit.flush()
+        self.assertEqual(["first"], self.messages())
+        self.assertIsNone(Audit._writer_pid)
+
+        Audit.audit(1, self.obj_id, self.obj_id, "TestAudit", "second")
+        self.assertEqual(os.getpid(), Audit._writer_pid)
+        self.assertTrue(Audit._writer.is_alive())
+        Audit.flush()
+        self.assertEqual(["first", "second"], self.messages())
+        self.assertEqual([], self.spilled())
+
+    def test_audit_spill_replay(self):
+        """ Records that can't be written are spilled, and replayed once. """
+        def broken(batch):
+            raise Exception("database went away")
+
+        insert = Audit._insert
+        Audit._insert = broken
+        try:
+            Audit.audit(1, self.obj_id, self.obj_id, "TestAudit", "spilled")
+            Audit.flush()
+        finally:
+            Audit._insert = insert
+        self.assertEqual([], self.messages())
+        self.assertEqual(["spilled"], self.spilled())
+        self.assertEqual(0600, os.stat(OaConfig.audit_spill_file).st_mode & 0777)
+
+        self.assertEqual(1, Audit.replay_spilled())
+        self.assertFalse(os.path.exists(OaConfig.audit_spill_file))
+        self.assertEqual(["spilled"], self.messages())
+        self.assertEqual(0, Audit.replay_spilled())
+        self.assertEqual(["spilled"], self.messages())
+        self.assertEqual([], os.listdir(self.tmpdir))
+
+    def test_audit_queue_full(self):
+        """ Records that don't fit in the queue are spilled straight away. """
+        entered = threading.Event()
+        release = threading.Event()
+
+        def slow(batch):
+            entered.set()
+            release.wait(10)
+            insert(batch)
+
+        insert = Audit._insert
+        max_queue = Audit.MAX_QUEUE
+        Audit._insert = slow
+        Audit.MAX_QUEUE = 1
+        try:
+            Audit.audit(1, self.obj_id, self.obj_id, "TestAudit", "writing")
+            self.assertTrue(entered.wait(10))
+            Audit.audit(1, self.obj_id, self.obj_id, "TestAudit", "queued")
+            Audit.audit(1, self.obj_id, self.obj_id, "TestAudit", "overflow")
+            self.assertEqual(["overflow"], self.spilled())
+            release.set()
+            Audit.flush()
+        finally:
+            release.set()
+            Audit._insert = insert
+            Audit.MAX_QUEUE = max_queue
+        self.assertEqual(["queued", "writing"], self.messages())
+        self.assertEqual(["overflow"], self.spilled())
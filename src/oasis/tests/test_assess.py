@@ -8,7 +8,8 @@ import tempfile
 from logging import getLogger
 from oasis import app
 import datetime
-from oasis.lib import DB, Courses, Exams, External, Topics
+import time
+from oasis.lib import DB, Courses, Exams, External, Topics, Groups, Periods, Users, ExamTimers
 
 L = getLogger("oasisqe")
 
@@ -27,6 +28,40 @@ def get_csrf_token(data):
         return match.groups()[0]
     return None
 
+def create_exam_and_group(course_name, code, title, astart, duration):
+    """ Create a course with a two hour assessment starting at astart, with
+        one simple question, and an empty group to take it. code keeps the
+        names unique. Returns (exam_id, group).
+    """
+    course_id = Courses.create(course_name, "unit tests, %s" % title, 1, 1)
+    exam_id = Exams.create(course_id, 1, title, 2, duration, astart,
+                           astart + datetime.timedelta(hours=2), "", instant=1)
+
+    qt_id = DB.create_qt(1, "TEST%s" % code, title, 0, 5.0, 1)
+    ver = DB.get_qt_version(qt_id)
+    DB.add_qt_variation(qt_id, 1, {'A1': "2"}, ver)
+    DB.create_qt_att(qt_id, "qtemplate.html", "text/html", "What is <VAL A1>? <ANSWER 1>", ver)
+    DB.update_exam_qt_in_pos(exam_id, 1, [qt_id, ])
+
+    period = Periods.Period(name="Period %s" % code,
+                            title=title,
+                            start=datetime.datetime.now(),
+                            finish=datetime.datetime.now(),
+                            code="CODE%s" % code)
+    period.save()
+    group = Groups.Group(g_id=0)
+    group.name = "TEST%sGROUP" % code
+    group.title = "%s group" % title
+    group.gtype = 1
+    group.source = None
+    group.period = Periods.Period(name="Period %s" % code).id
+    group.feed = None
+    group.feedargs = ""
+    group.active = True
+    group.save()
+    return exam_id, Groups.get_by_name("TEST%sGROUP" % code)
+
+
 def create_exported_questions(fname):
     """ Make some questions and export them."""
     # Not really related to assessment, but can use this to create some questions to import and use multiple times
@@ -147,3 +182,59 @@ class TestAssess(TestCase):
         data = open(self.test_question_fname).read()
         numread = External.import_qts_from_zip(data, topic1_id)
         self.assertEqual(numread, 3)
+
+    def test_pregenerate_results(self):
+        """ Questions generated ahead of an assessment don't count as the
+            students having done it, until they start.
+        """
+        astart = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        exam_id, group = create_exam_and_group("TESTCOURSE6", "PREGEN", "Test pregeneration", astart, 60)
+        uid1 = Users.create("pregentest1", "", "Pregen", "One", 1, "PG01")
+        uid2 = Users.create("pregentest2", "", "Pregen", "Two", 1, "PG02")
+        group.add_member(uid1)
+        group.add_member(uid2)
+
+        self.assertEqual(2, Exams.pregenerate_instances(exam_id, group))
+        self.assertEqual(1, Exams.get_user_status(uid1, exam_id))
+        self.assertEqual([], Exams.get_group_results(group, exam_id))
+        self.assertEqual({}, Exams.get_marks(group, exam_id))
+        self.assertNotIn(exam_id, Exams.get_exams_done(uid1))
+
+        Exams.set_user_status(uid1, exam_id, 2)  # started
+        results = Exams.get_group_results(group, exam_id)
+        self.assertEqual([uid1], [student['id'] for student in results])
+        self.assertIn(exam_id, Exams.get_exams_done(uid1))
+        self.assertNotIn(exam_id, Exams.get_exams_done(uid2))
+
+    def test_timer_submit(self):
+        """ Timed attempts that have run out are submitted by the sweeper,
+            others are left alone.
+        """
+        astart = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        exam_id, group = create_exam_and_group("TESTCOURSE7", "TIMERS", "Test exam timers", astart, 30)
+        expired = Users.create("timertest1", "", "Timer", "One", 1, "TM01")
+        running = Users.create("timertest2", "", "Timer", "Two", 1, "TM02")
+        unsubmitted = Users.create("timertest3", "", "Timer", "Three", 1, "TM03")
+        for uid in (expired, running, unsubmitted):
+            group.add_member(uid)
+        self.assertEqual(3, Exams.pregenerate_instances(exam_id, group))
+
+        def start(uid, endtime):
+            Exams.set_user_status(uid, exam_id, 2)
+            DB.run_sql("""INSERT INTO examtimers (userid, exam, endtime)
+                          VALUES (%s, %s, %s);""", [uid, exam_id, endtime])
+
+        start(expired, time.time() - ExamTimers.GRACE - 600)
+        start(running, time.time() + 600)
+        start(unsubmitted, time.time() - ExamTimers.GRACE - 600)
+        Exams.unsubmit(exam_id, unsubmitted)
+
+        self.assertEqual(1, ExamTimers.sweep_once())
+        self.assertNotIn(Exams.get_user_status(expired, exam_id), ExamTimers.ACTIVE_STATUS)
+        self.assertEqual(2, Exams.get_user_status(running, exam_id))
+        self.assertEqual(1, Exams.get_user_status(unsubmitted, exam_id))
+
+        # and they aren't submitted again
+        self.assertFalse(ExamTimers.submit_expired(exam_id, expired))
+        self.assertFalse(ExamTimers.submit_expired(exam_id, running))
+        self.assertFalse(ExamTimers.submit_expired(exam_id, unsubmitted))
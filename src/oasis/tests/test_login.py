@@ -6,7 +6,7 @@ import re
 from logging import getLogger
 from oasis import app
 from oasis.lib import DB
-from oasis.lib import Users
+from oasis.lib import Users, Users2
 
 L = getLogger("oasisqe")
 
@@ -122,4 +122,35 @@ class TestLogin(TestCase):
 
             self.assertFalse(Users.verify_password("notexist", "fred"))
 
+    def test_user_records(self):
+        """ Cached user records follow changes to the user, one at a time
+            or in bulk.
+        """
+        uid1 = Users.create("recordtest1", "", "Record", "One", 1, "RT01")
+        uid2 = Users.create("recordtest2", "", "Record", "Two", 1, "RT02")
+
+        self.assertEqual(u"One", Users2.get_user(uid1)['familyname'])
+        users = Users2.get_users([uid1, uid2, uid1, 999999])
+        self.assertEqual(set([uid1, uid2]), set(users.keys()))
+        self.assertEqual(u"recordtest2", users[uid2]['uname'])
+
+        Users.set_familyname(uid1, "Uno")
+        self.assertEqual(u"Uno", Users2.get_user(uid1)['familyname'])
+        self.assertEqual(u"Uno", Users2.get_users([uid1, uid2])[uid1]['familyname'])
+        self.assertEqual(u"Two", Users2.get_user(uid2)['familyname'])
+        self.assertIsNone(Users2.get_user(999999))
+
+        # ids from forms come as strings
+        self.assertEqual(u"Uno", Users2.get_user(str(uid1))['familyname'])
+        self.assertEqual(set([uid1, uid2]), set(Users2.get_users([str(uid1), uid2]).keys()))
+
+        # a change after the version counter is evicted mustn't go back to
+        # a version that's still cached
+        DB.MC.delete("user-%s-version" % uid1)
+        Users.set_familyname(uid1, "Eins")
+        self.assertEqual(u"Eins", Users2.get_user(uid1)['familyname'])
+        version = DB.MC.get("user-%s-version" % uid1)
+        if version is not None:  # memcached is running
+            self.assertTrue(int(version) > 1)
+
 
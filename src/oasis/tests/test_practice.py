@@ -1,11 +1,12 @@
 # Test that practice UI is working
 
 from unittest import TestCase
+import datetime
 import re
 
 from logging import getLogger
 from oasis import app
-from oasis.lib import DB, Courses
+from oasis.lib import DB, Courses, Practice, Stats, Groups, Periods, Users
 
 L = getLogger("oasisqe")
 
@@ -156,3 +157,134 @@ class TestPractice(TestCase):
 
             self.assertIn("<h2>TESTCOURSE10 (unit tests)</h2>", s.data)
             self.assertIn("Select a Topic", s.data)
+
+    def test_remark_prac_stats(self):
+        """ Marking a practice question again doesn't count it again in the
+            practice stats.
+        """
+        class FakeRequest(object):
+            def __init__(self, form):
+                self.form = form
+
+        qt_id = DB.create_qt(1, "TESTREMARK", "Test re-marking", 0, 5.0, 1)
+        ver = DB.get_qt_version(qt_id)
+        DB.add_qt_variation(qt_id, 1, {'A1': "2"}, ver)
+        DB.create_qt_att(qt_id, "qtemplate.html", "text/html", "What is <VAL A1>? <ANSWER 1>", ver)
+        q_id = DB.create_q(qt_id, "TESTREMARK", 1, 1, 1, ver, 0)
+        answer = FakeRequest({"Q_%s_ANS_1" % q_id: "2"})
+
+        def count():
+            ret = DB.run_sql("""SELECT SUM("number") FROM stats_prac_q_course
+                                WHERE qtemplate = %s;""", [qt_id, ])
+            return int(ret[0][0] or 0)
+
+        Practice.mark_q(1, 0, q_id, answer)
+        # as if it was marked a couple of hours ago
+        DB.run_sql("""UPDATE questions SET marktime = marktime - interval '2 hours'
+                      WHERE question = %s;""", [q_id, ])
+        marktime = DB.run_sql("SELECT marktime FROM questions WHERE question = %s;", [q_id, ])[0][0]
+        Stats.update_prac_stats(datetime.datetime.now() + datetime.timedelta(minutes=1))
+        self.assertEqual(1, count())
+
+        Practice.mark_q(1, 0, q_id, answer)
+        Stats.update_prac_stats(datetime.datetime.now() + datetime.timedelta(minutes=1))
+        self.assertEqual(1, count())
+        self.assertEqual(marktime,
+                         DB.run_sql("SELECT marktime FROM questions WHERE question = %s;", [q_id, ])[0][0])
+
+    def test_prac_summaries(self):
+        """ The practice summaries follow the scores of the questions, when
+            they're first marked and when they're marked again.
+        """
+        class FakeRequest(object):
+            def __init__(self, form):
+                self.form = form
+
+        course_id = Courses.create("TESTCOURSE11", "unit tests for practice summaries", 1, 1)
+        period = Periods.Period(name="Period PS",
+                                title="Test practice summaries",
+                                start=datetime.datetime.now(),
+                                finish=datetime.datetime.now(),
+                                code="CODEPS")
+        period.save()
+        group = Groups.Group(g_id=0)
+        group.name = "TESTPRACSUMGROUP"
+        group.title = "Test practice summaries group"
+        group.gtype = 1
+        group.source = None
+        group.period = Periods.Period(name="Period PS").id
+        group.feed = None
+        group.feedargs = ""
+        group.active = True
+        group.save()
+        group = Groups.get_by_name("TESTPRACSUMGROUP")
+        Courses.add_group(group.id, course_id)
+        uid = Users.create("pracsumtest1", "", "Practice", "One", 1, "PS01")
+        group.add_member(uid)
+
+        qt_id = DB.create_qt(1, "TESTPRACSUM", "Test practice summaries", 0, 5.0, 1)
+        ver = DB.get_qt_version(qt_id)
+        DB.add_qt_variation(qt_id, 1, {'A1': "2"}, ver)
+        DB.create_qt_att(qt_id, "qtemplate.html", "text/html", "What is <VAL A1>? <ANSWER 1>", ver)
+
+        def practice(answer, q_id=None):
+            if not q_id:
+                q_id = DB.create_q(qt_id, "TESTPRACSUM", uid, 1, 1, ver, 0)
+                # long enough on it to count for the class
+                DB.run_sql("""UPDATE questions SET firstview = NOW() - interval '5 minutes'
+                              WHERE question = %s;""", [q_id, ])
+            Practice.mark_q(uid, 0, q_id, FakeRequest({"Q_%s_ANS_1" % q_id: answer}))
+            return q_id
+
+        def check(num, avg, stddev, low, high):
+            for stats in (Stats.get_student_prac_summaries(uid, [qt_id, ])[qt_id],
+                          Stats.get_course_prac_summaries(course_id, [qt_id, ])[qt_id]):
+                self.assertEqual(num, stats['num'])
+                self.assertAlmostEqual(avg, stats['avg'])
+                self.assertAlmostEqual(stddev, stats['stddev'])
+                self.assertAlmostEqual(low, stats['min'])
+                self.assertAlmostEqual(high, stats['max'])
+
+        self.assertEqual({}, Stats.get_student_prac_summaries(uid, [qt_id, ]))
+        self.assertEqual({}, Stats.get_course_prac_summaries(course_id, [qt_id, ]))
+        self.assertEqual({}, Stats.get_student_prac_summaries(uid, []))
+        self.assertEqual({}, Stats.get_course_prac_summaries(course_id, []))
+
+        q1 = practice("2")
+        check(1, 1.0, 0.0, 1.0, 1.0)    # no stddev from one practice
+        q2 = practice("3")
+        check(2, 0.5, 0.5 ** 0.5, 0.0, 1.0)
+
+        # marked again, the score changes in place
+        practice("2", q2)
+        check(2, 1.0, 0.0, 1.0, 1.0)
+        practice("2", q2)
+        check(2, 1.0, 0.0, 1.0, 1.0)
+        practice("4", q1)
+        check(2, 0.5, 0.5 ** 0.5, 0.0, 1.0)
+
+        # they agree with the questions
+        ret = DB.run_sql("""SELECT COUNT(question), AVG(score), MIN(score), MAX(score)
+                            FROM questions WHERE qtemplate = %s;""", [qt_id, ])
+        stats = Stats.get_student_prac_summaries(uid, [qt_id, ])[qt_id]
+        self.assertEqual(int(ret[0][0]), stats['num'])
+        self.assertAlmostEqual(float(ret[0][1]), stats['avg'])
+        self.assertAlmostEqual(float(ret[0][2]), stats['min'])
+        self.assertAlmostEqual(float(ret[0][3]), stats['max'])
+
+        # the last few practices, oldest first
+        q3 = practice("2")
+        q4 = practice("2")
+        for ago, q_id in ((40, q1), (30, q2), (20, q3), (10, q4)):
+            DB.run_sql("""UPDATE questions
+                          SET marktime = NOW() - %s * interval '1 minute',
+                              firstview = NOW() - %s * interval '1 minute'
+                          WHERE question = %s;""", [ago, ago + 1, q_id])
+        recent = DB.get_student_qts_practice_stats(uid, [qt_id, ], 3)
+        self.assertEqual([q2, q3, q4], [prac['question'] for prac in recent[qt_id]])
+        self.assertEqual([1.0, 1.0, 1.0], [prac['score'] for prac in recent[qt_id]])
+        recent = DB.get_student_qts_practice_stats(uid, [qt_id, ], 0)
+        self.assertEqual([q1, q2, q3, q4], [prac['question'] for prac in recent[qt_id]])
+        self.assertEqual(0.0, recent[qt_id][0]['score'])
+        self.assertEqual({}, DB.get_student_qts_practice_stats(uid, [qt_id + 1000, ], 3))
+        self.assertEqual({}, DB.get_student_qts_practice_stats(uid, [], 3))
@@ -8,8 +8,15 @@
 # code from all over the place :)
 
 import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import psycopg2
 from unittest import TestCase
-from oasis.lib import General, script_funcs
+from oasis import app
+from oasis.lib import DB, General, script_funcs, QHtml, AttachStore, QScripts
+from oasis.lib.OaExceptions import OaScriptLimitError
 
 
 # noinspection PyTypeChecker
@@ -153,6 +160,223 @@ class TestQEngine(TestCase):
         res = General.gen_q_html(qvars, tmpl)
         self.assertEqual(res, html)
 
+    def test_instance_render(self):
+        """ Fill in a generated question's HTML with the student's guesses,
+            for display.
+
+            No side effects.
+        """
+        tmpl = "<ANSWER1> <ANSWER2 SELECT f,g> <ANSWER12 MULTIF f,g>"
+        qvars = {'f': 7, 'g': "joe"}
+        inst = QHtml.QInstanceHtml(unicode(General.gen_q_html(qvars, tmpl)), 3, 1, 2)
+
+        guesses = {"G1": "<b>", "G2": "2", "G12": "1.0"}
+        html = u"""<INPUT class='auto_save' TYPE='text' NAME='Q_5_ANS_1' VALUE="&lt;b&gt;"/> """
+        res = inst.render(5, guesses)
+        self.assertTrue(res.startswith(html))
+        self.assertIn(u"<OPTION VALUE='2' SELECTED>joe</OPTION>", res)
+        self.assertIn(u"<OPTION VALUE='1' >7</OPTION>", res)
+        self.assertIn(u"NAME='Q_5_ANS_12' VALUE='1' CHECKED>7", res)
+        self.assertIn(u"NAME='Q_5_ANS_12' VALUE='2' >joe", res)
+
+        res = inst.render(6, {}, readonly=True)
+        html = u"""<INPUT READONLY class='auto_save' TYPE='text' NAME='Q_6_ANS_1' VALUE=""/> """
+        self.assertTrue(res.startswith(html))
+        self.assertNotIn(u"Oa_", res)
+        self.assertNotIn(u"SELECTED", res)
+
+    def test_save_guesses(self):
+        """ Save all the guesses from a page at once and read them back.
+        """
+        qt_id = DB.create_qt(1, "TESTGUESSES", "Test saving guesses", 0, 5.0, 1)
+        q_id = DB.create_q(qt_id, "TESTGUESSES", 1, 1, 1, 1, 0)
+        self.assertEqual({}, DB.get_q_guesses(q_id))
+
+        DB.save_guesses([(q_id, 1, u"5"), (q_id, 2, u""), (q_id, 12, u"joe")])
+        self.assertEqual({"G1": u"5", "G2": u"", "G12": u"joe"}, DB.get_q_guesses(q_id))
+
+        DB.save_guess(q_id, 2, u"7")
+        self.assertEqual(u"7", DB.get_q_guesses(q_id)["G2"])
+
+        DB.save_guesses([])
+
+    def test_prepared_queries(self):
+        """ Declared queries run as prepared statements and are counted.
+        """
+        qt_id = DB.create_qt(1, "TESTPREPARED", "Test prepared queries", 0, 5.0, 1)
+        q_id = DB.create_q(qt_id, "TESTPREPARED", 1, 1, 1, 1, 0)
+        before = DB.QUERIES["get_q_parent"].calls
+        for _ in range(3):   # the pool may hand us different connections
+            self.assertEqual(qt_id, DB.get_q_parent(q_id))
+        self.assertEqual(before + 3, DB.QUERIES["get_q_parent"].calls)
+        self.assertIn("get_q_parent", [q['name'] for q in DB.query_stats()])
+
+        sql = DB.QUERIES["get_qt_att"].prepare_sql
+        self.assertIn("$5", sql)
+        self.assertNotIn("%s", sql)
+
+    def test_attachment_etag(self):
+        """ Attachments are served with their content hash as the ETag, and
+            answer conditional and Range requests.
+        """
+        data = "GIF89a" + "x" * 1000
+        qt_id = DB.create_qt(1, "TESTATTETAG", "Test attachment ETag", 0, 5.0, 1)
+        DB.update_qt_embedid(qt_id, "TESTATTETAG%s" % qt_id)  # no login needed
+        version = DB.get_qt_version(qt_id)
+        DB.create_qt_att(qt_id, "image1.gif", "image/gif", data, version)
+
+        info = DB.get_qt_att_info(qt_id, "image1.gif", version)
+        self.assertEqual(hashlib.md5(data).hexdigest(), info['hash'])
+        self.assertEqual(len(data), info['size'])
+        self.assertEqual("image/gif", info['mimetype'])
+        self.assertIsNone(DB.get_qt_att_info(qt_id, "nothere.gif", version))
+
+        url = "/att/qtatt/%s/%s/0/image1.gif" % (qt_id, version)
+        with app.test_client() as c:
+            res = c.get(url)
+            self.assertEqual(200, res.status_code)
+            self.assertEqual(data, res.data)
+            self.assertEqual('"%s"' % info['hash'], res.headers['ETag'])
+
+            res = c.get(url, headers={'If-None-Match': res.headers['ETag']})
+            self.assertEqual(304, res.status_code)
+            self.assertEqual("", res.data)
+
+            res = c.get(url, headers={'Range': 'bytes=0-5'})
+            self.assertEqual(206, res.status_code)
+            self.assertEqual("GIF89a", res.data)
+            self.assertEqual("bytes 0-5/%s" % len(data), res.headers['Content-Range'])
+
+    def test_attach_store(self):
+        """ Attachments in the file store are kept once per content hash,
+            copying a question template shares them, and they can be moved
+            there from the database and sent from there.
+        """
+        data = "GIF89a" + "y" * 1000
+        digest = hashlib.md5(data).hexdigest()
+        root = tempfile.mkdtemp()
+        try:
+            store = AttachStore.FileStore(root)
+            self.assertTrue(store.put(digest, data))
+            self.assertTrue(store.put(digest, data))
+            self.assertEqual(data, store.get(digest))
+            self.assertEqual(os.path.join(root, digest[0:2], digest[2:4], digest),
+                             store.path(digest))
+            self.assertFalse(store.put(digest, "something else"))
+            self.assertIsNone(store.get(hashlib.md5("missing").hexdigest()))
+            self.assertRaises(ValueError, store.path, "../../etc/passwd")
+        finally:
+            shutil.rmtree(root)
+
+        # in the database
+        qt_id = DB.create_qt(1, "TESTATTMOVE", "Test attachment move", 0, 5.0, 1)
+        DB.create_qt_att(qt_id, "image1.gif", "image/gif", data, DB.get_qt_version(qt_id))
+
+        def stored_files():
+            return [name for _, _, files in os.walk(root)
+                    for name in files if not name.startswith(".tmp-")]
+
+        def att_data_is_null(att_qt_id):
+            ret = DB.run_sql("""SELECT data IS NULL FROM qtattach
+                                WHERE qtemplate = %s AND name = 'image1.gif';""", [att_qt_id, ])
+            return [row[0] for row in ret]
+
+        root = tempfile.mkdtemp()
+        old_store = AttachStore.STORE
+        AttachStore.STORE = AttachStore.FileStore(root)
+        try:
+            data2 = "GIF89a" + "z" * 1000
+            digest2 = hashlib.md5(data2).hexdigest()
+            qt2_id = DB.create_qt(1, "TESTATTCOPY", "Test attachment copy", 0, 5.0, 1)
+            DB.create_qt_att(qt2_id, "image1.gif", "image/gif", data2, DB.get_qt_version(qt2_id))
+            newid = DB.copy_qt_all(qt2_id)
+            self.assertEqual([True], att_data_is_null(qt2_id))
+            self.assertEqual([True], att_data_is_null(newid))
+            self.assertEqual([digest2], stored_files())
+            self.assertEqual(data2, DB.get_qt_att(newid, "image1.gif"))
+            info = DB.get_qt_att_info(newid, "image1.gif")
+            self.assertEqual(digest2, info['hash'])
+            self.assertTrue(info['in_store'])
+
+            # sent from the store
+            DB.update_qt_embedid(newid, "TESTATTCOPY%s" % newid)  # no login needed
+            url = "/att/qtatt/%s/%s/0/image1.gif" % (newid, DB.get_qt_version(newid))
+            with app.test_client() as c:
+                res = c.get(url)
+                self.assertEqual(200, res.status_code)
+                self.assertEqual(data2, res.data)
+                self.assertEqual('"%s"' % digest2, res.headers['ETag'])
+
+                res = c.get(url, headers={'If-None-Match': res.headers['ETag']})
+                self.assertEqual(304, res.status_code)
+                self.assertEqual("", res.data)
+
+                res = c.get(url, headers={'Range': 'bytes=0-5'})
+                self.assertEqual(206, res.status_code)
+                self.assertEqual("GIF89a", res.data)
+                self.assertEqual("bytes 0-5/%s" % len(data2), res.headers['Content-Range'])
+
+            # moving the ones in the database out
+            self.assertEqual([False], att_data_is_null(qt_id))
+            self.assertTrue(DB.move_atts_to_store() >= 1)
+            self.assertEqual([True], att_data_is_null(qt_id))
+            self.assertIn(digest, stored_files())
+            self.assertEqual(data, DB.get_qt_att(qt_id, "image1.gif"))
+            self.assertEqual(0, DB.move_atts_to_store())
+        finally:
+            # Put back what the other tests' attachments had before.
+            for table in ("qattach", "qtattach"):
+                ret = DB.run_sql("""SELECT "%s", hash FROM %s
+                                    WHERE data IS NULL AND hash IS NOT NULL;""" % (table, table))
+                for row_id, row_hash in ret or []:
+                    stored = AttachStore.STORE.get(row_hash)
+                    if stored is not None:
+                        DB.run_sql("""UPDATE %s SET data = %%s WHERE "%s" = %%s;""" % (table, table),
+                                   [psycopg2.Binary(stored), row_id])
+            AttachStore.STORE = old_store
+            shutil.rmtree(root)
+
+        # Rows from before 3.9.13 with no data have no hash either
+        DB.run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, data, version)
+                      VALUES (%s, 'text/plain', 'empty.txt', NULL, %s);""",
+                   [qt_id, DB.get_qt_version(qt_id)])
+        self.assertFalse(DB.get_qt_att_info(qt_id, "empty.txt")['in_store'])
+        self.assertEqual("", DB.get_qt_att(qt_id, "empty.txt"))
+
+    def test_script_limits(self):
+        """ Question scripts are stopped when they run too long, and otherwise
+            behave as if they were exec'd.
+        """
+        # an ordinary script still runs
+        script = QScripts.QScript("total = 0\nfor i in range(10):\n    total += i\n")
+        ns = {"__builtins__": {"range": range}}
+        script.run(ns)
+        self.assertEqual(ns["total"], 45)
+
+        # docstrings are left alone
+        script = QScripts.QScript('def f():\n    """ Hello """\n    return 1\ndoc = f.__doc__\nres = f()\n')
+        ns = {"__builtins__": {}}
+        script.run(ns)
+        self.assertEqual(ns["doc"], " Hello ")
+        self.assertEqual(ns["res"], 1)
+
+        # loops that never finish
+        script = QScripts.QScript("while 1:\n    pass\n")
+        self.assertRaises(OaScriptLimitError, script.run, {"__builtins__": {}}, 5, 10000)
+        self.assertRaises(OaScriptLimitError, script.run, {"__builtins__": {}}, 0.2, 10 ** 9)
+
+        # catching the error doesn't help
+        script = QScripts.QScript("while 1:\n    try:\n        pass\n    except BaseException:\n        pass\n")
+        self.assertRaises(OaScriptLimitError, script.run, {"__builtins__": {"BaseException": BaseException}}, 5, 10000)
+
+        # recursion is stopped before Python's own limit
+        script = QScripts.QScript("def f(n):\n    return f(n + 1)\nf(0)\n")
+        self.assertRaises(OaScriptLimitError, script.run, {"__builtins__": {}}, 5, 100)
+
+        # it can't reach the tick function itself
+        script = QScripts.QScript("__oa_tick__ = None\n")
+        self.assertRaises(SyntaxError, script.run, {"__builtins__": {}})
+
     def test_html_esc(self):
         """ Check that our HTML escaping works ok. ( & -> &amp;  etc)
         """
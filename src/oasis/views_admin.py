@@ -12,7 +12,7 @@ import os
 from datetime import datetime
 
 from flask import render_template, \
-    request, redirect, abort, url_for, flash
+    request, redirect, abort, url_for, flash, jsonify
 
 from logging import getLogger
 from oasis.lib import Courses, Setup, Periods, Feeds, External, UFeeds, OaConfig, LTIConsumers
@@ -150,6 +150,9 @@ def admin_sysstats():
     db_sizes = DB.get_db_size()
     db_queue_size = DB.dbpool.total()
     db_queue_free = len(DB.dbpool)
+    stats = DB.runtime_stats()
+    db_pool_stats = stats['pool']
+    template_cache_stats = stats['template_cache']
     if OaConfig.memcache_enable:
         mc_queue_size = DB.MC.total()
         mc_queue_free = len(DB.MC)
@@ -163,12 +166,27 @@ def admin_sysstats():
         db_sizes=db_sizes,
         db_queue_size=db_queue_size,
         db_queue_free=db_queue_free,
+        db_pool_stats=db_pool_stats,
+        template_cache_stats=template_cache_stats,
         mc_enable=OaConfig.memcache_enable,
         mc_queue_size=mc_queue_size,
-        mc_queue_free=mc_queue_free
+        mc_queue_free=mc_queue_free,
+        mc_stats=stats['memcache'],
+        queries=stats['queries'],
+        statements=stats['statements'],
+        slow_query_ms=OaConfig.slow_query_ms
     )
 
 
+@app.route("/admin/sysstats.json")
+@require_perm('sysadmin')
+def admin_sysstats_json():
+    """ Database and cache statistics for this server process, for
+        monitoring tools.
+    """
+    return jsonify(DB.runtime_stats())
+
+
 @app.route("/admin/userfeeds")
 @require_perm('sysadmin')
 def admin_userfeeds():
@@ -99,6 +99,16 @@ def api_stats_practice_load():
     return jsonify(result=counts)
 
 
+@app.route("/api/stats/practice/live")
+@authenticated
+def api_stats_practice_live():
+    """ Return the number of practice questions marked each minute over
+        the last hour, as it happens.
+    """
+    counts = Stats.live_prac_load(60)
+    return jsonify(result=counts)
+
+
 @app.route("/api/stats/practice/<int:year>")
 @authenticated
 def api_stats_practice_load_year(year):
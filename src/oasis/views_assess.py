@@ -16,7 +16,7 @@ import logging
 from flask import render_template, session, \
     request, redirect, abort, url_for, flash
 
-from .lib import DB, General, Exams, Courses, Assess, Audit
+from .lib import DB, General, Exams, Courses, Assess, Audit, Marking, ExamTimers
 
 MYPATH = os.path.dirname(__file__)
 
@@ -140,24 +140,27 @@ def assess_assessmentpage(course_id, exam_id, page):
         Exams.set_user_status(user_id, exam_id, 2)
         Exams.touchuserexam(exam_id, user_id)
 
+    endtime = Exams.get_end_time(exam_id, user_id)
+    if endtime < time.time():  # make sure it wasn't reset by someone else
+        endtime = Exams.get_end_time(exam_id, user_id, fresh=True)
     form = request.form
+    guesses = []
     for field in form.keys():
         qinfo = re.search(r"^Q_(\d+)_ANS_(\d+)$", field)
         if qinfo:
             q_id = int(qinfo.groups()[0])
             part = int(qinfo.groups()[1])
-            value = form[field]
-            timeremain = Exams.get_end_time(exam_id, user_id) - time.time()
-            if timeremain < -30:
-                flash("Time Exceeded, automatically submitting...")
-                return redirect(url_for("assess_submit",
-                                        course_id=course_id,
-                                        exam_id=exam_id))
-
-            if status < 6:
-                DB.save_guess(q_id, part, value)
-        else:
-            pass
+            guesses.append((q_id, part, form[field]))
+
+    if guesses:
+        if endtime - time.time() < -ExamTimers.GRACE:
+            flash("Time Exceeded, automatically submitting...")
+            return redirect(url_for("assess_submit",
+                                    course_id=course_id,
+                                    exam_id=exam_id))
+
+        if status < 6 and status != 4:  # 4 = waiting to be marked
+            DB.save_guesses(guesses)
 
     Exams.touchuserexam(exam_id, user_id)
 
@@ -189,7 +192,7 @@ def assess_assessmentpage(course_id, exam_id, page):
         return redirect(url_for("assess_startexam",
                                 course_id=course_id,
                                 exam_id=exam_id))
-    timeleft = Exams.get_end_time(exam_id, user_id) - time.time()
+    timeleft = endtime - time.time()
     exam = Exams.get_exam_struct(exam_id, course_id)
 
     if 'code' in session:
@@ -203,7 +206,7 @@ def assess_assessmentpage(course_id, exam_id, page):
                                 exam_id=exam_id))
 
     course = Courses.get_course(course_id)
-    if Exams.is_done_by(user_id, exam_id):
+    if status == 4 or Exams.is_done_by(user_id, exam_id):
         exam['is_done'] = True
         html = General.render_q_html(q_id, readonly=True)
     else:
@@ -278,6 +281,10 @@ def assess_submit(course_id, exam_id):
             return redirect(url_for("assess_awaitresults",
                                     course_id=course_id,
                                     exam_id=exam_id))
+        if Exams.get_user_status(user_id, exam_id) < 5:  # queued for marking
+            return redirect(url_for("assess_awaitresults",
+                                    course_id=course_id,
+                                    exam_id=exam_id))
 
     if exam["instant"] == 2:
         return redirect(url_for("assess_awaitresults",
@@ -297,6 +304,15 @@ def assess_awaitresults(course_id, exam_id):
     """
     user_id = session['user_id']
     exam = Exams.get_exam_struct(exam_id, course_id)
+    jobstatus = Marking.get_job_status(user_id, exam_id)
+    marking = jobstatus in (Marking.JOB_QUEUED, Marking.JOB_RUNNING)
+    if jobstatus == Marking.JOB_DONE and exam["instant"] != 2 \
+            and Exams.get_user_status(user_id, exam_id) >= 5:
+        return redirect(url_for("assess_viewmarked",
+                                course_id=course_id,
+                                exam_id=exam_id))
+    if jobstatus == Marking.JOB_FAILED:
+        flash("There was a problem marking the assessment, please contact your instructor.")
     course = Courses.get_course(course_id)
     numquestions = Exams.get_num_questions(exam_id)
     qids = []
@@ -316,6 +332,7 @@ def assess_awaitresults(course_id, exam_id):
         "assess_awaitresults.html",
         course=course,
         exam=exam,
+        marking=marking,
         questions=questions,
         pages=range(1, numquestions + 1)
     )
@@ -10,11 +10,11 @@ import os
 from datetime import datetime
 
 from flask import render_template, session, request, redirect, \
-    abort, url_for, flash, make_response
+    abort, url_for, flash, Response, stream_with_context
 from logging import getLogger
 from oasis.lib import OaConfig, Users2, DB, Topics, Permissions, \
     Exams, Courses, Setup, CourseAdmin, Groups, General, Assess, \
-    Spreadsheets
+    Spreadsheets, Gradebook
 
 MYPATH = os.path.dirname(__file__)
 
@@ -41,8 +41,8 @@ def cadmin_top(course_id):
     is_sysadmin = check_perm(user_id, -1, 'sysadmin')
 
     topics = Courses.get_topics_list(course_id)
-    exams = [Exams.get_exam_struct(exam_id, course_id)
-             for exam_id in Courses.get_exams(course_id, prev_years=False)]
+    exams = Exams.get_exam_structs(Courses.get_exams(course_id, prev_years=False),
+                                   course_id)
 
     exams.sort(key=lambda y: y['start_epoch'], reverse=True)
     groups = Courses.get_groups(course_id)
@@ -70,9 +70,11 @@ def cadmin_config(course_id):
 
     user_id = session['user_id']
     is_sysadmin = check_perm(user_id, -1, 'sysadmin')
-    coords = [Users2.get_user(perm[0])
-              for perm in Permissions.get_course_perms(course_id)
-              if perm[1] == 3]  # course_coord
+    coord_ids = [perm[0]
+                 for perm in Permissions.get_course_perms(course_id)
+                 if perm[1] == 3]  # course_coord
+    found = Users2.get_users(coord_ids)
+    coords = [found[uid] for uid in coord_ids if uid in found]
     groups = Courses.get_groups(course_id)
     choosegroups = [group
                     for group in Groups.all_groups()
@@ -146,8 +148,8 @@ def cadmin_prev_assessments(course_id):
     if not course:
         abort(404)
 
-    exams = [Exams.get_exam_struct(exam_id, course_id)
-             for exam_id in DB.get_course_exam_all(course_id, prev_years=True)]
+    exams = Exams.get_exam_structs(DB.get_course_exam_all(course_id, prev_years=True),
+                                   course_id)
 
     years = [exam['start'].year for exam in exams]
     years = list(set(years))
@@ -301,42 +303,21 @@ def cadmin_exam_results(course_id, exam_id):
     exam['start_minute'] = int(exam['start'].minute)
     exam['end_minute'] = int(exam['end'].minute)
 
-    groups = [Groups.Group(g_id=g_id)
-              for g_id
-              in Groups.active_by_course(course_id)]
-    results = {}
-    uids = set([])
-    totals = {}
-    for group in groups:
-        results[group.id] = Exams.get_marks(group, exam_id)
-        for user_id in results[group.id]:
-            uids.add(user_id)
-            if user_id not in totals:
-                totals[user_id] = 0.0
-            for qt, val in results[group.id][user_id].iteritems():
-                totals[user_id] += val['score']
-
-    questions = Exams.get_qts_list(exam_id)
-    users = {}
-    for uid in uids:
-        users[uid] = Users2.get_user(uid)
+    gradebook = Gradebook.get_results(course_id, exam_id)
     return render_template(
         "cadmin_examresults.html",
         course=course,
         exam=exam,
-        results=results,
-        groups=groups,
-        users=users,
-        questions=questions,
-        when=datetime.now().strftime("%H:%m, %a %d %b %Y"),
-        totals=totals
+        groups=gradebook['groups'],
+        questions=gradebook['questions'],
+        when=gradebook['generated']
     )
 
 
 @app.route("/cadmin/<int:course_id>/exam/<int:exam_id>/<int:group_id>/export.csv")
 @require_course_perm(("coursecoord", "courseadmin", "viewmarks"))
 def cadmin_export_csv(course_id, exam_id, group_id):
-    """ Send the group results as a CSV file """
+    """ Send the group results as a spreadsheet. XLSX unless ?format=csv """
     course = Courses.get_course(course_id)
     if not course:
         abort(404)
@@ -350,11 +331,18 @@ def cadmin_export_csv(course_id, exam_id, group_id):
         return redirect(url_for('cadmin_top', course_id=course_id))
 
     group = Groups.Group(g_id=group_id)
-    output = Spreadsheets.exam_results_as_spreadsheet(course_id, group, exam_id)
+    fname = "OASIS_%s_%s_Results" % (course['title'], exam['title'])
+    if request.args.get("format") == "csv":
+        output = Spreadsheets.exam_results_as_csv(course_id, group, exam_id)
+        response = Response(stream_with_context(output),
+                            mimetype="text/csv")
+        response.headers.add('Content-Disposition', 'attachment; filename="%s.csv"' % fname)
+        return response
 
-    response = make_response(output)
-    response.headers.add('Content-Type', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet; charset=utf-8")
-    response.headers.add('Content-Disposition', 'attachment; filename="OASIS_%s_%s_Results.xlsx"' % (course.title, exam.title))
+    output = Spreadsheets.exam_results_as_spreadsheet(course_id, group, exam_id)
+    response = Response(stream_with_context(output),
+                        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    response.headers.add('Content-Disposition', 'attachment; filename="%s.xlsx"' % fname)
 
     return response
 
@@ -510,7 +498,8 @@ def cadmin_editgroup(course_id, group_id):
     if not course:
         abort(404)
     ulist = group.members()
-    members = [Users2.get_user(uid) for uid in ulist]
+    found = Users2.get_users(ulist)
+    members = [found[uid] for uid in ulist if uid in found]
     return render_template("courseadmin_editgroup.html",
                            course=course,
                            group=group,
@@ -913,9 +902,10 @@ def cadmin_permissions(course_id):
 
     permlist = Permissions.get_course_perms(course_id)
     perms = {}
+    users = Users2.get_users([uid for uid, pid in permlist])
     for uid, pid in permlist:  # (uid, permission)
         if uid not in perms:
-            user = Users2.get_user(uid)
+            user = users[uid]
             perms[uid] = {
                 'uname': user['uname'],
                 'fullname': user['fullname'],
@@ -14,6 +14,7 @@ import datetime
 from flask import render_template, session, \
     request, redirect, abort, url_for, flash, \
     Response, make_response, send_file
+from werkzeug.wsgi import wrap_file
 from logging import getLogger
 
 from .lib import Users2, DB, Topics, \
@@ -21,6 +22,7 @@ from .lib import Users2, DB, Topics, \
 
 MYPATH = os.path.dirname(__file__)
 
+from .lib import AttachStore
 from .lib.Audit import audit
 from .lib.Permissions import check_perm
 
@@ -29,6 +31,61 @@ from oasis import app, authenticated
 L = getLogger("oasisqe")
 
 
+def _send_stored(info):
+    """ Respond with an attachment that's in the AttachStore. nginx sends
+        the file if attachment_accel is set, otherwise we do, using the WSGI
+        server's sendfile support if it has it.
+    """
+    store = AttachStore.STORE
+    if store.accel:
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = store.accel_url(info['hash'])
+    else:
+        try:
+            fileobj = open(store.path(info['hash']), "rb")
+        except IOError as err:
+            L.error("Unable to send attachment %s from store: %s" % (info['hash'], err))
+            abort(404)
+        response = Response(wrap_file(request.environ, fileobj), direct_passthrough=True)
+        response.content_length = info['size']
+    response.headers["Content-Type"] = info['mimetype']
+    return response
+
+
+def _send_attachment(info, fetch):
+    """ Respond with an attachment, given its DB.get_q_att_info() style
+        info. The content hash is the ETag, so if the browser already has
+        it we answer 304 without fetching the data. Otherwise fetch() is
+        called for the data, unless it's in the AttachStore, and Range
+        requests get just the part asked for.
+    """
+    etag = info['hash']
+    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
+    if etag and request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    elif info.get('in_store') and AttachStore.STORE:
+        response = _send_stored(info)
+        length = info['size']
+    else:
+        data = fetch()
+        if data is None or data is False:
+            abort(404)
+        response = make_response(data)
+        response.headers["Content-Type"] = info['mimetype']
+        length = len(data)
+    if etag:
+        response.set_etag(etag)
+    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    if response.status_code == 304 or "X-Accel-Redirect" in response.headers:
+        return response  # nginx does Range for us
+    try:
+        return response.make_conditional(request, accept_ranges=True,
+                                         complete_length=length)
+    except BaseException:
+        response.close()  # the stored file, eg. for a 416
+        raise
+
+
 # Does its own auth because it may be used in embedded questions
 @app.route("/att/qatt/<int:qt_id>/<int:version>/<int:variation>/<fname>")
 def attachment_question(qt_id, version, variation, fname):
@@ -45,16 +102,11 @@ def attachment_question(qt_id, version, variation, fname):
             return redirect(url_for('index'))
     if Attach.is_restricted(fname):
         abort(403)
-    mtype = DB.get_q_att_mimetype(qt_id, fname, variation, version)
-    if not mtype:
+    info = DB.get_q_att_info(qt_id, fname, variation, version)
+    if not info or not info['mimetype']:
         abort(404)
 
-    data = DB.get_q_att(qt_id, fname, variation, version)
-    response = make_response(data)
-    response.headers["Content-Type"] = mtype
-    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
-    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    return response
+    return _send_attachment(info, lambda: DB.get_q_att(qt_id, fname, variation, version))
 
 
 @app.route("/att/qtatt/<int:qt_id>/<int:version>/<int:variation>/<fname>")
@@ -71,18 +123,13 @@ def attachment_qtemplate(qt_id, version, variation, fname):
         if 'user_id' not in session:
             session['redirect'] = request.path
             return redirect(url_for('index'))
-    mtype = DB.get_q_att_mimetype(qt_id, fname, variation, version)
     if Attach.is_restricted(fname):
         abort(403)
-    if not mtype:
+    info = DB.get_qt_att_info(qt_id, fname, version)
+    if not info or not info['mimetype']:
         abort(404)
 
-    data = DB.get_qt_att(qt_id, fname, version)
-    response = make_response(data)
-    response.headers["Content-Type"] = mtype
-    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
-    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    return response
+    return _send_attachment(info, lambda: DB.get_qt_att(qt_id, fname, version))
 
 
 @app.route("/logout")
@@ -138,7 +138,8 @@ def setup_usersearch():
                 flash("Search term too short, please try something longer")
             else:
                 uids = Users2.find(needle)
-                users = [Users2.get_user(uid) for uid in uids]
+                found = Users2.get_users(uids)
+                users = [found[uid] for uid in uids if uid in found]
                 if len(users) == 0:
                     nonefound = True
                 else:
@@ -254,10 +255,13 @@ def setup_user_make_sysadmin():
         flash("You do not have User Administration access.")
         return redirect(url_for('setup_top'))
 
-    new_user = request.form.get('userid', None)
-    if not new_user:
+    try:
+        new_user = int(request.form.get('userid', None))
+    except (TypeError, ValueError):
         abort(400)
     user = Users2.get_user(new_user)
+    if not user:
+        abort(404)
     add_perm(new_user, 0, 1)
     flash("%s is now a system admin on OASIS" % user['uname'])
     return redirect(url_for("setup_usersearch"))
@@ -273,10 +277,13 @@ def setup_user_remove_sysadmin():
         flash("You do not have User Administration access.")
         return redirect(url_for('setup_top'))
 
-    new_user = request.form.get('userid', None)
-    if not new_user:
+    try:
+        new_user = int(request.form.get('userid', None))
+    except (TypeError, ValueError):
         abort(400)
     user = Users2.get_user(new_user)
+    if not user:
+        abort(404)
     delete_perm(new_user, 0, 1)
     flash("%s is no longer a system admin on OASIS" % user['uname'])
     return redirect(url_for("setup_usersearch"))
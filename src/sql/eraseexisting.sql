@@ -4,6 +4,10 @@ SET client_encoding = 'UTF8';
 SET standard_conforming_strings = on;
 
 BEGIN;
+DROP TABLE IF EXISTS stats_prac_course;
+DROP TABLE IF EXISTS stats_prac_student;
+DROP TABLE IF EXISTS stats_prac_daily;
+DROP TABLE IF EXISTS latest_guesses;
 DROP TABLE IF EXISTS audit;
 DROP TABLE IF EXISTS examqtemplates;
 DROP TABLE IF EXISTS examquestions;
@@ -18,6 +22,7 @@ DROP TABLE IF EXISTS groups;
 DROP TABLE IF EXISTS grouptypes;
 
 DROP TABLE IF EXISTS marklog;
+DROP TABLE IF EXISTS markjobs;
 
 DROP TABLE IF EXISTS marks;
 DROP TABLE IF EXISTS guesses;
@@ -65,6 +70,7 @@ DROP SEQUENCE IF EXISTS groups_id_seq;
 DROP SEQUENCE IF EXISTS guesses_id_seq;
 DROP SEQUENCE IF EXISTS lti_consumers_id_seq;
 DROP SEQUENCE IF EXISTS marklog_id_seq;
+DROP SEQUENCE IF EXISTS markjobs_id_seq;
 DROP SEQUENCE IF EXISTS marks_id_seq;
 DROP SEQUENCE IF EXISTS permissiondesc_permission_seq;
 DROP SEQUENCE IF EXISTS permissions_id_seq;
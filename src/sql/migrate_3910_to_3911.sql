@@ -0,0 +1,26 @@
+--
+-- Make the changes needed to move from v3.9.10 to 3.9.11
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+BEGIN;
+
+update config SET "value" = '3.9.11' WHERE "name" = 'dbversion';
+
+CREATE TABLE stats_prac_daily (
+    "day" date NOT NULL,
+    "qtemplate" integer NOT NULL,
+    "number" integer NOT NULL,
+    PRIMARY KEY ("day", "qtemplate")
+);
+
+-- the daily totals are filled in by the next stats update, have it start
+-- from the beginning
+DELETE FROM config WHERE "name" = 'stats_prac_marktime';
+
+COMMIT;
\ No newline at end of file
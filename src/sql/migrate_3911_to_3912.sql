@@ -0,0 +1,64 @@
+--
+-- Make the changes needed to move from v3.9.11 to 3.9.12
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+BEGIN;
+
+update config SET "value" = '3.9.12' WHERE "name" = 'dbversion';
+
+CREATE TABLE stats_prac_student (
+    "student" integer REFERENCES users("id") NOT NULL,
+    "qtemplate" integer REFERENCES qtemplates("qtemplate") NOT NULL,
+    "number" integer NOT NULL,
+    "total" float NOT NULL,
+    "totalsq" float NOT NULL,
+    "min" float NOT NULL,
+    "max" float NOT NULL,
+    PRIMARY KEY ("student", "qtemplate")
+);
+
+CREATE TABLE stats_prac_course (
+    "course" integer REFERENCES courses("course") NOT NULL,
+    "qtemplate" integer REFERENCES qtemplates("qtemplate") NOT NULL,
+    "number" integer NOT NULL,
+    "total" float NOT NULL,
+    "totalsq" float NOT NULL,
+    "min" float NOT NULL,
+    "max" float NOT NULL,
+    PRIMARY KEY ("course", "qtemplate")
+);
+
+-- summaries of the practice done so far
+INSERT INTO stats_prac_student (student, qtemplate, number, total, totalsq, min, max)
+    SELECT student, qtemplate, COUNT(question), SUM(score), SUM(score * score),
+           MIN(score), MAX(score)
+    FROM questions
+    WHERE (exam = 0 OR exam IS NULL)
+      AND marktime IS NOT NULL
+      AND score IS NOT NULL
+      AND student IS NOT NULL
+      AND qtemplate IS NOT NULL
+    GROUP BY student, qtemplate;
+
+INSERT INTO stats_prac_course (course, qtemplate, number, total, totalsq, min, max)
+    SELECT uc.course, q.qtemplate, COUNT(q.question), SUM(q.score),
+           SUM(q.score * q.score), MIN(q.score), MAX(q.score)
+    FROM questions AS q
+    JOIN (SELECT DISTINCT ug.userid, gc.course
+          FROM usergroups AS ug
+          JOIN groupcourses AS gc ON gc.groupid = ug.groupid) AS uc
+      ON uc.userid = q.student
+    WHERE (q.exam = 0 OR q.exam IS NULL)
+      AND q.score IS NOT NULL
+      AND q.qtemplate IS NOT NULL
+      AND (q.marktime - q.firstview) > '00:00:20'
+      AND (q.marktime - q.firstview) < '02:00:01'
+    GROUP BY uc.course, q.qtemplate;
+
+COMMIT;
\ No newline at end of file
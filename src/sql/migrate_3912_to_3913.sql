@@ -0,0 +1,23 @@
+--
+-- Make the changes needed to move from v3.9.12 to 3.9.13
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+BEGIN;
+
+update config SET "value" = '3.9.13' WHERE "name" = 'dbversion';
+
+ALTER TABLE qattach ADD COLUMN "hash" character varying(64);
+ALTER TABLE qattach ADD COLUMN "size" integer;
+UPDATE qattach SET "hash" = md5("data"), "size" = octet_length("data") WHERE "data" IS NOT NULL;
+
+ALTER TABLE qtattach ADD COLUMN "hash" character varying(64);
+ALTER TABLE qtattach ADD COLUMN "size" integer;
+UPDATE qtattach SET "hash" = md5("data"), "size" = octet_length("data") WHERE "data" IS NOT NULL;
+
+COMMIT;
\ No newline at end of file
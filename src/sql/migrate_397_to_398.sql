@@ -0,0 +1,32 @@
+--
+-- Make the changes needed to move from v3.9.7 to 3.9.8
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+BEGIN;
+
+update config SET "value" = '3.9.8' WHERE "name" = 'dbversion';
+
+-- queue of submitted assessments waiting to be marked by the marking workers
+CREATE TABLE markjobs (
+    "id" SERIAL PRIMARY KEY,
+    "exam" integer REFERENCES exams("exam") NOT NULL,
+    "student" integer REFERENCES users("id") NOT NULL,
+    "status" integer NOT NULL DEFAULT 0,
+    "attempts" integer NOT NULL DEFAULT 0,
+    "worker" character varying(100),
+    "created" timestamp without time zone NOT NULL DEFAULT NOW(),
+    "started" timestamp without time zone,
+    "finished" timestamp without time zone,
+    "message" text
+);
+
+CREATE INDEX markjobs_status ON markjobs USING btree (status, id);
+CREATE UNIQUE INDEX markjobs_exam_student_pending ON markjobs USING btree (exam, student) WHERE status < 2;
+
+COMMIT;
\ No newline at end of file
@@ -0,0 +1,31 @@
+--
+-- Make the changes needed to move from v3.9.8 to 3.9.9
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+BEGIN;
+
+update config SET "value" = '3.9.9' WHERE "name" = 'dbversion';
+
+CREATE TABLE latest_guesses (
+    "question" integer REFERENCES questions("question") NOT NULL,
+    "part" integer NOT NULL,
+    "created" timestamp without time zone,
+    "guess" text,
+    PRIMARY KEY ("question", "part")
+);
+
+-- the most recent guess for each part of each question, the full history
+-- stays in guesses
+INSERT INTO latest_guesses (question, part, created, guess)
+    SELECT DISTINCT ON (question, part) question, part, created, guess
+    FROM guesses
+    WHERE question IS NOT NULL AND part IS NOT NULL
+    ORDER BY question, part, created DESC, id DESC;
+
+COMMIT;
\ No newline at end of file
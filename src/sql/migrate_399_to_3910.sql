@@ -0,0 +1,17 @@
+--
+-- Make the changes needed to move from v3.9.9 to 3.9.10
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+BEGIN;
+
+update config SET "value" = '3.9.10' WHERE "name" = 'dbversion';
+
+CREATE INDEX question_marktime ON questions USING btree (marktime);
+
+COMMIT;
\ No newline at end of file